@@ -0,0 +1,67 @@
+"""
+Thin client of the barline finder daemon (barfinderd.py). Accepts the same
+arguments as barfinder.py, plus the socket of the daemon, and only imports
+the standard library.
+
+usage:
+python barclient.py -g 'staffgrouphint' image_path mei_path
+"""
+
+import json
+import os
+import socket
+import sys
+
+from barfinderargs import create_parser, DEFAULT_SOCKET
+
+# set up command line argument structure
+parser = create_parser('Send a barline detection job to the barfinder daemon.')
+parser.add_argument('-s', '--socket', help='path of the UNIX socket of the daemon', default=DEFAULT_SOCKET)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if not os.path.exists(args.filein):
+        raise ValueError('The input file does not exist')
+
+    if args.racefinders:
+        print >> sys.stderr, 'the daemon does not race the staff finders, ignoring --racefinders'
+
+    # the daemon does not share the working directory of the client:
+    # the paths are made absolute and the intermediary files, if any,
+    # are written to the working directory of the client
+    request = {
+        'cwd': os.getcwd(),
+        'filein': os.path.abspath(args.filein),
+        'fileout': os.path.abspath(args.fileout),
+        'staffgroups': args.staffgroups,
+        'verbose': args.verbose,
+        'interfiles': args.interfiles,
+        'noborderremove': args.noborderremove,
+        'norotation': args.norotation,
+        'pyramid': args.pyramid,
+        'systemregions': args.systemregions,
+        'lowmemory': args.lowmemory,
+        'runindex': args.runindex,
+        'streammei': args.streammei,
+        'sidecar': args.sidecar,
+        'meiids': args.meiids,
+        'cachedir': os.path.abspath(args.cachedir) if args.cachedir else None,
+        'trace': os.path.abspath(args.trace) if args.trace else None
+    }
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(args.socket)
+    f = client.makefile('rwb')
+    f.write(json.dumps(request) + '\n')
+    f.flush()
+    reply = json.loads(f.readline())
+    f.close()
+    client.close()
+
+    if reply['error'] is not None:
+        print >> sys.stderr, reply['error']
+        sys.exit(1)
+
+    if args.verbose:
+        print 'found %d staves and %d bars' % (reply['staves'], reply['bars'])
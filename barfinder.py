@@ -1,19 +1,19 @@
-from gamera.core import *
-from gamera.toolkits import musicstaves, lyric_extraction, border_removal
-from gamera.classify import BoundingBoxGroupingFunction, ShapedGroupingFunction
-from gamera.plugins import image_utilities
-from gamera import classify
-from gamera import knn
-import PIL, os
-import argparse
-
-from meicreate import BarlineDataConverter
-from pymei import MeiElement
-import re
-from pyparsing import nestedExpr
-import sys
-import collections
-import sets
+import os
+import numpy as np
+import pickle
+import functools
+import multiprocessing
+import Queue
+import traceback
+
+from stagecache import StageCache
+from manifest import file_hash
+from intervalindex import IntervalIndex
+from runindex import VerticalRunIndex
+import imageloader
+from barfinderargs import create_parser
+from tracing import Tracer, JSONLinesExporter, NULL_STAGE, peak_rss, reset_peak_rss
+from staffgroups import compile_hint
 
 '''
 Finds barlines in an image and outputs MEI.
@@ -21,17 +21,29 @@ Finds barlines in an image and outputs MEI.
 usage:
 python barfinder.py -g 'staffgrouphint' image_path mei_path
 python barfinder.py -g '(2|)x2 (4(2|))' images/C_07a_ED-Kl_1_A-Wn_SHWeber90_S_009.tiff mei/C_07a_ED-Kl_1_A-Wn_SHWeber90_S_009.mei
+
+reuse the outputs of previous runs on the same image:
+python barfinder.py -c cache -g 'staffgrouphint' image_path mei_path
+
+append the wall and CPU time of each stage to a JSON-lines trace:
+python barfinder.py -t trace.jsonl -g 'staffgrouphint' image_path mei_path
+
+gamera, its toolkits, pymei and pyparsing are imported by the stages that use them,
+so that the module itself loads quickly.
 '''
 
 # set up command line argument structure
-parser = argparse.ArgumentParser(description='Perform barline detection on an image and output the MEI.')
-parser.add_argument('-g', '--staffgroups', help='staffgroups')
-parser.add_argument('filein', help='input file (.tiff)')
-parser.add_argument('fileout', help='output file (.mei)')
-parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
-parser.add_argument('-i', '--interfiles', help='generate intermediary output files', action='store_true')
-parser.add_argument('-nb', '--noborderremove', help='do not remove borders automatically', action='store_true')
-parser.add_argument('-nr', '--norotation', help='do not automatically rotate', action='store_true')
+parser = create_parser()
+
+# version of the image processing pipeline: bump whenever a stage changes its output
+# so that stale cached stage outputs are no longer used
+PIPELINE_VERSION = '2'
+
+# cached stages of process_file, in pipeline order
+PIPELINE_STAGES = ('preprocess', 'staff_find', 'staffline_removal', 'mfr_filter', 'ccs')
+
+# file of the staff finder win counts in the cache directory
+STAFF_FINDER_WINS_FILENAME = 'staff_finder_wins.json'
 
 class StaffGroupMismatch(Exception):
     '''
@@ -45,18 +57,422 @@ class StaffGroupMismatch(Exception):
     def __str__(self):
         return repr(self.value)
 
+# bounding box of a barline candidate (connected component).
+# Only the geometry of the candidates is used to filter them.
+BBOX_DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('w', np.int32), ('h', np.int32),
+                       ('aspect', np.float64), ('system', np.int32)])
+
+def bbox_array(boxes):
+    '''
+    Create a structured array of bounding boxes from [(x, y, w, h), ...].
+    The aspect ratio is width over height, as the gamera aspect_ratio feature.
+    '''
+
+    bboxes = np.zeros(len(boxes), dtype=BBOX_DTYPE)
+    if len(boxes):
+        boxes = np.asarray(boxes)
+        bboxes['x'] = boxes[:, 0]
+        bboxes['y'] = boxes[:, 1]
+        bboxes['w'] = boxes[:, 2]
+        bboxes['h'] = boxes[:, 3]
+        bboxes['aspect'] = bboxes['w'] / bboxes['h'].astype(np.float64)
+
+    return bboxes
+
+def group_broken_candidates(bboxes, window):
+    '''
+    Group bar candidates that are broken into several pieces. Each candidate
+    is grouped with every candidate closer than window to it in x, and each
+    distinct group is merged into the union of its bounding boxes. Groups are
+    returned in the order in which they are first encountered.
+
+    Once the candidates are sorted by x each group is a contiguous range,
+    found by binary search, and the unions are range minimum/maximum queries:
+    O(n log n) in the number of candidates.
+    '''
+
+    if not len(bboxes):
+        return bbox_array([])
+
+    order = np.argsort(bboxes['x'], kind='mergesort')
+    sorted_bboxes = bboxes[order]
+    x = sorted_bboxes['x']
+
+    # range [lo, hi) of the sorted candidates within the window of each candidate
+    lo = np.searchsorted(x, bboxes['x'] - window, side='right')
+    hi = np.searchsorted(x, bboxes['x'] + window, side='left')
+
+    # candidates with the same range form the same group
+    _, first = np.unique(lo.astype(np.int64) * (len(bboxes) + 1) + hi, return_index=True)
+    first.sort()
+    lo = lo[first]
+    hi = hi[first]
+
+    groups = np.zeros(len(first), dtype=BBOX_DTYPE)
+    groups['x'] = x[lo]
+    groups['y'] = _range_reduce(sorted_bboxes['y'], lo, hi, np.minimum)
+    groups['w'] = _range_reduce(x + sorted_bboxes['w'], lo, hi, np.maximum) - groups['x']
+    groups['h'] = _range_reduce(sorted_bboxes['y'] + sorted_bboxes['h'], lo, hi, np.maximum) - groups['y']
+    groups['aspect'] = groups['w'] / groups['h'].astype(np.float64)
+
+    return groups
+
+def _range_reduce(values, lo, hi, ufunc):
+    '''
+    Reduce values[lo[i]:hi[i]] with ufunc (np.minimum or np.maximum) for each i,
+    using a sparse table of the reductions over ranges of power of two lengths.
+    '''
+
+    # table[k][i] is the reduction of values[i:i+2**k]
+    table = [values]
+    span = 1
+    while 2 * span <= len(values):
+        table.append(ufunc(table[-1][:-span], table[-1][span:]))
+        span *= 2
+
+    # two overlapping ranges of length 2**k cover [lo, hi)
+    k = np.frexp(hi - lo)[1] - 1
+    reduced = np.empty(len(lo), dtype=values.dtype)
+    for level in np.unique(k):
+        mask = k == level
+        reduced[mask] = ufunc(table[level][lo[mask]], table[level][hi[mask] - 2**level])
+
+    return reduced
+
+class PageFeatures:
+    '''
+    Features of a page that do not depend on the barline candidate
+    filtering thresholds. Produced by BarlineFinder.extract_features
+    and consumed by BarlineFinder.refine.
+    '''
+
+    def __init__(self, stf_position, system, ccs, image_path, image_width, image_height, image_dpi,
+                 version=PIPELINE_VERSION, params=None, image_hash=None):
+        '''
+        PARAMETERS
+        ----------
+        stf_position {list}: [[staff_no, x1, y1, x2, y2, system_no], ...]
+        system {list}: system number of each staff given by the staff group hint
+        ccs {ndarray}: bounding boxes of the connected components (BBOX_DTYPE)
+        image_path {String}: path of the preprocessed image
+        image_width {int}: width of the preprocessed image
+        image_height {int}: height of the preprocessed image
+        image_dpi {int}: resolution of the image in the x dimension
+        version {String}: pipeline version that extracted the features
+        params {dict}: parameters of the extraction (see BarlineFinder.extract_params)
+        image_hash {String}: sha1 hash of the input image the features were extracted from
+        '''
+
+        self.stf_position = stf_position
+        self.system = system
+        self.ccs = ccs
+        self.image_path = image_path
+        self.image_width = image_width
+        self.image_height = image_height
+        self.image_dpi = image_dpi
+        self.version = version
+        self.params = params
+        self.image_hash = image_hash
+
+    def matches(self, params, image_hash):
+        '''
+        Check that the features were extracted from the image of the given hash
+        by this version of the pipeline with the given parameters, and can be reused
+        '''
+
+        return self.version == PIPELINE_VERSION and self.params == params and self.image_hash == image_hash
+
+    def to_dict(self):
+        return {
+            'stf_position': self.stf_position,
+            'system': self.system,
+            'ccs': self.ccs,
+            'image_path': self.image_path,
+            'image_width': self.image_width,
+            'image_height': self.image_height,
+            'image_dpi': self.image_dpi,
+            'version': self.version,
+            'params': self.params,
+            'image_hash': self.image_hash
+        }
+
+    @staticmethod
+    def from_dict(d):
+        # features saved before they were versioned never match
+        return PageFeatures(d['stf_position'], d['system'], d['ccs'], d['image_path'],
+                            d['image_width'], d['image_height'], d['image_dpi'],
+                            d.get('version'), d.get('params'), d.get('image_hash'))
+
+    def save(self, path):
+        '''
+        Write the features to disk
+        '''
+
+        with open(path, 'wb') as f:
+            pickle.dump(self.to_dict(), f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        '''
+        Read features written by PageFeatures.save.
+        Returns None if the file cannot be read, e.g. if it was written
+        by a version of the pipeline whose classes no longer exist.
+        '''
+
+        try:
+            with open(path, 'rb') as f:
+                return PageFeatures.from_dict(pickle.load(f))
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError, TypeError):
+            return None
+
+def init_gamera():
+    '''
+    Import and initialize gamera and the toolkits used by the barline finder
+    '''
+
+    from gamera import core
+    from gamera.toolkits import musicstaves, border_removal
+    from gamera.plugins import numeric_io
+
+    core.init_gamera()
+
+def _run_staff_finder(name, finder, image, image_dpi, queue):
+    '''
+    Run a staff finder in a forked process and send its result to the parent
+    '''
+
+    try:
+        queue.put((name, finder(image, image_dpi), None))
+    except:
+        queue.put((name, None, traceback.format_exc()))
+
+# barline finder of a process_files worker process
+_worker_finder = None
+
+def _init_worker(finder_params):
+    '''
+    Initialize a process_files worker: gamera is initialized once
+    and the same barline finder is reused for every job of the worker
+    '''
+
+    global _worker_finder
+
+    init_gamera()
+    _worker_finder = BarlineFinder(**finder_params)
+
+def _run_job(job):
+    '''
+    Process a single process_files job in a worker process
+    '''
+
+    return _process_job(_worker_finder, job)
+
+def _write_outputs(bar_finder, result, sg_hint, output_file):
+    '''
+    Convert the result of process_file to MEI and write it,
+    along with its sidecar file if the barline finder has a sidecar format
+    '''
+
+    from meicreate import BarlineDataConverter
+
+    staff_bb, bar_bb, image_path, image_width, image_height, image_dpi = result
+    bar_converter = BarlineDataConverter(staff_bb, bar_bb, bar_finder.verbose, bar_finder._mei_ids)
+    if bar_finder._stream_mei:
+        with bar_finder.stage('mei_write', bars=len(bar_bb), stream=True):
+            bar_converter.write_mei(output_file, sg_hint, image_path, image_width, image_height, image_dpi)
+    else:
+        with bar_finder.stage('mei_build', bars=len(bar_bb)):
+            bar_converter.bardata_to_mei(sg_hint, image_path, image_width, image_height, image_dpi)
+        with bar_finder.stage('mei_write'):
+            bar_converter.output_mei(output_file)
+
+    if bar_finder._sidecar is not None:
+        from sidecar import sidecar_path, write_results
+        with bar_finder.stage('sidecar_write', format=bar_finder._sidecar):
+            write_results(sidecar_path(output_file, bar_finder._sidecar), *result)
+
+def _update_staff_finder_wins(path, collection=None, winner=None):
+    '''
+    Read the staff finder win counts {collection: {'dalitz': n, 'miyao': n}}
+    of a JSON file and, if a winner is given, count a page won on the
+    collection. The file is locked so that concurrent processes can share it.
+    '''
+
+    import fcntl
+    import json
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process created it first
+            pass
+
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                wins = json.loads(f.read() or '{}')
+            except ValueError:
+                # unreadable counts are started over
+                wins = {}
+
+            if winner is not None:
+                collection_wins = wins.setdefault(collection, {'dalitz': 0, 'miyao': 0})
+                collection_wins[winner] += 1
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(wins))
+                f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    return wins
+
+def _process_job(bar_finder, job):
+    '''
+    Process a single job with the given barline finder and write
+    its MEI output. Returns (job, result, error) where error is the
+    formatted traceback of a failed job.
+    '''
+
+    input_file, sg_hint, output_file = job[:3]
+    noborderremove = job[3] if len(job) > 3 else False
+    norotation = job[4] if len(job) > 4 else False
+
+    try:
+        # parsed once, shared by the finder and the converter
+        sg_hint = compile_hint(sg_hint)
+        result = bar_finder.process_file(input_file, sg_hint, noborderremove, norotation)
+        if output_file is not None:
+            _write_outputs(bar_finder, result, sg_hint, output_file)
+    except:
+        return job, None, traceback.format_exc()
+
+    return job, result, None
+
 class BarlineFinder:
 
-    def __init__(self, ar_thresh=0.1, v_thresh=0.66, interfiles=False, verbose=False):
+    def __init__(self, ar_thresh=0.1, v_thresh=0.66, interfiles=False, verbose=False, cache_dir=None, race_staff_finders=False, pyramid=False, roi=False, roi_margin=None, tracer=None, low_memory=False, run_index=False, stream_mei=False, sidecar=None, mei_ids='uuid', staff_finder_wins=None):
+        # constructor parameters, to create the same barline finder in worker processes
+        self._params = {
+            'ar_thresh': ar_thresh,
+            'v_thresh': v_thresh,
+            'interfiles': interfiles,
+            'verbose': verbose,
+            'cache_dir': cache_dir,
+            'race_staff_finders': race_staff_finders,
+            'pyramid': pyramid,
+            'roi': roi,
+            'roi_margin': roi_margin,
+            'tracer': tracer,
+            'low_memory': low_memory,
+            'run_index': run_index,
+            'stream_mei': stream_mei,
+            'sidecar': sidecar,
+            'mei_ids': mei_ids,
+            'staff_finder_wins': staff_finder_wins
+        }
+
         self._ar_thresh = ar_thresh
         self._v_thresh = v_thresh
         self._interfiles = interfiles
         self.verbose = verbose
 
+        # run both staff finders concurrently instead of one after the other
+        self._race_staff_finders = race_staff_finders
+        # number of pages won by each staff finder per collection (image directory)
+        # {collection: {'dalitz': n, 'miyao': n}}
+        self._staff_finder_wins = {}
+        # the win counts are shared with the other runs and processes through a JSON file,
+        # by default in the cache directory, since a process may only see a few pages
+        if staff_finder_wins is None and cache_dir is not None:
+            staff_finder_wins = os.path.join(cache_dir, STAFF_FINDER_WINS_FILENAME)
+        self._staff_finder_wins_path = staff_finder_wins
+        if self._staff_finder_wins_path is not None:
+            self._staff_finder_wins = _update_staff_finder_wins(self._staff_finder_wins_path)
+
+        # find staves on a downsampled page and refine them at full resolution
+        self._pyramid = pyramid
+
+        # only remove stafflines and find connected components around the systems,
+        # padded by roi_margin pixels (default: one staff height)
+        self._roi = roi
+        self._roi_margin = roi_margin
+
+        # release each page buffer as soon as its last stage is done
+        # and filter the page in place
+        self._low_memory = low_memory
+
+        # filter the short runs, despeckle and find the connected components
+        # of the page without stafflines on its vertical run-length index
+        self._run_index = run_index
+
+        # write the MEI of _process_job incrementally instead of building a pymei document
+        self._stream_mei = stream_mei
+
+        # format of the compact results file written next to the MEI (see sidecar.py), if any
+        self._sidecar = sidecar
+
+        # id strategy of the MEI elements (see meiids.py)
+        self._mei_ids = mei_ids
+
+        # peak resident set size of the last page processed (bytes)
+        self.peak_rss = None
+
+        # cache of the outputs of the threshold independent stages
+        if cache_dir is not None:
+            self._cache = StageCache(cache_dir, PIPELINE_VERSION)
+        else:
+            self._cache = None
+
+        # records the time spent in each stage (see tracing.py)
+        self._tracer = tracer
+
+    def stage(self, name, **details):
+        '''
+        Return a context manager tracing the stage of the given name,
+        which does nothing without a tracer
+        '''
+
+        if self._tracer is None:
+            return NULL_STAGE
+        return self._tracer.stage(name, **details)
+
+    def output_params(self):
+        '''
+        Return the constructor parameters that may change the
+        output of the barline finder, to record along with it
+        '''
+
+        return dict((k, v) for k, v in self._params.items()
+                    if k not in ('interfiles', 'verbose', 'cache_dir', 'tracer', 'staff_finder_wins'))
+
+    def extract_params(self, sg_hint, noborderremove=False, norotation=False):
+        '''
+        Return the parameters that may change the output of extract_features
+        on a page, to record along with the features
+        '''
+
+        params = dict((k, v) for k, v in self.output_params().items()
+                      if k not in ('ar_thresh', 'v_thresh', 'stream_mei', 'sidecar', 'mei_ids'))
+        params.update({
+            'sg_hint': compile_hint(sg_hint).hint,
+            'noborderremove': bool(noborderremove),
+            'norotation': bool(norotation)
+        })
+
+        return params
+
     def _border_removal(self, image):
         """
         Calculates and masks the image border, returns a new image
         """
+        # registers the border_removal plugin
+        from gamera.toolkits import border_removal
+
         mask_border = image.border_removal(3, 5, 5, 0.8, 6.0, 0.8, 6.0, 0.25, 15, 23, 75, 45, 15)
         masked_image = image.mask(mask_border)
         return masked_image
@@ -64,6 +480,8 @@ class BarlineFinder:
     def _staffline_removal(self, image):
         """
         """
+        from gamera.toolkits import musicstaves
+
         i = musicstaves.MusicStaves_rl_roach_tatem(image, 0, 0)
         i.remove_staves(u'all', 5)
         return i.image
@@ -73,14 +491,24 @@ class BarlineFinder:
         """
         return image.despeckle(despeckle_value)
 
-    def _most_frequent_run_filter(self, image, mfr, despeckle_value):
+    def _most_frequent_run_filter(self, image, mfr, despeckle_value, in_place=False):
         """
         """
-        filtered_image = image.image_copy()
+        filtered_image = image if in_place else image.image_copy()
         filtered_image.filter_short_runs(mfr + 5, 'black') # most frequent run plus 1 pixel
         filtered_image.despeckle(despeckle_value)
         return filtered_image
 
+    def _run_index_filter(self, image, mfr, despeckle_value):
+        """
+        Same as _most_frequent_run_filter, on the vertical run-length index
+        of the image. Only long vertical runs are left after the short runs are
+        filtered, so the connected components, and with them the despeckling,
+        are computed on the runs alone.
+        """
+        runs = VerticalRunIndex.from_image(image)
+        return runs.filter_short_runs(mfr + 5).despeckle(despeckle_value)
+
     def _ccs(self, proc_image):
         """
         Performs connected component analysis
@@ -100,6 +528,8 @@ class BarlineFinder:
         sc_position = [] # staff candidate
         stf_position = []
 
+        from gamera.toolkits import musicstaves
+
         stf_instance = musicstaves.StaffFinder_dalitz(image, 0, 0)
         stf_instance.find_staves(5, 3, 60, 25, True, True, 0) # 5 lines
         skeleton = stf_instance.get_skeleton()
@@ -137,6 +567,8 @@ class BarlineFinder:
         sc_position = [] # staff candidate
         stf_position = []
         
+        from gamera.toolkits import musicstaves
+
         stf_instance = musicstaves.StaffFinder_miyao(image, 0, 0)
         stf_instance.find_staves(5, 20, 0.8, -1) # 5 lines
         polygon = stf_instance.get_polygon()
@@ -155,6 +587,87 @@ class BarlineFinder:
         return sc_position
      
 
+    def _staff_line_position_pyramid(self, finder, image, image_dpi, coarse_dpi=150):
+        """Multi-resolution staff finding. Coarse staff positions are found
+        with the given staff finder on a downsampled copy of the page, then
+        refined by running it at full resolution only within horizontal bands
+        around each coarse staff.
+
+        Returns a vector with the vertices for each staff with the form 
+        [(staff_number, x1, y1, x2, y2)], starting from number 1
+        """
+
+        factor = int(image_dpi // coarse_dpi)
+        if factor < 2:
+            return finder(image, image_dpi)
+
+        # the pixels of the page, indexed from 0 whatever the offset of the image
+        pixels = image.to_numpy()
+
+        # downsample by taking the maximum of each block of factor x factor pixels,
+        # so that thin staff lines are not lost
+        nrows = pixels.shape[0] // factor * factor
+        ncols = pixels.shape[1] // factor * factor
+        coarse_pixels = pixels[:nrows, :ncols].reshape(nrows // factor, factor, ncols // factor, factor).max(axis=3).max(axis=1)
+        from gamera.plugins import numeric_io
+        coarse_image = numeric_io.from_numpy(np.ascontiguousarray(coarse_pixels))
+        coarse_position = finder(coarse_image, image_dpi // factor)
+
+        # horizontal bands of the full resolution image around each coarse staff
+        # [[y1, y2, [coarse staves]], ...]
+        bands = []
+        for st in sorted(coarse_position, key=lambda st: min(st[2], st[4])):
+            y1 = min(st[2], st[4]) * factor
+            y2 = (max(st[2], st[4]) + 1) * factor
+            # pad by half a staff height to make up for the inaccuracy of the coarse position
+            margin = (y2 - y1) // 2 + factor
+            band = [max(y1 - margin, 0), min(y2 + margin, image.nrows - 1), [st]]
+            if bands and band[0] <= bands[-1][1]:
+                # staves that are close together are refined in the same band
+                bands[-1][1] = max(bands[-1][1], band[1])
+                bands[-1][2].append(st)
+            else:
+                bands.append(band)
+
+        sc_position = []
+        for y1, y2, coarse_staves in bands:
+            # the band is copied to an image of its own, so the staves are found
+            # in band coordinates whatever the offset of the page image
+            band_image = numeric_io.from_numpy(np.ascontiguousarray(pixels[y1:y2 + 1]))
+            try:
+                band_position = finder(band_image, image_dpi)
+            except Exception, e:
+                if self.verbose:
+                    print 'PYRAMID: staff finder failed on band {0}-{1}: {2!r}'.format(y1, y2, e)
+                band_position = None
+
+            if band_position is not None and len(band_position) == len(coarse_staves):
+                # translate the band coordinates to page coordinates
+                dx, dy = 0, y1
+                sc_position.extend([[x1 + dx, sy1 + dy, x2 + dx, sy2 + dy] for _, x1, sy1, x2, sy2 in band_position])
+            else:
+                # keep the coarse staves if they could not be refined,
+                # rather than losing or adding staves
+                if self.verbose and band_position is not None:
+                    print 'PYRAMID: {0} staves refined in band {1}-{2} instead of {3}, keeping the coarse staves'.format(
+                        len(band_position), y1, y2, len(coarse_staves))
+                sc_position.extend([[x1 * factor, sy1 * factor, x2 * factor, sy2 * factor] for _, x1, sy1, x2, sy2 in coarse_staves])
+
+        return [[i + 1] + sc for i, sc in enumerate(sc_position)]
+
+    def _staff_finders(self):
+        '''
+        Returns the staff finders {name: finder(image, image_dpi)},
+        running on an image pyramid if requested.
+        '''
+
+        finders = {'dalitz': self._staff_line_position_dalitz, 'miyao': self._staff_line_position_miyao}
+        if self._pyramid:
+            for name, finder in finders.items():
+                finders[name] = functools.partial(self._staff_line_position_pyramid, finder)
+
+        return finders
+
     def stafffinding_glue(self, sc_position):
         """
         Glues the staff output of the stafffinding algorithms
@@ -209,7 +722,7 @@ class BarlineFinder:
                 system_bb.append(sp)
         return system_bb
 
-    def _bar_candidate_check(self, bar_candidates, stf_position, system, image_dpi):
+    def _bar_candidate_check(self, bar_candidates, stf_position, system, image_dpi, ar_thresh, v_thresh):
         """
         Several methods to discard and/or validate bar candidates:
 
@@ -221,164 +734,107 @@ class BarlineFinder:
         3) Creates a barline at the beginning of each staff according 
         to the staff position by the Miyao staff finder.
 
-        Returns a vector in the form: [[gameracore.Image, staff_no]]
+        Returns a structured array of bounding boxes (BBOX_DTYPE) whose
+        system field holds the system number of each bar.
 
         PARAMETERS
         ----------
+        bar_candidates (ndarray): bounding boxes of the connected components (BBOX_DTYPE)
         ar_thresh (Float): threshold parameter for aspect ratio of bar candidates
         v_thresh (Float): threshold parameter for the percentage of the staff height for bar candidates
                           to be within the system bounding box (y dimension)
         """
 
-        checked_bars = []
         stf_height = sum([i[4]-i[2] for i in stf_position])/len(stf_position)
         system_bb = self._system_position_parser(stf_position)    
         no_sys =  len(system_bb) 
+        # [[x1, y1, x2, y2, system_no], ...]
+        system_arr = np.array([bb[1:6] for bb in system_bb])
 
         if self.verbose:
             print 'STF_HEIGHT:{0}'.format(stf_height)
 
-        def __within_bb_check(bc, bb):
-            """
-            Checks if a bar_candidate is inside a bounding_box (system or staff)
-            """
-            bc_mid_x = bc.offset_x + int((bc.ncols - 1) / 2)
-            bc_mid_y = bc.offset_y + int((bc.nrows - 1) / 2)
-            bb_x1, bb_x2 = bb[1], bb[3]
-            bb_y1, bb_y2 = bb[2], bb[4]
-            # print 'x1:{0}, y1:{1}, x2:{2}, y2:{3}, x_mid:{4}, y_mid:{5}'.format(bb_x1, bb_y1, bb_x2, bb_y2, bc_mid_x, bc_mid_y)
-
-            if bc_mid_x > bb_x1 and bc_mid_x < bb_x2 and bc_mid_y > bb_y1 and bc_mid_y < bb_y2:
-                return bb
-
-        def __bar_candidate_grouping(ungrouped_bars):
-            """
-            Groups bar candidates and returns grouped bars
-            """
-            grouped_bars = []
-            grouped_bars.append(image_utilities.union_images(ungrouped_bars))
-            return grouped_bars
-
-
         # 1. filter by aspect ratio
-        bar_candidates = [bc for bc in bar_candidates if bc.aspect_ratio()[0] <= self._ar_thresh]# and bc.ncols <=15]
+        bar_candidates = bar_candidates[bar_candidates['aspect'] <= ar_thresh]
         if not len(bar_candidates):
             # if all candidates have been filtered, no need to filter more
-            return []
-
-        # aspect_ratio = [bc.aspect_ratio() for bc in bar_candidates]
-        # print aspect_ratio
+            return bbox_array([])
 
         # 2. Discard bar_candidates outside of all system_bb(filtering by middle position)
-        filt_bar_candidates = []
-        bc_av_width = 0
-        for bc in bar_candidates:
-            for s in system_bb:
-                bb = __within_bb_check(bc, s)
-                if bb:
-                    filt_bar_candidates.append([bc, bb[5]])
-                    bc_av_width += bc.ncols
-                    break
-        
+        # and label the rest with the first system they lie in
+        bc_mid_x = bar_candidates['x'] + (bar_candidates['w'] - 1) // 2
+        bc_mid_y = bar_candidates['y'] + (bar_candidates['h'] - 1) // 2
+        system_idx = IntervalIndex(system_bb).first_containing(bc_mid_x, bc_mid_y)
+        filt_bar_candidates = bar_candidates[system_idx >= 0]
+        filt_bar_candidates['system'] = system_arr[system_idx[system_idx >= 0], 4]
+
         # if all candidates have been filtered, no need to filter more
         if not len(filt_bar_candidates):    
-            return []
+            return bbox_array([])
 
         # Calculate the average width of bar candidates
-        bc_av_width = bc_av_width/len(filt_bar_candidates) 
-        
-        # group bar candidates by system which they belong
-        sys_bars = []
-        for i in xrange(no_sys):
-            sys_bars.append([x for x in filt_bar_candidates if x[1] == i+1])
-
-        for sys_bar_idx, sys_bar in enumerate(sys_bars):
-            bars = []
-            system_height = abs(system_bb[sys_bar_idx][4]-system_bb[sys_bar_idx][2])
-
-            factor = 4 # vertical tolerance for finding vertical candidates (should be dependent on the number of staves per system)
-            brok_cand_list = []
-            #each bar candidate within the same system
-            for s_ind, s in enumerate(sys_bar): 
-                brok_cand = [x[0] for x in sys_bar if \
-                        (s[0].offset_x > (x[0].offset_x - factor * bc_av_width) and \
-                         s[0].offset_x < (x[0].offset_x + factor * bc_av_width))] 
-
-                if not brok_cand in brok_cand_list: # if it is not already in the list of broken bar candidates
-                    brok_cand_list.append(brok_cand)
-
-                    if len(brok_cand) > 1:   
-                        grouped_bars = __bar_candidate_grouping(brok_cand)
-                        # run until all candidates have been glued
-                        while len(grouped_bars) > 1:
-                            grouped_bars = __bar_candidate_grouping(grouped_bars) 
-                        bars.append(grouped_bars[0])
-                    else:
-                        bars.append(s[0])
+        bc_av_width = int(filt_bar_candidates['w'].sum()) // len(filt_bar_candidates)
+
+        factor = 4 # vertical tolerance for finding vertical candidates (should be dependent on the number of staves per system)
+        checked_bars = []
+        for sys_bar_idx in xrange(no_sys):
+            # glue broken bar candidates within the same system
+            sys_bar = filt_bar_candidates[filt_bar_candidates['system'] == sys_bar_idx+1]
+            bars = group_broken_candidates(sys_bar, factor * bc_av_width)
+            bars['system'] = sys_bar_idx+1
+            checked_bars.append(bars)
 
-            for bc in bars:
-                checked_bars.append((bc, sys_bar_idx+1))
+        checked_bars = np.concatenate(checked_bars)
 
         # filtering bar candidates that are outside a y-range of tolerance
-        for cb_idx in range(len(checked_bars)-1, -1, -1):
-            cb = checked_bars[cb_idx]
-            bc_y1 = cb[0].offset_y
-            bc_y2 = cb[0].offset_y + cb[0].nrows
-            bb_y1 = system_bb[cb[1]-1][2]
-            bb_y2 = system_bb[cb[1]-1][4]
-            tolerance = self._v_thresh * stf_height #tolerance dependent on stf_height
-
-            if abs(bc_y1 - bb_y1) > tolerance or abs(bc_y2 - bb_y2) > tolerance:
-                del checked_bars[cb_idx]
+        bb_y1 = system_arr[checked_bars['system']-1, 1]
+        bb_y2 = system_arr[checked_bars['system']-1, 3]
+        tolerance = v_thresh * stf_height #tolerance dependent on stf_height
+        checked_bars = checked_bars[(np.abs(checked_bars['y'] - bb_y1) <= tolerance) &
+                                    (np.abs(checked_bars['y'] + checked_bars['h'] - bb_y2) <= tolerance)]
 
         # if all candidates have been filtered, no need to filter more
         if not len(checked_bars):    
-            return []
+            return bbox_array([])
 
         # comparing first and last bar candidate with staffFinder output
         # converting the barline candidate structure into a different one
         # where bar candidates are ordered according to the system they belong:
         # system_bars[sys_no][bar_no]
         system_bars = []
-        for i, cb in enumerate(checked_bars):
-            system_no = int(cb[1])
-            bar_image = cb[0]
+        for i, system_no in enumerate(checked_bars['system']):
             try:
-                system_bars[system_no-1].append(bar_image)
+                system_bars[system_no-1].append(i)
             except IndexError:
-                system_bars.append([bar_image])
+                system_bars.append([i])
 
         # sort all system bar candidates by x-position
-        system_bars = [sorted(sb, key = lambda element: element.offset_x) for sb in system_bars]
+        system_bars = [checked_bars[sb][np.argsort(checked_bars['x'][sb], kind='mergesort')] for sb in system_bars]
 
+        # bars created from the stafffinder output are as high as the last system
+        system_height = abs(system_bb[-1][4]-system_bb[-1][2])
         for idx, sb in enumerate(system_bars):
             # first and last bars
-            fb_x, lb_x = sb[0].offset_x, sb[-1].offset_x 
+            fb_x, lb_x = sb['x'][0], sb['x'][-1]
             bb_x1, bb_x2 = system_bb[idx][1], system_bb[idx][3]
             bb_y1, bb_y2 = system_bb[idx][2], system_bb[idx][4]
             tolerance = 1 * stf_height
-            system_height = abs(system_bb[sys_bar_idx][4]-system_bb[sys_bar_idx][2])
 
             if abs(fb_x - bb_x1) > tolerance:
-                # create a new blank image for a manually created bar candidate from the stafffinder output
-                new_bc = Image(Point (bb_x1, bb_y1), Point(bb_x1 + bc_av_width, bb_y1 + system_height))
-                sb.insert(0, new_bc)
+                # create a new bar candidate from the stafffinder output
+                sb = np.concatenate((bbox_array([(bb_x1, bb_y1, bc_av_width + 1, system_height + 1)]), sb))
 
             if abs(lb_x - bb_x2) > tolerance:
-                # create a new blank image for a manually created bar candidate from the stafffinder output
-                new_bc = Image(Point (bb_x2, bb_y2), Point(bb_x2 + bc_av_width, bb_y2 + system_height))
-                sb.append(new_bc)
+                # create a new bar candidate from the stafffinder output
+                sb = np.concatenate((sb, bbox_array([(bb_x2, bb_y2, bc_av_width + 1, system_height + 1)])))
 
             # filters bar candidates that are close together by x
             tolerance = 2 * stf_height # maximum horizontal is given the maximum amount of alterations
-            for jdx in range(len(sb) - 1, 0, -1):
-                if abs(sb[jdx - 1].offset_x - sb[jdx].offset_x) < tolerance:
-                    del sb[jdx]
+            sb = sb[np.concatenate(([True], np.abs(np.diff(sb['x'])) >= tolerance))]
+            sb['system'] = idx+1
+            system_bars[idx] = sb
 
-        checked_bars = []
-        for idx, sb in enumerate(system_bars):
-            for bar in sb:
-                checked_bars.append((bar, idx+1))
+        checked_bars = np.concatenate(system_bars)
 
         if self.verbose:
             print 'Checked bars:{0}'.format(checked_bars)
@@ -390,30 +846,15 @@ class BarlineFinder:
         Assigns staff number to all bars
         """
 
+        # a bar belongs to every staff it overlaps vertically
+        staff_index = IntervalIndex(staff_bb)
         numbered_bars = []
         for bar in bars_bb:
-            for staff_idx, staff in enumerate(staff_bb):
-                staff_check = self._within_bb_checker(bar, staff)
-                if staff_check == True:
-                    numbered_bars.append((staff[0], bar[1], staff[2], bar[3], staff[4]))
+            for staff_idx in staff_index.overlapping(bar[2], bar[4]):
+                staff = staff_bb[staff_idx]
+                numbered_bars.append((staff[0], bar[1], staff[2], bar[3], staff[4]))
         return numbered_bars
 
-
-    def _within_bb_checker(self, bar_bb, staff_bb):
-        """
-        Checks if a bar_candidate is inside a bounding_box (system or staff)
-        """
-        x_bar_range = (bar_bb[1], bar_bb[3])
-        y_bar_range = (bar_bb[2], bar_bb[4])
-
-        x_staff_range = (staff_bb[1], staff_bb[3])
-        y_staff_range = (staff_bb[2], staff_bb[4])
-
-        for y in xrange(y_bar_range[0], y_bar_range[1]+1):
-            if y_staff_range[0] < y < y_staff_range[1]:
-                return True
-
-
     def _bar_sorting(self, bar_vector):
         """
         Sorts a set of bars according to their staff number and x-position. Input vector should be:
@@ -423,72 +864,45 @@ class BarlineFinder:
         # lg.debug(checked_bars)
         return checked_bars
 
-    def _system_structure_parser(self, system_input):
-        """
-        Parses the structure of the system according to the user input
-        """
-        system = system_input.split(',')
-        output = []
-        for i, s in enumerate(system):
-            for j in range(int(s)):
-                output.append(i+1)
-        return output
-    
-    def _parse_staff_hint(self, sg_hint):
-        # parse staff group hint to generate staff group
-        sg_hint = sg_hint.split(" ")
-        systems = []
-        for s in sg_hint:
-            parser = nestedExpr()
-            sg_list = parser.parseString(s).asList()[0]
-            staff_grp, n = self._create_staff_group(sg_list, MeiElement('staffGrp'), 0)
-
-            # parse repeating staff groups (systems)
-            num_sb = 1
-            match = re.search('(?<=x)(\d+)$', s)
-            if match is not None:
-                # there are multiple systems of this staff grouping
-                num_sb = int(match.group(0))
-            
-            for i in range(num_sb):
-                systems.append(staff_grp)
+    def _highlight(self, image, bboxes):
+        from gamera.core import SubImage, Point, RGBPixel
 
-        return systems
+        RGB_image = image.to_rgb()
+        for x, y, w, h in zip(bboxes['x'].tolist(), bboxes['y'].tolist(), bboxes['w'].tolist(), bboxes['h'].tolist()):
+            # clip the bounding box to the image, manually created bars may lie outside of it
+            ul = Point(max(x, image.offset_x), max(y, image.offset_y))
+            lr = Point(min(x + w, image.offset_x + image.ncols) - 1, min(y + h, image.offset_y + image.nrows) - 1)
+            if ul.x <= lr.x and ul.y <= lr.y:
+                RGB_image.highlight(SubImage(image, ul, lr), RGBPixel(255, 0, 0))
+        return RGB_image
 
-    def _create_staff_group(self, sg_list, staff_grp, n):
+    def _save_tiles(self, tiles, input_file, suffix, num_tiles=None):
         '''
-        Recursively create the staff group element from the parsed
-        user input of the staff groupings
+        Save intermediary images of the tiles of a page.
+        The tiles may be generated one at a time, given their number.
         '''
-        if not sg_list:
-            return staff_grp, n
-        else:
-            if type(sg_list[0]) is list:
-                new_staff_grp, n = self._create_staff_group(sg_list[0], MeiElement('staffGrp'), n)
-                staff_grp.addChild(new_staff_grp)
+
+        if num_tiles is None:
+            num_tiles = len(tiles)
+
+        filename = os.path.splitext(input_file.split('/')[-1])[0] + suffix
+        for i, (x, y, tile) in enumerate(tiles):
+            if num_tiles == 1:
+                tile.save_tiff(filename + '.tiff')
             else:
-                # check for barthrough character
-                if sg_list[0][-1] == '|':
-                    # the barlines go through all the staves in the staff group
-                    staff_grp.addAttribute('barthru', 'true')
-                    # remove the barthrough character, should now only be an integer
-                    sg_list[0] = sg_list[0][:-1]
-
-                n_staff_defs = int(sg_list[0])
-                # get current staffDef number
-                for i in range(n_staff_defs):
-                    staff_def = MeiElement('staffDef')
-                    staff_def.addAttribute('n', str(n+i+1))
-                    staff_grp.addChild(staff_def)
-                n += n_staff_defs
-
-            return self._create_staff_group(sg_list[1:], staff_grp, n)
-
-    def _highlight(self, image, ccs_bars):
-        RGB_image = image.to_rgb()
-        for c in ccs_bars:
-            RGB_image.highlight(c[0], RGBPixel(255, 0, 0))
-        return RGB_image
+                tile.save_tiff('%s_%d.tiff' % (filename, i))
+
+    def _tile_bboxes(self, bboxes, x, y, tile):
+        '''
+        Translate bounding boxes in page coordinates to the coordinates
+        of the tile at page coordinates x, y
+        '''
+
+        tile_bboxes = bboxes.copy()
+        tile_bboxes['x'] -= x - tile.offset_x
+        tile_bboxes['y'] -= y - tile.offset_y
+
+        return tile_bboxes
 
     # def _filter_close_bar_bb(self, sorted_bars, staff_bb, image_dpi):
     #     # print 'A', image_dpi
@@ -500,46 +914,203 @@ class BarlineFinder:
         filtered_bars = sorted_bars
         return filtered_bars
 
-    def process_file(self, input_file, sg_hint, noborderremove=False, norotation=False):
+    def _system_regions(self, stf_position, image_width, image_height):
         '''
-        Find measures in the given input file.
+        Regions of the page around each system: the system bounding boxes padded
+        by the margin and clipped to the page. Regions that overlap vertically are
+        merged so that no connected component is found twice.
 
-        PARAMETERS
-        ----------
-        sg_hint: staff group hint inputted manually by the user
-        noborderremove: flag to specify whether the automatic border removal algorithm should be used
-        norotation: flag to specify whether the automatic rotation algorithm should be used
+        Returns [(x1, y1, x2, y2), ...]
         '''
 
-        image = load_image(input_file)
+        if self._roi_margin is not None:
+            margin = self._roi_margin
+        else:
+            # one staff height
+            margin = sum([st[4]-st[2] for st in stf_position])/len(stf_position)
+
+        # the system parser modifies the staff positions
+        system_bb = self._system_position_parser([list(st) for st in stf_position])
+
+        regions = []
+        for bb in sorted(system_bb, key=lambda bb: bb[2]):
+            x1 = max(bb[1] - margin, 0)
+            y1 = max(bb[2] - margin, 0)
+            x2 = min(bb[3] + margin, image_width - 1)
+            y2 = min(bb[4] + margin, image_height - 1)
+            if regions and y1 <= regions[-1][3]:
+                r = regions[-1]
+                regions[-1] = (min(r[0], x1), r[1], max(r[2], x2), max(r[3], y2))
+            else:
+                regions.append((x1, y1, x2, y2))
+
+        return regions
+
+    def _preprocess(self, input_file, image_info, noborderremove, norotation):
+        '''
+        Load the image, remove its border, binarize it and correct its rotation.
+        '''
+
+        # the border removal needs a greyscale image
+        with self.stage('load', width=image_info.width, height=image_info.height):
+            image = imageloader.load_image(input_file, image_info, greyscale=not noborderremove)
 
         # since they want to be able to disclude this step from the workflow on the command line
         if not noborderremove:
-            #Applies a mask. Greyscale image needed
-            if image.pixel_type_name != 'GreyScale':
-                image = image.to_greyscale()
-            image = self._border_removal(image)
+            with self.stage('border_removal', width=image.ncols, height=image.nrows):
+                #Applies a mask. Greyscale image needed
+                if image.pixel_type_name != 'GreyScale':
+                    image = image.to_greyscale()
+                image = self._border_removal(image)
 
         # Binarizes image
-        image = image.to_onebit()
+        with self.stage('onebit', width=image.ncols, height=image.nrows):
+            image = image.to_onebit()
 
         # since they want to be able to disclude this step from the workflow
         if not norotation:
             # Auto-rotates an image
-            image = image.correct_rotation(0)
+            with self.stage('rotation') as stage:
+                image = image.correct_rotation(0)
+                stage.record(width=image.ncols, height=image.nrows)
 
-        # save the image that barline candidates are calculated from
-        # the MEI will reference this file
-        image_path = os.path.splitext(input_file.split('/')[-1])[0] + '_preprocessed.tiff'
-        if self._interfiles:
-            image.save_tiff(image_path)
-        image_width = image.width
-        image_height = image.height
+        return image
+
+    def _find_staves(self, image, image_dpi, system, collection=None):
+        '''
+        Find the staves with the Dalitz staff finder, falling back to the
+        Miyao staff finder if it fails or the number of staves found does not
+        match the staff group hint. The output is glued.
+
+        In racing mode both staff finders run concurrently, unless the Dalitz
+        staff finder almost always wins on the collection of the image, in
+        which case it is tried first on its own.
+        '''
+
+        with self.stage('staff_find', width=image.ncols, height=image.nrows) as stage:
+            if self._race_staff_finders and not self._usual_staff_finder_winner(collection) == 'dalitz':
+                winner, stf_position = self._race_staff_line_position(image, image_dpi, system)
+            else:
+                finders = self._staff_finders()
+                try:
+                    stf_position = finders['dalitz'](image, image_dpi)
+                    if len(stf_position) != len(system):
+                        raise StaffGroupMismatch('Number of recognized staves is different to the one entered by the user')
+                    winner = 'dalitz'
+
+                except:
+                    stf_position = finders['miyao'](image, image_dpi)
+                    winner = 'miyao'
+            stage.record(finder=winner, staves=len(stf_position))
+
+        if self.verbose:
+            print winner.upper()
+
+        if self._staff_finder_wins_path is not None and collection is not None:
+            # also picks up the pages won in other processes
+            self._staff_finder_wins = _update_staff_finder_wins(self._staff_finder_wins_path, collection, winner)
+        else:
+            wins = self._staff_finder_wins.setdefault(collection, {'dalitz': 0, 'miyao': 0})
+            wins[winner] += 1
+
+        # glue the output of the stafffinding algorithms if they retrieve broken staff
+        with self.stage('glue', staves=len(stf_position)) as stage:
+            stf_position = self.stafffinding_glue(stf_position)
+            stage.record(glued_staves=len(stf_position))
+
+        return stf_position
 
-        # use PIL to get image resolution in the x dimension
+    def _usual_staff_finder_winner(self, collection, min_pages=5, min_ratio=0.9):
+        '''
+        Returns the staff finder that won on at least min_ratio of the pages
+        of the collection seen so far, or None. With a win counts file, the pages
+        seen by earlier runs and by other processes sharing the file count too.
+        '''
+
+        wins = self._staff_finder_wins.get(collection)
+        if wins is None or sum(wins.values()) < min_pages:
+            return None
+
+        for finder, n in wins.items():
+            if n >= min_ratio * sum(wins.values()):
+                return finder
+
+    def _race_staff_line_position(self, image, image_dpi, system):
+        '''
+        Run the Dalitz and Miyao staff finders concurrently, each in a forked
+        process. The Dalitz result is taken as soon as it is known to match the
+        staff group hint, otherwise the Miyao result.
+
+        Returns the winning staff finder and its staff positions.
+        '''
+
+        queue = multiprocessing.Queue()
+        processes = {}
+        for name, finder in self._staff_finders().items():
+            p = multiprocessing.Process(target=_run_staff_finder, args=(name, finder, image, image_dpi, queue))
+            p.daemon = True
+            p.start()
+            processes[name] = p
+
+        # {finder: (stf_position, error)}
+        results = {}
+        try:
+            while 'miyao' not in results or 'dalitz' not in results:
+                try:
+                    name, stf_position, error = queue.get(True, 0.1)
+                    results[name] = (stf_position, error)
+                except Queue.Empty:
+                    # a staff finder crashed without reporting back
+                    for name, p in processes.items():
+                        if name not in results and not p.is_alive() and queue.empty():
+                            results[name] = (None, 'the %s staff finder exited with code %s' % (name, p.exitcode))
+
+                dalitz = results.get('dalitz')
+                if dalitz is not None and dalitz[1] is None and len(dalitz[0]) == len(system):
+                    return 'dalitz', dalitz[0]
+        finally:
+            for p in processes.values():
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+
+        stf_position, error = results['miyao']
+        if error is not None:
+            raise RuntimeError(error)
+
+        return 'miyao', stf_position
+
+    def extract_features(self, input_file, sg_hint, noborderremove=False, norotation=False):
+        '''
+        Run the stages of the barline finder that do not depend on the
+        candidate filtering thresholds: preprocessing, staff finding, staffline
+        removal and connected component analysis.
+
+        Returns a PageFeatures object that can be refined with different
+        thresholds without reprocessing the image.
+
+        PARAMETERS
+        ----------
+        sg_hint: staff group hint inputted manually by the user, as a string or compiled with staffgroups.compile_hint
+        noborderremove: flag to specify whether the automatic border removal algorithm should be used
+        norotation: flag to specify whether the automatic rotation algorithm should be used
+        '''
+
+        if self._tracer is not None:
+            self._tracer.page = input_file
+
+        # system number of each staff, from the staff group hint
+        # (parsed once per hint and shared with the MEI converter)
+        sg_hint = compile_hint(sg_hint)
+        system = list(sg_hint.staff_systems)
+
+        if self.verbose:
+            print "SG HINT:{0}".format(sg_hint.hint) #GVM
+
+        # read the image resolution in the x dimension from the image header
         # because it is more reliable than gamera
-        pil_image = PIL.Image.open(input_file)
-        image_dpi = pil_image.info['dpi'][0]
+        image_info = imageloader.read_image_info(input_file)
+        image_dpi = image_info.dpi
         if image_dpi == 0:
             # set a default image dpi of 72
             if self.verbose:
@@ -549,91 +1120,324 @@ class BarlineFinder:
         if self.verbose:
             print 'DPI:{0}'.format(image_dpi)
 
-        # parse the staff group hint into a list of staffGrps---one for each system
-        # [staffGrps, ...]
-        system_staff_groups = self._parse_staff_hint(sg_hint)
-
-        barfinder_sg_hint = ", ".join([str(len(sg.getDescendantsByName('staffDef'))) for sg in system_staff_groups])
-        system = self._system_structure_parser(barfinder_sg_hint)
+        # the features record the image they were extracted from
+        if self._cache is not None:
+            image_hash = self._cache.file_hash(input_file)
+        else:
+            image_hash = file_hash(input_file)
+
+        # find the deepest stage whose output is already cached and resume from there
+        deepest = -1
+        if self._cache is not None:
+            keys = self._cache.stage_keys(image_hash, [
+                ('preprocess', (bool(noborderremove), bool(norotation))),
+                ('staff_find', (len(system), self._pyramid)),
+                ('staffline_removal', (self._roi_margin if self._roi else False,)),
+                ('mfr_filter', ('run_index',) if self._run_index else ()),
+                ('ccs', ()),
+            ])
+            stage_keys = dict(zip(PIPELINE_STAGES, keys))
+            # values of the cached stages, in stage order
+            deepest, cached = self._cache.load(keys)
+            if self.verbose and deepest >= 0:
+                print 'CACHE: resuming after stage {0}'.format(PIPELINE_STAGES[deepest])
+
+        # the preprocessed image is only needed if a later stage has to be computed
+        need_image = deepest < PIPELINE_STAGES.index('staffline_removal') or self._interfiles
+        if deepest >= PIPELINE_STAGES.index('preprocess'):
+            preprocess = cached[PIPELINE_STAGES.index('preprocess')]
+            image_width = preprocess['image_width']
+            image_height = preprocess['image_height']
+            image = self._cache.get_image(stage_keys['preprocess'], 'image') if need_image else None
+        else:
+            image = self._preprocess(input_file, image_info, noborderremove, norotation)
+            image_width = image.width
+            image_height = image.height
+            if self._cache is not None:
+                self._cache.put(stage_keys['preprocess'], {'image_width': image_width, 'image_height': image_height}, {'image': image})
 
-        if self.verbose:
-            print "SG HINT:{0}".format(sg_hint) #GVM
+        # save the image that barline candidates are calculated from
+        # the MEI will reference this file
+        image_path = os.path.splitext(input_file.split('/')[-1])[0] + '_preprocessed.tiff'
+        if self._interfiles:
+            image.save_tiff(image_path)
 
         # Returns the vertices for each staff and its number
-        try:
-            stf_position = self._staff_line_position_dalitz(image, image_dpi)
-            if len(stf_position) != len(system):
-                raise StaffGroupMismatch('Number of recognized staves is different to the one entered by the user')
-            if self.verbose:
-                print 'DALITZ'
-
-        except:
-            if self.verbose:
-                print 'MIYAO'
-            stf_position = self._staff_line_position_miyao(image, image_dpi)
-
-        # glue the output of the stafffinding algorithms if they retrieve broken staff
-        stf_position = self.stafffinding_glue(stf_position)
+        if deepest >= PIPELINE_STAGES.index('staff_find'):
+            stf_position = cached[PIPELINE_STAGES.index('staff_find')]['stf_position']
+        else:
+            stf_position = self._find_staves(image, image_dpi, system, os.path.dirname(os.path.abspath(input_file)))
+            if self._cache is not None:
+                self._cache.put(stage_keys['staff_find'], {'stf_position': stf_position})
 
         # Appends the proper system number according to the user input
         for i, s in enumerate(stf_position):
             stf_position[i].append(system[i])
 
-        staff_bb = []
-        # Saving staff bounding boxes
-        for st in stf_position:
-            staff_bb.append([st[0], st[1], st[2], st[3], st[4]])
-        # print stf_position, '\n' #GVM
-        # print staff_bb, '\n' #GVM
         # Staff-line removal
-        mfr = image.most_frequent_run('black', 'vertical')
-        # despeckle value equation for mfr: [1,10], [2,50], [3,100]
-        despeckle_value = int(45 * mfr - 36.67)
+        # the page is processed as tiles [(x, y, image)] of page coordinates x, y:
+        # either the whole page or the regions around the systems
+        if deepest >= PIPELINE_STAGES.index('staffline_removal'):
+            staffline_removal = cached[PIPELINE_STAGES.index('staffline_removal')]
+            mfr = staffline_removal['mfr']
+            despeckle_value = staffline_removal['despeckle_value']
+            tile_origins = staffline_removal['tile_origins']
+            if deepest < PIPELINE_STAGES.index('mfr_filter'):
+                no_staff_tiles = [(x, y, self._cache.get_image(stage_keys['staffline_removal'], 'no_staff_image_%d' % i))
+                                  for i, (x, y) in enumerate(tile_origins)]
+        else:
+            with self.stage('mfr', width=image.ncols, height=image.nrows):
+                mfr = image.most_frequent_run('black', 'vertical')
+            # despeckle value equation for mfr: [1,10], [2,50], [3,100]
+            despeckle_value = int(45 * mfr - 36.67)
+            if self._roi:
+                from gamera.core import SubImage, Point
+                # margins, titles and lyrics outside of the systems are never processed
+                tiles = [(x1, y1, SubImage(image, Point(x1, y1), Point(x2, y2)))
+                         for x1, y1, x2, y2 in self._system_regions(stf_position, image.ncols, image.nrows)]
+            else:
+                tiles = [(0, 0, image)]
+            tile_origins = [(x, y) for x, y, _ in tiles]
+
+            no_staff_tiles = []
+            for i, (x, y, tile) in enumerate(tiles):
+                with self.stage('staffline_removal', tile=i, width=tile.ncols, height=tile.nrows):
+                    no_staff_image = self._staffline_removal(tile)
+                with self.stage('despeckle', tile=i, despeckle_value=despeckle_value):
+                    self._despeckle(no_staff_image, despeckle_value)
+                no_staff_tiles.append((x, y, no_staff_image))
+            if self._interfiles:
+                self._save_tiles(no_staff_tiles, input_file, '_no_stafflines')
+            if self._cache is not None:
+                self._cache.put(stage_keys['staffline_removal'],
+                                {'mfr': mfr, 'despeckle_value': despeckle_value, 'tile_origins': tile_origins},
+                                dict(('no_staff_image_%d' % i, t) for i, (_, _, t) in enumerate(no_staff_tiles)))
         if self.verbose:
             print 'MFR:{0}, DV:{1}'.format(mfr, despeckle_value)
-        no_staff_image = self._staffline_removal(image)
-        self._despeckle(no_staff_image, despeckle_value)
-        if self._interfiles:
-            no_staff_image.save_tiff(os.path.splitext(input_file.split('/')[-1])[0] + '_no_stafflines.tiff')
+
+        if self._low_memory:
+            # the preprocessed page has been saved if needed and is not used anymore
+            image = tiles = None
 
         # Filters short-runs
-        filtered_image = self._most_frequent_run_filter(no_staff_image, mfr, despeckle_value)    # most_frequent_run
-        if self._interfiles:
-            filtered_image.save_tiff(os.path.splitext(input_file.split('/')[-1])[0] + '_no_mfr.tiff')
+        # run indices of the filtered tiles [(x, y, VerticalRunIndex)], if used
+        run_tiles = None
+        if deepest >= PIPELINE_STAGES.index('mfr_filter'):
+            if deepest < PIPELINE_STAGES.index('ccs') or self._interfiles:
+                filtered_tiles = [(x, y, self._cache.get_image(stage_keys['mfr_filter'], 'filtered_image_%d' % i))
+                                  for i, (x, y) in enumerate(tile_origins)]
+        else:
+            with self.stage('mfr_filter', tiles=len(no_staff_tiles), mfr=mfr) as stage:
+                if self._run_index:
+                    run_tiles = [(x, y, self._run_index_filter(t, mfr, despeckle_value)) for x, y, t in no_staff_tiles]
+                    stage.record(runs=sum(len(runs) for _, _, runs in run_tiles))
+                    # the filtered images are only rendered to be saved
+                    if self._interfiles or self._cache is not None:
+                        filtered_tiles = [(x, y, runs.to_image()) for x, y, runs in run_tiles]
+                    else:
+                        filtered_tiles = None
+                else:
+                    # the images without stafflines are not used after filtering
+                    filtered_tiles = [(x, y, self._most_frequent_run_filter(t, mfr, despeckle_value, self._low_memory))
+                                      for x, y, t in no_staff_tiles]    # most_frequent_run
+            if self._interfiles:
+                self._save_tiles(filtered_tiles, input_file, '_no_mfr')
+            if self._cache is not None:
+                self._cache.put(stage_keys['mfr_filter'], {}, dict(('filtered_image_%d' % i, t) for i, (_, _, t) in enumerate(filtered_tiles)))
+
+        if self._low_memory:
+            no_staff_tiles = None
 
         # cc's and highlighs no staff and short runs filtered image and writes txt file with candidate bars
-        ccs_bars = self._ccs(filtered_image)
+        if deepest >= PIPELINE_STAGES.index('ccs'):
+            ccs = cached[PIPELINE_STAGES.index('ccs')]['ccs']
+        else:
+            with self.stage('ccs', tiles=len(tile_origins)) as stage:
+                ccs = []
+                if run_tiles is not None:
+                    for x, y, runs in run_tiles:
+                        # the runs are in tile coordinates
+                        ccs.extend([(cx + x, cy + y, ncols, nrows) for cx, cy, ncols, nrows in runs.component_bboxes()])
+                else:
+                    for x, y, filtered_image in filtered_tiles:
+                        # translate the tile coordinates to page coordinates
+                        dx, dy = x - filtered_image.offset_x, y - filtered_image.offset_y
+                        ccs.extend([(c.offset_x + dx, c.offset_y + dy, c.ncols, c.nrows) for c in self._ccs(filtered_image)])
+                stage.record(ccs=len(ccs))
+            if self._cache is not None:
+                self._cache.put(stage_keys['ccs'], {'ccs': ccs})
+
+        if self._low_memory and not self._interfiles:
+            filtered_tiles = run_tiles = None
+
+        # print ccs
+        ccs = bbox_array(ccs)
+        if self._interfiles:
+            ccs_mfr = ccs[ccs['aspect'] <= 0.05]
+            # highlight and save one tile at a time
+            ccs_mfr_tiles = ((x, y, self._highlight(filtered_image, self._tile_bboxes(ccs_mfr, x, y, filtered_image)))
+                             for x, y, filtered_image in filtered_tiles)
+            self._save_tiles(ccs_mfr_tiles, input_file, '_ccs_mfr', len(filtered_tiles))
 
+        return PageFeatures(stf_position, system, ccs, image_path, image_width, image_height, image_dpi,
+                            params=self.extract_params(sg_hint, noborderremove, norotation), image_hash=image_hash)
 
-        # print ccs_bars
-        image_ccs_mfr = self._highlight(filtered_image, [[c] for c in ccs_bars if c.aspect_ratio()[0] <= 0.05])
-        if self._interfiles:
-            image_ccs_mfr.save_tiff(os.path.splitext(input_file.split('/')[-1])[0] + '_ccs_mfr.tiff')
+    def refine(self, features, ar_thresh=None, v_thresh=None):
+        '''
+        Filter the connected components of a page into barlines and assign
+        them to staves. This is the only stage that depends on the thresholds,
+        so it can be rerun cheaply on the same features.
 
-        checked_bars = self._bar_candidate_check(ccs_bars, stf_position, system, image_dpi)
+        Returns the staff bounding boxes and the numbered bars.
+
+        PARAMETERS
+        ----------
+        features (PageFeatures): output of extract_features
+        ar_thresh (Float): threshold parameter for aspect ratio of bar candidates,
+                           defaults to the one of the barline finder
+        v_thresh (Float): threshold parameter for the percentage of the staff height for bar candidates
+                          to be within the system bounding box (y dimension),
+                          defaults to the one of the barline finder
+        '''
+
+        if ar_thresh is None:
+            ar_thresh = self._ar_thresh
+        if v_thresh is None:
+            v_thresh = self._v_thresh
+
+        # the candidate check appends to and modifies the staff positions
+        stf_position = [list(st) for st in features.stf_position]
+
+        staff_bb = []
+        # Saving staff bounding boxes
+        for st in stf_position:
+            staff_bb.append([st[0], st[1], st[2], st[3], st[4]])
+        # print stf_position, '\n' #GVM
+        # print staff_bb, '\n' #GVM
+
+        with self.stage('candidate_check', candidates=len(features.ccs)) as stage:
+            checked_bars = self._bar_candidate_check(features.ccs, stf_position, features.system, features.image_dpi, ar_thresh, v_thresh)
+            stage.record(bars=len(checked_bars))
 
-        RGB_image = self._highlight(image, checked_bars)
-        output_path = os.path.splitext(input_file.split('/')[-1])[0] + '_candidates.tiff'
         if self._interfiles:
+            from gamera.core import load_image
+            image = load_image(features.image_path)
+            RGB_image = self._highlight(image, checked_bars)
+            output_path = features.image_path.rsplit('_preprocessed', 1)[0] + '_candidates.tiff'
             RGB_image.save_tiff(output_path) #GVM
+            image = RGB_image = None
 
-        bar_list = []
-        for c in checked_bars:
-            bar_list.append([c[1], c[0].offset_x, c[0].offset_y, c[0].offset_x+c[0].ncols-1, c[0].offset_y+c[0].nrows-1])
+        with self.stage('number_assign', bars=len(checked_bars), staves=len(staff_bb)) as stage:
+            bar_list = np.column_stack((checked_bars['system'], checked_bars['x'], checked_bars['y'],
+                                        checked_bars['x']+checked_bars['w']-1, checked_bars['y']+checked_bars['h']-1)).tolist()
 
-        sorted_bars = self._bar_sorting(bar_list)
-        # for sb in sorted_bars: print sb
+            sorted_bars = self._bar_sorting(bar_list)
+            # for sb in sorted_bars: print sb
+
+            numbered_bars = self._staff_number_assign(sorted_bars, staff_bb)
+            stage.record(numbered_bars=len(numbered_bars))
 
-        numbered_bars = self._staff_number_assign(sorted_bars, staff_bb)
-        
         # for nb in numbered_bars: print 'NUMBERED BARS:{0}'.format(nb)
-        return staff_bb, numbered_bars, image_path, image_width, image_height, image_dpi
+        return staff_bb, numbered_bars
+
+    def process_file(self, input_file, sg_hint, noborderremove=False, norotation=False):
+        '''
+        Find measures in the given input file.
+
+        PARAMETERS
+        ----------
+        sg_hint: staff group hint inputted manually by the user, as a string or compiled with staffgroups.compile_hint
+        noborderremove: flag to specify whether the automatic border removal algorithm should be used
+        norotation: flag to specify whether the automatic rotation algorithm should be used
+        '''
+
+        # measure the peak memory of this page only
+        reset_peak_rss()
+
+        with self.stage('page') as stage:
+            features = self.extract_features(input_file, sg_hint, noborderremove, norotation)
+            staff_bb, numbered_bars = self.refine(features)
+
+            self.peak_rss = peak_rss()
+            stage.record(peak_rss=self.peak_rss)
+
+        if self.verbose:
+            print 'PEAK RSS: {0:.1f} MB'.format(self.peak_rss / 1024.0**2)
+
+        return staff_bb, numbered_bars, features.image_path, features.image_width, features.image_height, features.image_dpi
+
+    def process_files(self, jobs, workers=None):
+        '''
+        Find measures in many input files using a pool of worker processes.
+        Each worker initializes gamera once, reuses a barline finder with the
+        parameters of this one and writes the MEI output of its jobs itself.
+
+        Yields (job, result, error) in order of completion, where result is the
+        return value of process_file and error is None, or result is None and
+        error is the formatted traceback of the failed job.
+
+        PARAMETERS
+        ----------
+        jobs: iterable of (input_file, sg_hint, output_file[, noborderremove[, norotation]]),
+              no MEI is written when output_file is None
+        workers: number of worker processes, defaults to the number of cores
+        '''
+
+        params = dict(self._params)
+        # pool workers cannot fork the staff finder race, and every core is busy anyway
+        params['race_staff_finders'] = False
+
+        pool = multiprocessing.Pool(workers, _init_worker, (params,))
+        try:
+            for job, result, error in pool.imap_unordered(_run_job, jobs):
+                if self.verbose:
+                    print '%s: %s' % (job[0], 'failed' if error else 'done')
+                yield job, result, error
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def process_book(self, jobs, book_file, workers=None):
+        '''
+        Find measures in the pages of a book using a pool of worker processes
+        (see process_files) and write all the pages to a single MEI document,
+        in the order of the jobs, straight from the results of the pages:
+        no MEI is written for each page. Failed pages are left out of the book.
+
+        Yields (job, result, error) in order of completion, as process_files,
+        and writes the book once every page is done.
+
+        PARAMETERS
+        ----------
+        jobs: iterable of (input_file, sg_hint[, output_file[, noborderremove[, norotation]]]),
+              output_file is ignored
+        book_file: output path of the MEI document of the book
+        workers: number of worker processes, defaults to the number of cores
+        '''
+
+        from meicreate import BookConverter
+
+        jobs = [(job[0], job[1], None) + tuple(job[3:]) for job in jobs]
+        results = {}
+        for job, result, error in self.process_files(jobs, workers):
+            if error is None:
+                results[job] = result
+            yield job, result, error
+
+        pages = [(job[1], results[job]) for job in jobs if job in results]
+        if pages:
+            with self.stage('book_write', pages=len(pages)):
+                BookConverter(pages, self.verbose, self._mei_ids).write_mei(book_file)
 
 if __name__ == "__main__":
+    # parse command line arguments before loading gamera
+    args = parser.parse_args()
+
     init_gamera()
 
-    # parse command line arguments
-    args = parser.parse_args()
     input_file = args.filein
     
     if not os.path.exists(input_file):
@@ -645,14 +1449,21 @@ if __name__ == "__main__":
     noborderremove = args.noborderremove
     norotation = args.norotation
     interfiles = args.interfiles
+    cache_dir = args.cachedir
+    race_staff_finders = args.racefinders
+    pyramid = args.pyramid
+    roi = args.systemregions
+    tracer = Tracer([JSONLinesExporter(args.trace)]) if args.trace else None
+    low_memory = args.lowmemory
+    run_index = args.runindex
+    stream_mei = args.streammei
+    sidecar = args.sidecar
+    mei_ids = args.meiids
 
     # internal parameters for filtering barline candidates
     ar_thresh = 0.138
     v_thresh = 0.550
 
-    bar_finder = BarlineFinder(ar_thresh, v_thresh, interfiles, verbose)
-    staff_bb, bar_bb, image_path, image_width, image_height, image_dpi = bar_finder.process_file(input_file, sg_hint, noborderremove, norotation)
-    # print '\nSTAFF_BB:{0}\n\nBAR_BB:{1}'.format(staff_bb, bar_bb)
-    bar_converter = BarlineDataConverter(staff_bb, bar_bb, verbose)
-    bar_converter.bardata_to_mei(sg_hint, image_path, image_width, image_height, image_dpi)
-    bar_converter.output_mei(output_file)
+    bar_finder = BarlineFinder(ar_thresh, v_thresh, interfiles, verbose, cache_dir, race_staff_finders, pyramid, roi, tracer=tracer, low_memory=low_memory, run_index=run_index, stream_mei=stream_mei, sidecar=sidecar, mei_ids=mei_ids)
+    result = bar_finder.process_file(input_file, sg_hint, noborderremove, norotation)
+    _write_outputs(bar_finder, result, sg_hint, output_file)
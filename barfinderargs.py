@@ -0,0 +1,36 @@
+"""
+Command line arguments of barfinder.py, shared with the client of the
+barfinder daemon so that it accepts the same arguments without importing gamera.
+"""
+
+import argparse
+import os
+
+# default path of the socket of the barfinder daemon
+DEFAULT_SOCKET = '/tmp/barfinder-%d.sock' % os.getuid()
+
+def create_parser(description='Perform barline detection on an image and output the MEI.'):
+    '''
+    Create the argument parser of barfinder.py
+    '''
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-g', '--staffgroups', help='staffgroups')
+    parser.add_argument('filein', help='input file (.tiff)')
+    parser.add_argument('fileout', help='output file (.mei)')
+    parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
+    parser.add_argument('-i', '--interfiles', help='generate intermediary output files', action='store_true')
+    parser.add_argument('-nb', '--noborderremove', help='do not remove borders automatically', action='store_true')
+    parser.add_argument('-nr', '--norotation', help='do not automatically rotate', action='store_true')
+    parser.add_argument('-rf', '--racefinders', help='run the staff finders concurrently', action='store_true')
+    parser.add_argument('-p', '--pyramid', help='find staves on a downsampled image and refine them at full resolution', action='store_true')
+    parser.add_argument('-roi', '--systemregions', help='only process the regions around the systems after staff finding', action='store_true')
+    parser.add_argument('-c', '--cachedir', help='directory of the on-disk cache of intermediate stage outputs')
+    parser.add_argument('-lm', '--lowmemory', help='release page buffers as early as possible and filter in place', action='store_true')
+    parser.add_argument('-rx', '--runindex', help='filter short runs and find connected components on a vertical run-length index', action='store_true')
+    parser.add_argument('-sm', '--streammei', help='write the MEI incrementally instead of building a pymei document', action='store_true')
+    parser.add_argument('-sc', '--sidecar', help='also write the staves and bars next to the MEI in a compact format', choices=('bfr', 'npz'))
+    parser.add_argument('-id', '--meiids', help='ids of the MEI elements: random or deterministic, counted per page', choices=('uuid', 'counter'), default='uuid')
+    parser.add_argument('-t', '--trace', help='append the timings of each stage to this file as JSON lines')
+
+    return parser
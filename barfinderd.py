@@ -0,0 +1,185 @@
+"""
+Barline finder daemon.
+
+Keeps a pool of worker processes that have imported the gamera toolkits and
+initialized gamera once, and serves barline finding jobs sent by barclient.py
+over a local UNIX socket, so that a page costs only its own processing time.
+
+Each request and each reply is a single line of JSON. A request holds the
+arguments of barfinder.py (see barfinderargs.py) and the working directory of
+the client, a reply holds the error of the job, if any, and the number of
+staves and bars found. The job runs in the working directory of the client, so
+that the intermediary files are written where barfinder.py would write them.
+
+usage:
+python barfinderd.py -w 4 -s /tmp/barfinder.sock
+python barclient.py -s /tmp/barfinder.sock -g 'staffgrouphint' image_path mei_path
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from barfinder import BarlineFinder, _process_job, init_gamera
+from tracing import Tracer, JSONLinesExporter
+from barfinderargs import DEFAULT_SOCKET
+
+# internal parameters for filtering barline candidates, as in barfinder.py
+AR_THRESH = 0.138
+V_THRESH = 0.550
+
+# set up command line argument structure
+parser = argparse.ArgumentParser(description='Serve barline detection jobs from a pool of initialized workers.')
+parser.add_argument('-s', '--socket', help='path of the UNIX socket to listen on', default=DEFAULT_SOCKET)
+parser.add_argument('-w', '--workers', help='number of worker processes (default: number of cores)', type=int)
+parser.add_argument('-v', '--verbose', help='log the jobs served', action='store_true')
+
+# BarlineFinder parameter of each request option, and its default
+FINDER_OPTIONS = {
+    'interfiles': ('interfiles', False),
+    'verbose': ('verbose', False),
+    'cachedir': ('cache_dir', None),
+    'pyramid': ('pyramid', False),
+    'systemregions': ('roi', False),
+    'lowmemory': ('low_memory', False),
+    'runindex': ('run_index', False),
+    'streammei': ('stream_mei', False),
+    'sidecar': ('sidecar', None),
+    'meiids': ('mei_ids', 'uuid')
+}
+
+# barline finders of a worker process, by parameters
+_worker_finders = {}
+
+def _init_worker():
+    # the daemon process handles the signals and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_gamera()
+
+def _serve_job(request):
+    '''
+    Process the job of a request in a worker process.
+    Barline finders are reused for requests with the same options.
+    '''
+
+    finder_params = dict((param, request.get(option, default))
+                         for option, (param, default) in FINDER_OPTIONS.items())
+    trace = request.get('trace')
+    params = (tuple(sorted(finder_params.items())), trace)
+    if params not in _worker_finders:
+        tracer = Tracer([JSONLinesExporter(trace)]) if trace else None
+        # pool workers cannot fork the staff finder race
+        _worker_finders[params] = BarlineFinder(AR_THRESH, V_THRESH, race_staff_finders=False, tracer=tracer, **finder_params)
+
+    job = (request['filein'], request['staffgroups'], request['fileout'],
+           request['noborderremove'], request['norotation'])
+    # a worker runs one job at a time, in the working directory of its client
+    cwd = os.getcwd()
+    os.chdir(request.get('cwd', cwd))
+    try:
+        job, result, error = _process_job(_worker_finders[params], job)
+    finally:
+        os.chdir(cwd)
+
+    if error is not None:
+        return {'error': error}
+
+    staff_bb, bar_bb = result[:2]
+    return {'error': None, 'staves': len(staff_bb), 'bars': len(bar_bb)}
+
+class BarlineFinderDaemon:
+    '''
+    Accepts jobs on a UNIX socket and runs them on a pool of warm workers
+    '''
+
+    def __init__(self, socket_path, workers=None, verbose=False):
+        '''
+        PARAMETERS
+        ----------
+        socket_path {String}: path of the UNIX socket to listen on
+        workers {int}: number of worker processes, defaults to the number of cores
+        verbose {bool}: log the jobs served
+        '''
+
+        self._socket_path = socket_path
+        self._workers = workers
+        self.verbose = verbose
+
+    def serve_forever(self):
+        # load gamera, its toolkits and the mei output before the workers
+        # are forked so that they start warm
+        init_gamera()
+        import meicreate
+
+        pool = multiprocessing.Pool(self._workers, _init_worker)
+
+        # remove the socket left behind by a previous daemon
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen(64)
+
+        if self.verbose:
+            print 'listening on %s' % self._socket_path
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                # one thread per connection, the jobs themselves run in the pool
+                thread = threading.Thread(target=self._handle, args=(pool, conn))
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            os.unlink(self._socket_path)
+            pool.terminate()
+            pool.join()
+
+    def _handle(self, pool, conn):
+        '''
+        Serve the request of a client connection
+        '''
+
+        f = conn.makefile('rwb')
+        try:
+            try:
+                request = json.loads(f.readline())
+            except ValueError:
+                reply = {'error': 'malformed request'}
+            else:
+                try:
+                    # a request missing a field, a job that cannot be
+                    # pickled or a dead worker fail the request only
+                    reply = pool.apply(_serve_job, (request,))
+                except Exception:
+                    reply = {'error': traceback.format_exc()}
+                if self.verbose:
+                    filein = request.get('filein') if isinstance(request, dict) else None
+                    print '%s: %s' % (filein, 'failed' if reply['error'] else 'done')
+            f.write(json.dumps(reply) + '\n')
+            f.flush()
+        except socket.error:
+            # the client went away
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # exit cleanly, removing the socket, when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    daemon = BarlineFinderDaemon(args.socket, args.workers, args.verbose)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
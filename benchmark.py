@@ -0,0 +1,148 @@
+"""
+Per-stage benchmark of the barline finder on synthetic pages.
+
+Renders synthetic pages (see synthscore.py) for every combination of page
+size, density and resolution, runs the barline finder and the MEI output on
+each page with a tracer and reports the pages per second and the median time
+of each stage. Runs offline; needs gamera and pymei.
+
+usage:
+python benchmark.py
+python benchmark.py -n 5 --sizes letter a3 --densities sparse dense --dpi 300 600 --json results.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import synthscore
+from barfinder import BarlineFinder, _process_job, init_gamera
+from tracing import Tracer, JSONLinesExporter, STAGES
+
+# (measures per system, notes per measure and staff)
+DENSITIES = {
+    'sparse': (3, 2),
+    'medium': (5, 6),
+    'dense': (8, 12),
+}
+
+# set up command line argument structure
+parser = argparse.ArgumentParser(description='Benchmark the stages of the barline finder on synthetic pages.')
+parser.add_argument('-n', '--pages', help='pages per configuration', type=int, default=3)
+parser.add_argument('--sizes', help='page sizes', nargs='+', choices=sorted(synthscore.PAGE_SIZES), default=['letter'])
+parser.add_argument('--densities', help='page densities', nargs='+', choices=sorted(DENSITIES), default=['sparse', 'dense'])
+parser.add_argument('--dpi', help='page resolutions', nargs='+', type=int, default=[300])
+parser.add_argument('-s', '--staves', help='staves per system', type=int, default=4)
+parser.add_argument('--noise', help='fraction of flipped pixels', type=float, default=0.0005)
+parser.add_argument('--skew', help='skew of the pages in degrees', type=float, default=0.0)
+parser.add_argument('-nb', '--noborderremove', help='do not remove borders automatically', action='store_true')
+parser.add_argument('-nr', '--norotation', help='do not automatically rotate', action='store_true')
+parser.add_argument('-lm', '--lowmemory', help='run the barline finder in low-memory mode', action='store_true')
+parser.add_argument('-rx', '--runindex', help='filter and find connected components on a vertical run-length index', action='store_true')
+parser.add_argument('-sm', '--streammei', help='write the MEI incrementally instead of building a pymei document', action='store_true')
+parser.add_argument('-o', '--workdir', help='directory of the rendered pages (default: a temporary directory, removed afterwards)')
+parser.add_argument('-t', '--trace', help='append the stage records to this file as JSON lines')
+parser.add_argument('--json', help='write the summary to this file')
+
+def benchmark_configuration(bar_finder, records, pages, workdir, noborderremove, norotation):
+    '''
+    Run the barline finder and the MEI output on the given pages.
+    Returns the summary of the configuration.
+
+    PARAMETERS
+    ----------
+    bar_finder {BarlineFinder}: barline finder whose tracer appends to records
+    records {list}: stage records of the tracer
+    pages {iterable}: [(name, SyntheticPage), ...], rendered one at a time
+                      so that the pages do not add up in the peak memory
+    workdir {String}: directory to write the pages and outputs to
+    '''
+
+    # {stage: [seconds per page, ...]}
+    stage_times = dict((stage, []) for stage in STAGES)
+    page_times = []
+    peak_rss = []
+    failed = 0
+    num_pages = 0
+    for name, page in pages:
+        num_pages += 1
+        directory = os.path.join(workdir, name)
+        image_path = synthscore.write_page(page, directory, name)
+        output_path = os.path.join(directory, name + '_ao.mei')
+
+        del records[:]
+        start = time.time()
+        job, result, error = _process_job(bar_finder, (image_path, page.sg_hint, output_path, noborderremove, norotation))
+        page_times.append(time.time() - start)
+        if error is not None:
+            failed += 1
+            print error
+            continue
+
+        # stages that run once per tile are summed per page
+        page_stage_times = {}
+        for record in records:
+            if record['stage'] == 'page':
+                peak_rss.append(record['peak_rss'])
+                continue
+            page_stage_times[record['stage']] = page_stage_times.get(record['stage'], 0.0) + record['wall']
+        for stage, seconds in page_stage_times.items():
+            stage_times.setdefault(stage, []).append(seconds)
+
+    return {
+        'pages': num_pages,
+        'failed': failed,
+        'pages_per_sec': num_pages / sum(page_times) if page_times else 0.0,
+        'median_page': float(np.median(page_times)) if page_times else 0.0,
+        'median_peak_rss_mb': float(np.median(peak_rss)) / 1024**2 if peak_rss else 0.0,
+        'median_stages': dict((stage, float(np.median(times))) for stage, times in stage_times.items() if times)
+    }
+
+def print_summary(configuration, summary):
+    print '\n%s: %d pages, %d failed, %.2f pages/sec, median %.3fs and %.0f MB peak RSS per page' % (
+        configuration, summary['pages'], summary['failed'], summary['pages_per_sec'], summary['median_page'],
+        summary['median_peak_rss_mb'])
+    for stage in STAGES:
+        if stage in summary['median_stages']:
+            print '    %-18s %8.4fs' % (stage, summary['median_stages'][stage])
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    init_gamera()
+
+    records = []
+    callbacks = [records.append]
+    if args.trace:
+        callbacks.append(JSONLinesExporter(args.trace))
+    bar_finder = BarlineFinder(0.138, 0.550, tracer=Tracer(callbacks), low_memory=args.lowmemory, run_index=args.runindex,
+                               stream_mei=args.streammei)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='barfinder_benchmark')
+    summaries = {}
+    try:
+        for size in args.sizes:
+            for density in args.densities:
+                for dpi in args.dpi:
+                    configuration = '%s/%s/%ddpi' % (size, density, dpi)
+                    measures, notes = DENSITIES[density]
+                    # the same seeds for every configuration
+                    pages = (('%s_%s_%d_%04d' % (size, density, dpi, i),
+                              synthscore.render_page(args.staves, True, synthscore.PAGE_SIZES[size], dpi,
+                                                     measures, notes, args.noise, args.skew, seed=i))
+                             for i in range(args.pages))
+                    summaries[configuration] = benchmark_configuration(bar_finder, records, pages, workdir,
+                                                                       args.noborderremove, args.norotation)
+                    print_summary(configuration, summaries[configuration])
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2, sort_keys=True)
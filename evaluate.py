@@ -33,15 +33,13 @@ python evaluate.py path/to/data -v
 """
 
 from __future__ import division
-from barlineFinder.barfinder import BarlineFinder
-from barlineFinder.meicreate import BarlineDataConverter
+from barlineFinder.imageloader import read_image_info
+from barlineFinder.manifest import file_hash
 from pymei import XmlImport, MeiDocument
-from gamera.core import *
 import os
 import logging
 import argparse
 import numpy as np
-from PIL import Image
 
 # set up command line argument structure
 parser = argparse.ArgumentParser(description='Perform experiment reporting performance of the measure finding algorithm.')
@@ -85,8 +83,6 @@ class EvaluateMeasureFinder(object):
         self.verbose = verbose
         self._interfiles = interfiles
 
-        init_gamera()
-
     def evaluate(self, ar_thresh, v_thresh, bb_padding_in=0.05, log=None):
         '''
         Evaluate the measure finding algorithm on the dataset using the metrics
@@ -119,6 +115,7 @@ class EvaluateMeasureFinder(object):
         >> filename.mei         (ground-truth mei file)
         >> filename_ao.mei      (algorithm MEI output)
         >> filename.txt         (staff group hint)
+        >> filename_features.pickle (threshold independent page features, generated)
         ...
         > dataroot/N
         >> filename.tiff        (music score image)
@@ -127,6 +124,9 @@ class EvaluateMeasureFinder(object):
         >> filename.txt         (staff group hint)
         '''
         num_errors = 0
+        # gamera is only loaded the first time a page needs the algorithm to be run,
+        # re-scoring existing output only needs pymei
+        gamera_loaded = False
         data_points = [d for d in os.listdir(self.datapath) if os.path.isdir(os.path.join(self.datapath, d))]
         for i, d in enumerate(data_points):
             data_point_path = os.path.join(self.datapath, d)
@@ -146,9 +146,8 @@ class EvaluateMeasureFinder(object):
                 # the algorithm has already been run with the given parameters
                 mei_path = mei_path[0]
 
-                # still need the image dpi (in the x plane)
-                image = Image.open(image_path)
-                image_dpi = image.info['dpi'][0]
+                # still need the image dpi (in the x plane), read from the image header
+                image_dpi = read_image_info(image_path).dpi
                 if image_dpi == 0:
                     # set a default image dpi of 72
                     logging.info('[WARNING] manually setting img resolution to 72')
@@ -161,12 +160,35 @@ class EvaluateMeasureFinder(object):
                 # get staff group hint
                 sg_hint = self._get_sg_hint(sg_hint_file_path)
 
+                if not gamera_loaded:
+                    from barlineFinder.barfinder import BarlineFinder, PageFeatures, init_gamera
+                    from barlineFinder.meicreate import BarlineDataConverter
+                    init_gamera()
+                    gamera_loaded = True
+
                 # run the measure finding algorithm and write the output to mei
                 try:
                     bar_finder = BarlineFinder(ar_thresh, v_thresh, self._interfiles, self.verbose)
+
+                    # the threshold independent stages only need to be run once per page
+                    # for the whole parameter sweep
+                    # and are extracted again if the image, the pipeline or its parameters have changed
+                    features_path = os.path.join(data_point_path, '%s_features.pickle' % filename)
                     noborderremove = True
                     norotation = False
-                    staff_bb, bar_bb, _, image_width, image_height, image_dpi = bar_finder.process_file(image_path, sg_hint, noborderremove, norotation)
+                    features = None
+                    if os.path.exists(features_path):
+                        features = PageFeatures.load(features_path)
+                        if features is not None and \
+                                not features.matches(bar_finder.extract_params(sg_hint, noborderremove, norotation),
+                                                     file_hash(image_path)):
+                            features = None
+                    if features is None:
+                        features = bar_finder.extract_features(image_path, sg_hint, noborderremove, norotation)
+                        features.save(features_path)
+
+                    staff_bb, bar_bb = bar_finder.refine(features, ar_thresh, v_thresh)
+                    image_width, image_height, image_dpi = features.image_width, features.image_height, features.image_dpi
 
                     bar_converter = BarlineDataConverter(staff_bb, bar_bb, self.verbose)
                     bar_converter.bardata_to_mei(sg_hint, image_path, image_width, image_height, image_dpi)
@@ -180,7 +202,7 @@ class EvaluateMeasureFinder(object):
             bb_padding_px = bb_padding_in * image_dpi
 
             p, r, f, num_gt_measures = self._evaluate_output(mei_path, gt_mei_path, bb_padding_px)
-            if verbose:
+            if self.verbose:
                 print '\tprecision: %.2f\n\trecall: %.2f\n\tf-measure: %.2f' % (p, r, f)
                 print '\tnumber of measures: %d' % num_gt_measures
             logging.info('\tprecision: %.2f\n\trecall: %.2f\n\tf-measure: %.2f' % (p, r, f))
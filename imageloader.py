@@ -0,0 +1,281 @@
+"""
+Image loading for the barline finder.
+
+The TIFF header is probed once for the size, bit depth and resolution of the
+image without decoding any pixels. Uncompressed TIFFs are then memory-mapped
+and converted straight into the gamera image the pipeline needs; any other
+image is decoded once by gamera.
+"""
+
+import struct
+
+import numpy as np
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+FILL_ORDER = 266
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+X_RESOLUTION = 282
+Y_RESOLUTION = 283
+PLANAR_CONFIG = 284
+RESOLUTION_UNIT = 296
+PREDICTOR = 317
+TILE_WIDTH = 322
+
+# TIFF field types: (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1),    # BYTE
+    2: ('c', 1),    # ASCII
+    3: ('H', 2),    # SHORT
+    4: ('I', 4),    # LONG
+    5: ('II', 8),   # RATIONAL
+    6: ('b', 1),    # SBYTE
+    7: ('B', 1),    # UNDEFINED
+    8: ('h', 2),    # SSHORT
+    9: ('i', 4),    # SLONG
+    10: ('ii', 8),  # SRATIONAL
+    11: ('f', 4),   # FLOAT
+    12: ('d', 8),   # DOUBLE
+}
+
+# photometric interpretations
+WHITE_IS_ZERO = 0
+BLACK_IS_ZERO = 1
+RGB = 2
+
+class ImageInfo:
+    '''
+    Header information of an image
+    '''
+
+    def __init__(self, width, height, dpi, bits_per_sample=None, samples_per_pixel=None, tags=None, byte_order=None):
+        '''
+        PARAMETERS
+        ----------
+        width {int}: number of columns
+        height {int}: number of rows
+        dpi {int}: resolution in the x dimension, 0 if unknown
+        bits_per_sample {int}: bit depth of each sample
+        samples_per_pixel {int}: 1 for bilevel and greyscale images, 3 for RGB
+        tags {dict}: raw TIFF tags {tag: [values]}, None for other formats
+        byte_order {String}: struct byte order of a TIFF file
+        '''
+
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.bits_per_sample = bits_per_sample
+        self.samples_per_pixel = samples_per_pixel
+        self.tags = tags
+        self.byte_order = byte_order
+
+def read_tiff_info(path):
+    '''
+    Read the header of a TIFF file without decoding its pixels.
+    Raises ValueError if the file is not a (classic) TIFF file.
+    '''
+
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        if header[:4] == b'II*\x00':
+            byte_order = '<'
+        elif header[:4] == b'MM\x00*':
+            byte_order = '>'
+        else:
+            raise ValueError('%s is not a TIFF file' % path)
+
+        ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+        f.seek(ifd_offset)
+        num_entries = struct.unpack(byte_order + 'H', f.read(2))[0]
+        entries = f.read(12 * num_entries)
+
+        tags = {}
+        for i in xrange(num_entries):
+            tag, field_type, count = struct.unpack(byte_order + 'HHI', entries[12*i:12*i+8])
+            if field_type not in FIELD_TYPES:
+                continue
+            fmt, size = FIELD_TYPES[field_type]
+            if size * count <= 4:
+                data = entries[12*i+8:12*i+8+size*count]
+            else:
+                offset = struct.unpack(byte_order + 'I', entries[12*i+8:12*i+12])[0]
+                f.seek(offset)
+                data = f.read(size * count)
+            values = struct.unpack(byte_order + fmt * count, data)
+            if field_type in (5, 10):
+                # rationals
+                values = [float(n) / d if d else 0.0 for n, d in zip(values[::2], values[1::2])]
+            tags[tag] = list(values)
+
+    # resolution in dots per inch, 0 if unknown
+    dpi = tags.get(X_RESOLUTION, [0])[0]
+    unit = tags.get(RESOLUTION_UNIT, [2])[0]
+    if unit == 3:
+        # dots per centimetre
+        dpi *= 2.54
+    elif unit != 2:
+        dpi = 0
+    dpi = int(round(dpi))
+
+    return ImageInfo(tags[IMAGE_WIDTH][0], tags[IMAGE_LENGTH][0], dpi,
+                     tags.get(BITS_PER_SAMPLE, [1])[0], tags.get(SAMPLES_PER_PIXEL, [1])[0],
+                     tags, byte_order)
+
+def read_image_info(path):
+    '''
+    Read the header of an image. TIFF files are probed directly,
+    other formats through PIL.
+    '''
+
+    try:
+        return read_tiff_info(path)
+    except ValueError:
+        import PIL.Image
+        pil_image = PIL.Image.open(path)
+        dpi = int(round(pil_image.info.get('dpi', (0, 0))[0]))
+        return ImageInfo(pil_image.size[0], pil_image.size[1], dpi)
+
+def load_image(path, info=None, greyscale=False):
+    '''
+    Load an image into a gamera image, decoding it only once.
+
+    PARAMETERS
+    ----------
+    path {String}: path of the image
+    info {ImageInfo}: header of the image if already read
+    greyscale {bool}: return bilevel images as greyscale images,
+                      as needed by the border removal
+    '''
+
+    from gamera.core import load_image as gamera_load_image
+
+    if info is None:
+        info = read_image_info(path)
+
+    pixels = _read_uncompressed_tiff(path, info)
+    if pixels is None:
+        # compressed or unsupported layout: let gamera decode it
+        image = gamera_load_image(path)
+        if greyscale and image.pixel_type_name == 'OneBit':
+            image = image.to_greyscale()
+        return image
+
+    from gamera.plugins import numeric_io
+
+    photometric = info.tags.get(PHOTOMETRIC, [BLACK_IS_ZERO])[0]
+    if info.bits_per_sample == 1:
+        # unpack the bits of each row, rows are padded to a whole byte
+        bits = np.unpackbits(pixels, axis=1)[:, :info.width]
+        black = bits if photometric == WHITE_IS_ZERO else 1 - bits
+        if greyscale:
+            return numeric_io.from_numpy(np.ascontiguousarray(((1 - black) * 255).astype(np.uint8)))
+        # gamera onebit images are stored as uint16, 1 is black
+        return numeric_io.from_numpy(black.astype(np.uint16))
+    elif info.samples_per_pixel == 1:
+        if photometric == WHITE_IS_ZERO:
+            pixels = 255 - pixels
+        return numeric_io.from_numpy(np.ascontiguousarray(pixels))
+    else:
+        return numeric_io.from_numpy(np.ascontiguousarray(pixels.reshape(info.height, info.width, 3)))
+
+def _read_uncompressed_tiff(path, info):
+    '''
+    Return the raw pixel data of an uncompressed bilevel, 8 bit greyscale or
+    8 bit RGB TIFF image as a uint8 array of shape (height, bytes per row),
+    memory-mapped when the strips are contiguous. Returns None for any other image.
+    '''
+
+    tags = info.tags
+    if tags is None:
+        return None
+    if (tags.get(COMPRESSION, [1])[0] != 1 or TILE_WIDTH in tags or
+        tags.get(FILL_ORDER, [1])[0] != 1 or tags.get(PREDICTOR, [1])[0] != 1 or
+        tags.get(PLANAR_CONFIG, [1])[0] != 1 or STRIP_OFFSETS not in tags):
+        return None
+
+    photometric = tags.get(PHOTOMETRIC, [BLACK_IS_ZERO])[0]
+    if info.bits_per_sample == 1 and info.samples_per_pixel == 1 and photometric in (WHITE_IS_ZERO, BLACK_IS_ZERO):
+        row_bytes = (info.width + 7) // 8
+    elif info.bits_per_sample == 8 and info.samples_per_pixel == 1 and photometric in (WHITE_IS_ZERO, BLACK_IS_ZERO):
+        row_bytes = info.width
+    elif info.bits_per_sample == 8 and info.samples_per_pixel == 3 and photometric == RGB:
+        row_bytes = 3 * info.width
+    else:
+        return None
+
+    offsets = tags[STRIP_OFFSETS]
+    rows_per_strip = tags.get(ROWS_PER_STRIP, [info.height])[0]
+    strip_bytes = [min(rows_per_strip, info.height - i * rows_per_strip) * row_bytes for i in xrange(len(offsets))]
+
+    if all(offsets[i] + strip_bytes[i] == offsets[i+1] for i in xrange(len(offsets)-1)):
+        return np.memmap(path, dtype=np.uint8, mode='r', offset=offsets[0], shape=(info.height, row_bytes))
+
+    pixels = np.empty((info.height, row_bytes), dtype=np.uint8)
+    flat = pixels.reshape(-1)
+    with open(path, 'rb') as f:
+        position = 0
+        for offset, nbytes in zip(offsets, strip_bytes):
+            f.seek(offset)
+            flat[position:position+nbytes] = np.frombuffer(f.read(nbytes), dtype=np.uint8)
+            position += nbytes
+
+    return pixels
+
+def write_tiff(path, black, dpi):
+    '''
+    Write a bilevel image as an uncompressed TIFF file with the given resolution,
+    readable by gamera and by load_image without decoding.
+
+    PARAMETERS
+    ----------
+    path {String}: path of the TIFF file
+    black {ndarray}: 2D array, nonzero where the pixels are black
+    dpi {int}: resolution of the image
+    '''
+
+    height, width = black.shape
+    data = np.packbits(np.asarray(black, dtype=bool), axis=1).tostring()
+
+    # header, image file directory, resolution rationals, pixels
+    entries = [
+        (IMAGE_WIDTH, 4, width),
+        (IMAGE_LENGTH, 4, height),
+        (BITS_PER_SAMPLE, 3, 1),
+        (COMPRESSION, 3, 1),
+        (PHOTOMETRIC, 3, WHITE_IS_ZERO),
+        (STRIP_OFFSETS, 4, None),
+        (SAMPLES_PER_PIXEL, 3, 1),
+        (ROWS_PER_STRIP, 4, height),
+        (STRIP_BYTE_COUNTS, 4, len(data)),
+        (X_RESOLUTION, 5, None),
+        (Y_RESOLUTION, 5, None),
+        (RESOLUTION_UNIT, 3, 2),
+    ]
+    ifd_offset = 8
+    resolution_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    data_offset = resolution_offset + 8
+
+    ifd = struct.pack('<H', len(entries))
+    for tag, field_type, value in entries:
+        if tag == STRIP_OFFSETS:
+            value = data_offset
+        elif tag in (X_RESOLUTION, Y_RESOLUTION):
+            value = resolution_offset
+        if field_type == 3:
+            ifd += struct.pack('<HHIHH', tag, field_type, 1, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, field_type, 1, value)
+    ifd += struct.pack('<I', 0)
+
+    with open(path, 'wb') as f:
+        f.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        f.write(ifd)
+        f.write(struct.pack('<II', int(dpi), 1))
+        f.write(data)
@@ -0,0 +1,153 @@
+"""
+Import-time benchmark of the barfinder entry points.
+
+Measures the cold start of `barfinder.py --help` and of the evaluation-only
+path of evaluate.py in fresh interpreters, and fails if the median time of an
+entry point goes over its budget or if it loads a module it should only load
+when a stage needs it. The evaluation-only path re-scores a tiny dataset of a
+page whose _ao.mei output already exists, so the algorithm is never run.
+
+usage:
+python importbudget.py
+python importbudget.py -n 10 --barfinder-budget 0.3 --evaluate-budget 0.6
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# set up command line argument structure
+parser = argparse.ArgumentParser(description='Check the import time of the barfinder entry points against a budget.')
+parser.add_argument('-n', '--runs', help='number of cold starts per entry point', type=int, default=5)
+parser.add_argument('--barfinder-budget', help='budget of barfinder.py --help (seconds)', type=float, default=0.5)
+parser.add_argument('--evaluate-budget', help='budget of the evaluation-only path (seconds)', type=float, default=1.0)
+
+# run an entry point and report the heavy modules it loaded on stderr
+PROBE = '''
+import sys
+sys.argv = %(argv)r
+sys.path.insert(0, %(path)r)
+try:
+    %(statement)s
+except SystemExit:
+    pass
+import json
+sys.stderr.write('\\n' + json.dumps(sorted(m for m in %(heavy)r if m in sys.modules)) + '\\n')
+'''
+
+# MEI of a page of a single measure, as the ground truth and as the existing output
+PAGE_MEI = '''<?xml version="1.0" encoding="UTF-8"?>
+<mei xmlns="http://www.music-encoding.org/ns/mei" meiversion="2013">
+    <music xml:id="music-1">
+        <facsimile xml:id="facsimile-1">
+            <surface xml:id="surface-1">
+                <zone xml:id="zone-1" ulx="10" uly="0" lrx="200" lry="150"/>
+            </surface>
+        </facsimile>
+        <body xml:id="body-1">
+            <mdiv xml:id="mdiv-1">
+                <score xml:id="score-1">
+                    <section xml:id="section-1">
+                        <measure xml:id="measure-1" n="1" facs="#zone-1"/>
+                    </section>
+                </score>
+            </mdiv>
+        </body>
+    </music>
+</mei>
+'''
+
+# thresholds of the existing output of the page
+AR_THRESH = 0.1
+V_THRESH = 0.66
+
+def write_rescoring_dataset(dataroot):
+    '''
+    Write a dataset of a single page (see evaluate.py) whose output
+    for AR_THRESH and V_THRESH already exists
+    '''
+
+    import numpy as np
+    from imageloader import write_tiff
+
+    page_dir = os.path.join(dataroot, '1')
+    os.makedirs(page_dir)
+    write_tiff(os.path.join(page_dir, 'page.tiff'), np.zeros((150, 200), dtype=np.uint8), 300)
+    with open(os.path.join(page_dir, 'page.txt'), 'w') as f:
+        f.write('(1)\n')
+    for name in ('page.mei', 'page_%.3f_%.3f_ao.mei' % (AR_THRESH, V_THRESH)):
+        with open(os.path.join(page_dir, name), 'w') as f:
+            f.write(PAGE_MEI)
+
+def time_entry_point(statement, argv, path, heavy, runs, cwd):
+    '''
+    Start an entry point in fresh interpreters.
+    Returns the median start-up time and the heavy modules it loaded.
+
+    PARAMETERS
+    ----------
+    statement {String}: python statement starting the entry point
+    argv {list}: command line arguments of the entry point
+    path {String}: directory prepended to the module search path
+    heavy {list}: modules that must not be loaded
+    runs {int}: number of cold starts
+    cwd {String}: working directory of the interpreters
+    '''
+
+    probe = PROBE % {'argv': argv, 'path': path, 'statement': statement, 'heavy': heavy}
+
+    timings = []
+    loaded = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            p = subprocess.Popen([sys.executable, '-c', probe], cwd=cwd, stdout=devnull, stderr=subprocess.PIPE)
+            _, err = p.communicate()
+            timings.append(time.time() - start)
+            if p.returncode != 0:
+                raise RuntimeError('%s failed:\n%s' % (statement, err))
+            loaded = json.loads(err.strip().splitlines()[-1])
+
+    timings.sort()
+    return timings[len(timings)//2], loaded
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    # evaluate.py imports through the barlineFinder package
+    link_dir = tempfile.mkdtemp()
+    os.symlink(package_dir, os.path.join(link_dir, 'barlineFinder'))
+    dataroot = os.path.join(link_dir, 'dataset')
+    write_rescoring_dataset(dataroot)
+
+    entry_points = [
+        ('barfinder.py --help',
+         "import runpy; runpy.run_path('barfinder.py', run_name='__main__')",
+         ['barfinder.py', '--help'], package_dir,
+         ['gamera', 'gamera.core', 'pymei', 'pyparsing', 'PIL'], args.barfinder_budget),
+        ('evaluate.py (re-scoring only)',
+         'from barlineFinder.evaluate import EvaluateMeasureFinder; '
+         'EvaluateMeasureFinder(%r).evaluate(%r, %r)' % (dataroot, AR_THRESH, V_THRESH),
+         ['evaluate.py', dataroot], link_dir,
+         ['gamera', 'gamera.core', 'barlineFinder.barfinder', 'barlineFinder.meicreate', 'pyparsing', 'PIL'], args.evaluate_budget)
+    ]
+
+    failed = False
+    try:
+        for name, statement, argv, path, heavy, budget in entry_points:
+            median, loaded = time_entry_point(statement, argv, path, heavy, args.runs, package_dir)
+            over_budget = median > budget
+            print '%-32s %.3fs (budget %.3fs)%s' % (name, median, budget, ' OVER BUDGET' if over_budget else '')
+            if loaded:
+                print '%-32s loads %s' % ('', ', '.join(loaded))
+            failed = failed or over_budget or bool(loaded)
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+"""
+Static index over the y-intervals of staff or system bounding boxes.
+
+The bounding boxes are sorted by their upper y coordinate and the running
+maximum of their lower y coordinates is kept, so that the boxes overlapping a
+y-range are found by two binary searches followed by a scan over the boxes that
+actually straddle it (usually none or one, since staves and systems rarely
+overlap).
+"""
+
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+class IntervalIndex:
+    '''
+    Index of bounding boxes of the form [n, x1, y1, x2, y2, ...],
+    such as the staff and system bounding boxes of a page.
+    '''
+
+    def __init__(self, bbs):
+        '''
+        PARAMETERS
+        ----------
+        bbs {list}: bounding boxes [[n, x1, y1, x2, y2, ...], ...]
+        '''
+
+        boxes = np.array([bb[1:5] for bb in bbs], dtype=np.int64).reshape(-1, 4)
+        self._order = np.argsort(boxes[:, 1], kind='mergesort')
+        # [[x1, y1, x2, y2], ...] sorted by y1
+        self._boxes = boxes[self._order]
+        self._starts = self._boxes[:, 1]
+        self._max_ends = np.maximum.accumulate(self._boxes[:, 3]) if len(boxes) else self._boxes[:, 3]
+
+        # python lists for scalar queries, which are faster with bisect
+        self._starts_list = self._starts.tolist()
+        self._max_ends_list = self._max_ends.tolist()
+        self._boxes_list = self._boxes.tolist()
+        self._order_list = self._order.tolist()
+
+    def overlapping(self, y1, y2):
+        '''
+        Return the indices, in ascending order, of the bounding boxes
+        whose open y-interval contains a pixel row y with y1 <= y <= y2.
+        '''
+
+        # boxes starting before y2 and, among them, those that may end after y1
+        hi = bisect_left(self._starts_list, y2)
+        lo = bisect_right(self._max_ends_list, y1)
+
+        found = []
+        for i in xrange(lo, hi):
+            box = self._boxes_list[i]
+            if max(y1, box[1] + 1) <= min(y2, box[3] - 1):
+                found.append(self._order_list[i])
+        found.sort()
+
+        return found
+
+    def first_containing(self, x, y):
+        '''
+        For each point, return the index of the first bounding box
+        that strictly contains it, or -1 if there is none.
+
+        PARAMETERS
+        ----------
+        x {ndarray}: x coordinates of the points
+        y {ndarray}: y coordinates of the points
+        '''
+
+        x = np.asarray(x)
+        y = np.asarray(y)
+        first = np.full(len(y), len(self._order), dtype=np.int64)
+
+        hi = np.searchsorted(self._starts, y, side='left')
+        lo = np.searchsorted(self._max_ends, y, side='right')
+        depth = hi - lo
+        # visit the boxes straddling each point, one layer at a time
+        for d in xrange(int(depth.max()) if len(depth) else 0):
+            has_box = d < depth
+            i = np.where(has_box, lo + d, 0)
+            box = self._boxes[i]
+            inside = (has_box & (x > box[:, 0]) & (x < box[:, 2]) & (y > box[:, 1]) & (y < box[:, 3]))
+            first = np.where(inside, np.minimum(first, self._order[i]), first)
+
+        first[first == len(self._order)] = -1
+
+        return first
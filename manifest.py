@@ -0,0 +1,172 @@
+"""
+Manifest of the outputs of a batch run, for incremental reprocessing.
+
+For every output the manifest records the hash of the input image, the staff
+group hint, the parameters of the barline finder and the code version that
+produced it. A page is processed again only if one of them changed or the
+output is missing. The size and modification time of the input are recorded
+too, so that unchanged images are recognized without reading them.
+
+The manifest is a file of JSON lines, one line per recorded output, appended
+as the pages finish so that an interrupted run keeps its progress. Later lines
+replace earlier lines of the same output; compact() rewrites the file with one
+line per output.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+def file_hash(path):
+    '''
+    Calculate the sha1 hash of the contents of the given file
+    '''
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def code_version(version, module_names):
+    '''
+    Return a version of the code of the given modules: the version string
+    followed by a hash of their source files, so that outputs are reprocessed
+    after any change to the pipeline, even without a version bump
+
+    PARAMETERS
+    ----------
+    version {String}: pipeline version
+    module_names {list}: names of the imported modules of the pipeline
+    '''
+
+    sha = hashlib.sha1()
+    for name in module_names:
+        path = sys.modules[name].__file__
+        if path.endswith('.pyc') or path.endswith('.pyo'):
+            path = path[:-1]
+        sha.update(file_hash(path))
+
+    return '%s:%s' % (version, sha.hexdigest()[:12])
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+class Manifest:
+    '''
+    Records of the outputs of a batch run
+    '''
+
+    def __init__(self, path, code_version, params):
+        '''
+        PARAMETERS
+        ----------
+        path {String}: manifest file, created on the first record
+        code_version {String}: version of the code of this run (see code_version)
+        params {dict}: parameters of this run affecting the outputs
+        '''
+
+        self._path = path
+        self._code_version = code_version
+        # round trip through json so that the parameters compare equal to recorded ones
+        self._params = json.loads(json.dumps(params))
+        self._file = None
+        # lines in the file, including replaced records
+        self._num_lines = 0
+
+        # {output path: record}
+        self._records = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    self._num_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted run
+                        continue
+                    self._records[record['output']] = record
+
+    def __len__(self):
+        return len(self._records)
+
+    def check(self, output_path, input_path, sg_hint):
+        '''
+        Check whether the output is up to date with its input, hint, the parameters
+        and code version. Returns (up to date, fingerprint of the input) where the
+        fingerprint is to be recorded once the output is written. The input is hashed
+        only if its size or modification time changed since it was recorded.
+        '''
+
+        record = self._records.get(output_path)
+        # stamp the input before hashing it, so that a change during the run is seen next time
+        stamp = _stamp(input_path)
+
+        if record is None:
+            return False, (file_hash(input_path), stamp)
+
+        if record['input_stamp'] == stamp:
+            input_hash = record['input_hash']
+        else:
+            input_hash = file_hash(input_path)
+
+        up_to_date = (input_hash == record['input_hash'] and
+                      sg_hint == record['sg_hint'] and
+                      self._params == record['params'] and
+                      self._code_version == record['code_version'] and
+                      os.path.isfile(output_path))
+
+        if up_to_date and record['input_stamp'] != stamp:
+            # touched but unchanged: remember the new stamp to skip hashing next time
+            self.record(output_path, input_path, sg_hint, (input_hash, stamp))
+
+        return up_to_date, (input_hash, stamp)
+
+    def record(self, output_path, input_path, sg_hint, fingerprint):
+        '''
+        Record the output of the given input, with the fingerprint
+        of the input returned by check before it was processed
+        '''
+
+        input_hash, stamp = fingerprint
+        record = {
+            'output': output_path,
+            'input': input_path,
+            'input_hash': input_hash,
+            'input_stamp': stamp,
+            'sg_hint': sg_hint,
+            'params': self._params,
+            'code_version': self._code_version
+        }
+        self._records[output_path] = record
+
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        self._num_lines += 1
+
+    def compact(self):
+        '''
+        Rewrite the manifest with the latest record of each output
+        '''
+
+        self.close()
+        if self._num_lines == len(self._records):
+            # nothing replaced
+            return
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for output_path in sorted(self._records):
+                f.write(json.dumps(self._records[output_path], sort_keys=True) + '\n')
+        os.rename(tmp_path, self._path)
+        self._num_lines = len(self._records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,40 +1,93 @@
 import argparse
-import datetime
 import os
+from xml.etree.cElementTree import iterparse
 
 from pymei import XmlImport, XmlExport, MeiElement
+
+from meiids import ID_STRATEGIES, encoding_date, id_generator
+from meiwriter import MeiWriter
 # set up command line argument structure
 parser = argparse.ArgumentParser(description='Combines mei files created by the barline finding algorithm')
 parser.add_argument('inputdirectory', help='input directory')
 parser.add_argument('fileout', help='output file (.mei)')
 parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
+parser.add_argument('-s', '--stream', help='combine the files one element at a time with bounded memory, instead of in a pymei document', action='store_true')
+parser.add_argument('-id', '--ids', help='ids of the added elements, counter also prefixes the ids of the pages after the first with their page number', choices=ID_STRATEGIES, default='uuid')
+
+def _page_id_prefix(page_ind, page_ids, combined_ids, strategy):
+    '''
+    Prefix of the ids of the page with the given index in the combined document.
+    The ids of a page after the first are prefixed with its page number when
+    combining with counter ids, as pages generated with counter ids (see meiids.py)
+    all use the same ids, or when one of its ids is already in the combined document.
+    The random ids of other pages are kept as they are.
+
+    PARAMETERS
+    ----------
+    page_ind {int}: index of the page
+    page_ids {set}: ids of the page
+    combined_ids {set}: ids of the pages before it in the combined document
+    strategy {String}: id strategy of the combiner
+    '''
+
+    if page_ind > 0 and (strategy == 'counter' or not combined_ids.isdisjoint(page_ids)):
+        return 'p%d-' % (page_ind + 1)
+
+    return ''
+
+def _prefix_references(value, prefix):
+    '''
+    Prefix the ids referred to by an attribute value made of '#id' references.
+    Other values are returned as they are.
+    '''
+
+    references = value.split()
+    if not references or not all(r.startswith('#') for r in references):
+        return value
+
+    return ' '.join('#' + prefix + r[1:] for r in references)
 
 class MeiCombiner:
     '''
     Combines mei files created by the barline finding algorithm.
     '''
 
-    def __init__(self, input_mei_paths, output_mei_path):
+    def __init__(self, input_mei_paths, output_mei_path, ids='uuid', date=None):
         '''
         PARAMETERS
         ----------
         input_mei_paths {list}: list of mei paths to combine
         output_mei_path {String}: output file path of type .mei
+        ids {String}: id strategy of the added elements (see meiids.py).
+                      With counter ids, the ids of the pages after the first one,
+                      and the references to them, are prefixed with their page number,
+                      as are the ids of any page that collide with those of a previous page.
+        date {String}: date of the added change (YYYY-MM-DD). If None,
+                       today's date with random ids and no date with counter ids.
         '''
 
         self._input_mei_paths = input_mei_paths
         self._output_mei_path = output_mei_path
+        self._date = encoding_date(ids, date)
+        self._id_strategy = ids
+        self._ids = id_generator(ids, 'combine-')
         if len(self._input_mei_paths):
             self._meidoc = XmlImport.documentFromFile(self._input_mei_paths[0])
         else:
             self._meidoc = None
 
     def combine(self):
-        if self._meidoc and len(input_mei_paths) > 1:
+        if self._meidoc and len(self._input_mei_paths) > 1:
             base_facsimile = self._meidoc.getElementsByName('facsimile')[0]
             base_section = self._meidoc.getElementsByName('section')[0]
-            for f in self._input_mei_paths[1:]:
+            combined_ids = self._element_ids(self._meidoc.getRootElement())
+            for page_ind, f in enumerate(self._input_mei_paths[1:], 1):
                 mei = XmlImport.documentFromFile(f)
+                page_ids = self._element_ids(mei.getRootElement())
+                prefix = _page_id_prefix(page_ind, page_ids, combined_ids, self._id_strategy)
+                if prefix:
+                    self._rescope_ids(mei.getRootElement(), prefix)
+                combined_ids.update(prefix + element_id for element_id in page_ids)
 
                 # combine surface
                 surface = mei.getElementsByName('surface')
@@ -45,7 +98,7 @@ class MeiCombiner:
                     base_facsimile.addChild(surface[0])
 
                 # combine measures
-                pb = MeiElement('pb')
+                pb = self._create_element('pb')
                 base_section.addChild(pb)
 
                 # get last measure number
@@ -67,10 +120,49 @@ class MeiCombiner:
 
             self._add_revision()
 
+    def _create_element(self, name):
+        '''
+        Create an element with an id of the id strategy of the combiner
+        '''
+
+        element = MeiElement(name)
+        if self._ids is not None:
+            element.setId(self._ids(name))
+
+        return element
+
+    def _element_ids(self, element, ids=None):
+        '''
+        Return the set of the ids of an element and its descendants
+        '''
+
+        if ids is None:
+            ids = set()
+        ids.add(element.getId())
+        for child in element.getChildren():
+            self._element_ids(child, ids)
+
+        return ids
+
+    def _rescope_ids(self, element, prefix):
+        '''
+        Prefix the ids of an element and its descendants,
+        along with the references to them
+        '''
+
+        element.setId(prefix + element.getId())
+        for attribute in element.getAttributes():
+            value = attribute.getValue()
+            prefixed = _prefix_references(value, prefix)
+            if prefixed != value:
+                element.addAttribute(attribute.getName(), prefixed)
+
+        for child in element.getChildren():
+            self._rescope_ids(child, prefix)
+
     def _add_revision(self):
         # add a revision
-        today = datetime.date.today().isoformat()
-        change = MeiElement('change')
+        change = self._create_element('change')
 
         # get last change number
         changes = self._meidoc.getElementsByName('change')
@@ -78,12 +170,12 @@ class MeiCombiner:
             last_change = int(changes[-1].getAttribute('n').value)
 
         change.addAttribute('n', str(last_change+1))
-        resp_stmt = MeiElement('respStmt')
-        corp_name = MeiElement('corpName')
+        resp_stmt = self._create_element('respStmt')
+        corp_name = self._create_element('corpName')
         corp_name.setValue('Distributed Digital Music Archives and Libraries Lab (DDMAL)')
-        change_desc = MeiElement('changeDesc')
-        ref = MeiElement('ref')
-        p = MeiElement('p')
+        change_desc = self._create_element('changeDesc')
+        ref = self._create_element('ref')
+        p = self._create_element('p')
         application = self._meidoc.getElementsByName('application')
         app_name = 'RODAN/barlineFinder'
         if len(application):
@@ -93,8 +185,6 @@ class MeiCombiner:
             p.addChild(ref)
 
         p.setValue('Combining individual page MEIs using ')
-        date = MeiElement('date')
-        date.setValue(today)
 
         revision_descs = self._meidoc.getElementsByName('revisionDesc')
         if len(revision_descs):
@@ -103,7 +193,10 @@ class MeiCombiner:
             resp_stmt.addChild(corp_name)
             change.addChild(change_desc)
             change_desc.addChild(p)
-            change.addChild(date)
+            if self._date is not None:
+                date = self._create_element('date')
+                date.setValue(self._date)
+                change.addChild(date)
 
     def write_mei(self):
         if self._meidoc:
@@ -112,6 +205,254 @@ class MeiCombiner:
     def get_mei(self):
         return self._meidoc
 
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _attribute_name(key):
+    if key.startswith('{http://www.w3.org/XML/1998/namespace}'):
+        return 'xml:' + _local_name(key)
+
+    return _local_name(key)
+
+def _content(text):
+    # whitespace between elements is indentation
+    if text is None or not text.strip():
+        return None
+
+    return text
+
+class StreamingMeiCombiner:
+    '''
+    Combines mei files created by the barline finding algorithm
+    one element at a time, without building a pymei document.
+
+    Each input file is read three times with an incremental parser: once for
+    its ids, to find those that collide with the ids of the previous files, once
+    for its surface, up to the end of its facsimile, and once for the children of
+    its section. Only one surface or one measure is held in memory at a time, along
+    with the set of the ids of the files. The output is the same
+    document as that of MeiCombiner: the header and scoreDef of the first file,
+    the surfaces of every file, and the measures of every file in one section
+    with a pb before each file after the first and continuous measure numbers.
+    '''
+
+    def __init__(self, input_mei_paths, output_mei_path, ids='uuid', date=None):
+        '''
+        PARAMETERS
+        ----------
+        input_mei_paths {list}: list of mei paths to combine
+        output_mei_path {String}: output file path of type .mei
+        ids {String}: id strategy of the added elements, as for MeiCombiner
+        date {String}: date of the added change, as for MeiCombiner
+        '''
+
+        self._input_mei_paths = input_mei_paths
+        self._output_mei_path = output_mei_path
+        self._id_strategy = ids
+        self._date = encoding_date(ids, date)
+
+    def combine(self):
+        '''
+        Combine the input files and write the result to the output file
+        '''
+
+        if not len(self._input_mei_paths):
+            return
+
+        # id prefix of each file
+        self._prefixes = []
+        combined_ids = set()
+        for page_ind, path in enumerate(self._input_mei_paths):
+            page_ids = self._file_ids(path)
+            prefix = _page_id_prefix(page_ind, page_ids, combined_ids, self._id_strategy)
+            self._prefixes.append(prefix)
+            combined_ids.update(prefix + element_id for element_id in page_ids)
+
+        with open(self._output_mei_path, 'w') as f:
+            writer = MeiWriter(f, ids=id_generator(self._id_strategy, 'combine-'))
+
+            for page_ind, path in enumerate(self._input_mei_paths):
+                self._write_surface(writer, path, page_ind)
+            # facsimile
+            writer.end()
+
+            # last measure number
+            self._measure_n = 0
+            for page_ind, path in enumerate(self._input_mei_paths):
+                self._write_section(writer, path, page_ind)
+
+            # section, score, mdiv, body, music
+            for i in range(5):
+                writer.end()
+            writer.end_document()
+
+    def _file_ids(self, path):
+        '''
+        Return the set of the ids of the elements of an input file
+        '''
+
+        ids = set()
+        for event, element in iterparse(path):
+            element_id = element.get(XML_ID)
+            if element_id is not None:
+                ids.add(element_id)
+            # the element is not needed anymore
+            element.clear()
+
+        return ids
+
+    def _write_surface(self, writer, path, page_ind):
+        '''
+        Write the surface of an input file. The header and the elements
+        enclosing the facsimile are written from the first file.
+        '''
+
+        prefix = self._prefixes[page_ind]
+        elements = []
+        for event, element in iterparse(path, ('start', 'end')):
+            name = _local_name(element.tag)
+            if event == 'start':
+                elements.append(element)
+                if page_ind == 0:
+                    if name == 'mei':
+                        writer.start_document(element.get(XML_ID))
+                    elif name in ('music', 'facsimile'):
+                        self._start(writer, element)
+                continue
+
+            elements.pop()
+            if name == 'meiHead' and page_ind == 0:
+                self._application_id = None
+                for e in element.iter():
+                    if _local_name(e.tag) == 'application':
+                        self._application_id = e.get(XML_ID)
+                        break
+                self._copy(writer, element, '', {'revisionDesc': self._write_revision})
+                elements[-1].remove(element)
+            elif name == 'surface':
+                self._copy(writer, element, prefix)
+                elements[-1].remove(element)
+            elif name == 'facsimile':
+                break
+
+    def _write_section(self, writer, path, page_ind):
+        '''
+        Write the children of the section of an input file, renumbering its
+        measures. The scoreDef and the elements enclosing the section
+        are written from the first file.
+        '''
+
+        prefix = self._prefixes[page_ind]
+        elements = []
+        for event, element in iterparse(path, ('start', 'end')):
+            name = _local_name(element.tag)
+            if event == 'start':
+                elements.append(element)
+                if name == 'section':
+                    if page_ind == 0:
+                        self._start(writer, element)
+                    else:
+                        writer.element('pb')
+                elif page_ind == 0 and name in ('body', 'mdiv', 'score'):
+                    self._start(writer, element)
+                continue
+
+            elements.pop()
+            if name == 'section':
+                break
+            elif _local_name(elements[-1].tag) == 'section':
+                if name == 'measure':
+                    if page_ind == 0:
+                        self._measure_n = int(element.get('n', self._measure_n + 1))
+                    else:
+                        self._measure_n += 1
+                        element.set('n', str(self._measure_n))
+                self._copy(writer, element, prefix)
+                elements[-1].remove(element)
+            elif name == 'scoreDef' and page_ind == 0:
+                self._copy(writer, element)
+                elements[-1].remove(element)
+            elif name in ('meiHead', 'surface'):
+                # not needed for the section
+                elements[-1].remove(element)
+
+    def _attributes(self, element, prefix=''):
+        attributes = []
+        for key, value in element.items():
+            if key == XML_ID:
+                continue
+            if prefix:
+                value = _prefix_references(value, prefix)
+            attributes.append((_attribute_name(key), value))
+
+        return attributes
+
+    def _element_id(self, element, prefix=''):
+        element_id = element.get(XML_ID)
+        if element_id is not None:
+            element_id = prefix + element_id
+
+        return element_id
+
+    def _start(self, writer, element):
+        writer.start(_local_name(element.tag), self._attributes(element), _content(element.text),
+                     self._element_id(element))
+
+    def _copy(self, writer, element, prefix='', extend={}):
+        '''
+        Write an element and its descendants, prefixing their ids and the
+        references to them. extend maps element names to functions called with
+        the writer and the element before it is closed, to add children to it.
+        '''
+
+        name = _local_name(element.tag)
+        attributes = self._attributes(element, prefix)
+        element_id = self._element_id(element, prefix)
+        text = _content(element.text)
+        tail = _content(element.tail)
+        if not len(element) and name not in extend:
+            writer.element(name, attributes, text, tail, element_id)
+            return
+
+        writer.start(name, attributes, text, element_id)
+        for child in element:
+            self._copy(writer, child, prefix, extend)
+        if name in extend:
+            extend[name](writer, element)
+        writer.end(tail)
+
+    def _write_revision(self, writer, element):
+        '''
+        Add a change to the revisionDesc of the header of the first file
+        '''
+
+        app_name = 'RODAN/barlineFinder'
+
+        # get last change number
+        last_change = 0
+        changes = [e for e in element if _local_name(e.tag) == 'change']
+        if len(changes):
+            last_change = int(changes[-1].get('n'))
+
+        application_id = self._application_id
+        writer.start('change', [('n', str(last_change+1))])
+        writer.start('respStmt')
+        writer.element('corpName', text='Distributed Digital Music Archives and Libraries Lab (DDMAL)')
+        writer.end()
+        writer.start('changeDesc')
+        if application_id is not None:
+            writer.start('p', text='Combining individual page MEIs using ')
+            writer.element('ref', [('target', '#'+application_id)], text=app_name, tail='.')
+            writer.end()
+        else:
+            writer.element('p', text='Combining individual page MEIs using ')
+        writer.end()
+        if self._date is not None:
+            writer.element('date', text=self._date)
+        writer.end()
+
 if __name__ == "__main__":
     # parse command line arguments
     args = parser.parse_args()
@@ -130,6 +471,10 @@ if __name__ == "__main__":
     output_file = args.fileout
     verbose = args.verbose
 
-    mc = MeiCombiner(input_mei_paths, output_file)
-    mc.combine()
-    mc.write_mei()
+    if args.stream:
+        mc = StreamingMeiCombiner(input_mei_paths, output_file, args.ids)
+        mc.combine()
+    else:
+        mc = MeiCombiner(input_mei_paths, output_file, args.ids)
+        mc.combine()
+        mc.write_mei()
@@ -26,17 +26,37 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 Sample usage:
 python meicreate.py -b C_07a_ED-Kl_1_A-Wn_SHWeber90_S_009_bar_position_2.txt -s C_07a_ED-Kl_1_A-Wn_SHWeber90_S_009_staff_vertices.txt -f detmoldbars.mei -g '(2|)x2 (4(2|))' -v    
+
+Convert every bar/staff text file pair and .bdat file (see list_bar_lines.py)
+under a directory, on all cores:
+python meicreate.py -d legacy_outputs -o mei -w 8
+
+or into a single MEI document of all the pages, in the order of their file names:
+python meicreate.py -d legacy_outputs -bo book.mei
+
+The bar and staff text files hold one bounding box per line, staff_no ulx uly lrx lry,
+separated by spaces or commas. A pair is NAME_bar_position[_N].txt and NAME_staff_vertices.txt
+and its staff group hint is given with -g or read from NAME.txt. The bar lines of a .bdat
+file go through whole systems, so each system is converted as a single staff.
+The graphic of the MEI refers to NAME.tiff if it is next to the input files.
+Each bar file of a page with several is converted to NAME_N.mei, but a book
+only holds the first bar file of each page.
 """
 from __future__ import division
 import argparse
-from pyparsing import nestedExpr
+import multiprocessing
 import os
 import re
-import sys
-import datetime
+import traceback
+
+import numpy as np
 
 from pymei import MeiDocument, MeiElement, XmlExport
 
+from staffgroups import compile_hint
+from meiwriter import MeiWriter
+from meiids import ID_STRATEGIES, encoding_date, id_generator
+
 # set up command line argument structure
 parser = argparse.ArgumentParser(description='Convert text file of OMR barline data to mei.')
 parser.add_argument('-b', '--barfilein', help='barline data input file')
@@ -44,6 +64,208 @@ parser.add_argument('-s', '--stafffilein', help='staff data input file')
 parser.add_argument('-g', '--staffgroups', help='staffgroups')
 parser.add_argument('-f', '--fileout', help='output file')
 parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
+parser.add_argument('-d', '--inputdir', help='convert all the bar/staff text files and .bdat files under this directory')
+parser.add_argument('-o', '--outputdir', help='output directory of the bulk conversion (default: next to the input files)')
+parser.add_argument('-id', '--ids', help='ids of the generated elements: random or deterministic, counted per page', choices=ID_STRATEGIES, default='uuid')
+parser.add_argument('-bo', '--bookout', help='write all the pages of the bulk conversion to this single MEI file')
+parser.add_argument('-w', '--workers', help='number of worker processes of the bulk conversion (default: number of cores)', type=int)
+
+# bar position file of a bar/staff text file pair
+BAR_FILE_PATTERN = re.compile(r'^(.*)_bar_position(_\d+)?\.txt$')
+STAFF_FILE_SUFFIX = '_staff_vertices.txt'
+# any character that cannot be part of whitespace separated integers
+NOT_INTEGER_PATTERN = re.compile(r'[^0-9\s+-]')
+
+def read_boxes(path):
+    '''
+    Read a text file of bounding boxes, one staff_no ulx uly lrx lry per line
+    separated by spaces or commas, into an array with a row per box
+    '''
+
+    with open(path) as f:
+        text = f.read().replace(',', ' ')
+
+    values = _parse_values(text, path)
+    if len(values) % 5:
+        raise ValueError('%s does not hold 5 values per bounding box' % path)
+
+    return values.reshape(-1, 5)
+
+def _parse_values(text, path):
+    '''
+    Parse whitespace separated integers. np.fromstring stops silently at the
+    first value it cannot parse and parses the leading digits of a value such
+    as '5x', so the characters of the text are checked and the number of values
+    is checked against the number of fields of the text.
+    '''
+
+    num_fields = len(text.split())
+    if not num_fields:
+        # np.fromstring parses a blank text as a single 0
+        return np.zeros(0, dtype=np.int64)
+
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    if len(values) != num_fields or NOT_INTEGER_PATTERN.search(text) is not None:
+        raise ValueError('%s holds values that are not integers' % path)
+
+    return values
+
+def read_bdat(path):
+    '''
+    Read the bar lines of a .bdat file written by list_bar_lines.py, one
+    top_x top_y bottom_x bottom_y per line with systems separated by '~'.
+    Each system with bar lines becomes a staff, systems without bar lines are dropped.
+    Returns the staff and bar bounding boxes, as arrays with a row
+    [staff_no, ulx, uly, lrx, lry] per box.
+    '''
+
+    with open(path) as f:
+        text = f.read()
+    # every line written by list_bar_lines.py ends with a newline
+    if text and not text.endswith('\n'):
+        raise ValueError('%s is truncated' % path)
+
+    systems = [_parse_values(s, path) for s in text.split('~')]
+    if any(len(s) % 4 for s in systems):
+        # a line cut short, e.g. by a truncated file
+        raise ValueError('%s does not hold 4 values per bar line' % path)
+    systems = [s.reshape(-1, 4) for s in systems if len(s)]
+    if not systems:
+        return np.zeros((0, 5), dtype=np.int64), np.zeros((0, 5), dtype=np.int64)
+
+    bars = np.vstack(systems)
+    staff_no = np.repeat(np.arange(1, len(systems) + 1), [len(s) for s in systems])
+    bar_bb = np.column_stack((staff_no, bars))
+    # bars of each staff from left to right
+    bar_bb = bar_bb[np.lexsort((bar_bb[:, 1], bar_bb[:, 0]))]
+
+    # the staff of a system spans all of its bar lines
+    staff_bb = np.column_stack((np.arange(1, len(systems) + 1),
+                                [s[:, 0].min() for s in systems], [s[:, 1].min() for s in systems],
+                                [s[:, 2].max() for s in systems], [s[:, 3].max() for s in systems]))
+
+    return staff_bb, bar_bb
+
+def find_conversion_jobs(input_dir, output_dir=None, sg_hint=None):
+    '''
+    Find the bar/staff text file pairs and .bdat files under a directory, in
+    the order of their paths. Returns [(kind, input paths, sg_hint, image path,
+    output path), ...] where kind is 'txt' or 'bdat' and sg_hint is None if no
+    hint was given or found. The output of NAME_bar_position_N.txt is NAME_N.mei.
+    '''
+
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        # walk the directories in order, whatever the order of the file system
+        dirnames.sort()
+        for f in sorted(filenames):
+            match = BAR_FILE_PATTERN.match(f)
+            if match is not None:
+                kind = 'txt'
+                name = match.group(1)
+                # several bar files of the same page are kept apart
+                output_name = name + (match.group(2) or '')
+                inputs = (os.path.join(dirpath, f), os.path.join(dirpath, name + STAFF_FILE_SUFFIX))
+                page_hint = sg_hint
+                hint_path = os.path.join(dirpath, name + '.txt')
+                if page_hint is None and os.path.isfile(hint_path):
+                    with open(hint_path) as hint_file:
+                        page_hint = hint_file.readline().strip()
+            elif f.endswith('.bdat'):
+                kind = 'bdat'
+                name = output_name = f[:-len('.bdat')]
+                inputs = (os.path.join(dirpath, f),)
+                page_hint = None
+            else:
+                continue
+
+            image_path = os.path.join(dirpath, name + '.tiff')
+            output_path = os.path.join(output_dir or dirpath, output_name + '.mei')
+            jobs.append((kind, inputs, page_hint, image_path, output_path))
+
+    return jobs
+
+def page_jobs(jobs):
+    '''
+    Keep the first job of each page (image path) of the jobs found by
+    find_conversion_jobs, warning about the others
+    '''
+
+    pages = set()
+    kept = []
+    for job in jobs:
+        if job[3] in pages:
+            print 'WARNING: skipping {0}, another bar file of the same page is used'.format(job[1][0])
+            continue
+        pages.add(job[3])
+        kept.append(job)
+
+    return kept
+
+def read_job(job):
+    '''
+    Read the input files of a job found by find_conversion_jobs.
+    Returns the staff group hint of the page and its results in the form
+    returned by BarlineFinder.process_file.
+    '''
+
+    kind, inputs, sg_hint, image_path, output_path = job
+    if kind == 'bdat':
+        staff_bb, bar_bb = read_bdat(inputs[0])
+        # one staff per system, the bar lines go through the whole system
+        sg_hint = '(1|)x%d' % len(staff_bb)
+    else:
+        bar_bb = read_boxes(inputs[0])
+        # bars of each staff from left to right
+        bar_bb = bar_bb[np.lexsort((bar_bb[:, 1], bar_bb[:, 0]))]
+        staff_bb = read_boxes(inputs[1])
+        if sg_hint is None:
+            raise ValueError('no staff group hint for %s' % inputs[0])
+
+    if os.path.isfile(image_path):
+        import imageloader
+        info = imageloader.read_image_info(image_path)
+        image_width, image_height, image_dpi = info.width, info.height, info.dpi
+    else:
+        image_path, image_width, image_height, image_dpi = '', 0, 0, 0
+
+    return sg_hint, (staff_bb.tolist(), bar_bb.tolist(), image_path, image_width, image_height, image_dpi)
+
+def convert_file(job, verbose=False, ids='uuid'):
+    '''
+    Convert the input files of a job found by find_conversion_jobs to MEI
+    '''
+
+    sg_hint, (staff_bb, bar_bb, image_path, image_width, image_height, image_dpi) = read_job(job)
+    bar_converter = BarlineDataConverter(staff_bb, bar_bb, verbose, ids)
+    bar_converter.write_mei(job[4], sg_hint, image_path, image_width, image_height, image_dpi)
+
+def _convert_job(args):
+    job, verbose, ids = args
+    try:
+        convert_file(job, verbose, ids)
+    except:
+        return job, traceback.format_exc()
+
+    return job, None
+
+def convert_files(jobs, workers=None, verbose=False, ids='uuid'):
+    '''
+    Convert the jobs found by find_conversion_jobs on a pool of worker processes.
+    Yields (job, error) in order of completion, where error is None or
+    the formatted traceback of the failed job.
+    '''
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for job, error in pool.imap_unordered(_convert_job, [(job, verbose, ids) for job in jobs], chunksize=16):
+            yield job, error
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 class BarlineDataConverter:
     '''
@@ -51,22 +273,43 @@ class BarlineDataConverter:
     to MEI.
     '''
 
-    def __init__(self, staff_bb, bar_bb, verbose):
+    def __init__(self, staff_bb, bar_bb, verbose, id_strategy='uuid', id_scope='', date=None):
         '''
         Initialize the converter
+
+        PARAMETERS
+        ----------
+        id_strategy {String}: ids of the generated elements (see meiids.py),
+                              'uuid' (random) or 'counter' (deterministic, per page)
+        id_scope {String}: prefix of the counter ids
+        date {String}: date of the encoding in the header (YYYY-MM-DD). If None,
+                       today's date with random ids and no date with counter ids.
         '''
 
         self.staff_bb = staff_bb
         self.bar_bb = bar_bb
         self.verbose = verbose
 
+        self._id_strategy = id_strategy
+        self._id_scope = id_scope
+        self._date = encoding_date(id_strategy, date)
+        # id generator of the document being generated, None for the ids of pymei
+        self._ids = None
+
     def bardata_to_mei(self, sg_hint, image_path, image_width, image_height, image_dpi):
         '''
         Perform the data conversion to mei
+
+        PARAMETERS
+        ----------
+        sg_hint: staff group hint, as a string or compiled with staffgroups.compile_hint
         '''
 
+        # ids are counted from the start of every page
+        self._ids = id_generator(self._id_strategy, self._id_scope)
+
         self.meidoc = MeiDocument()
-        mei = MeiElement('mei')
+        mei = self._create_element('mei')
         self.meidoc.setRootElement(mei)
 
         ###########################
@@ -78,57 +321,28 @@ class BarlineDataConverter:
         ###########################
         #           Body          #
         ###########################
-        music = MeiElement('music')
-        body = MeiElement('body')
-        mdiv = MeiElement('mdiv')
-        score = MeiElement('score')
-        score_def = MeiElement('scoreDef')
-        section = MeiElement('section')
+        music = self._create_element('music')
+        body = self._create_element('body')
+        mdiv = self._create_element('mdiv')
+        score = self._create_element('score')
+        score_def = self._create_element('scoreDef')
+        section = self._create_element('section')
 
         # physical location data
-        facsimile = MeiElement('facsimile')
-        surface = MeiElement('surface')
+        facsimile = self._create_element('facsimile')
+        surface = self._create_element('surface')
 
         graphic = self._create_graphic(image_path, image_width, image_height)
         surface.addChild(graphic)
 
-        # parse staff group hint to generate staff group
-        sg_hint = sg_hint.split(" ")
-        systems = []
-        for s in sg_hint:
-            parser = nestedExpr()
-            sg_list = parser.parseString(s).asList()[0]
-            staff_grp, n = self._create_staff_group(sg_list, MeiElement('staffGrp'), 0)
-
-            # parse repeating staff groups (systems)
-            num_sb = 1
-            match = re.search('(?<=x)(\d+)$', s)
-            if match is not None:
-                # there are multiple systems of this staff grouping
-                num_sb = int(match.group(0))
-            
-            for i in range(num_sb):
-                systems.append(staff_grp)
-
-            if self.verbose:
-                print "number of staves in system: %d x %d system(s)" % (n, num_sb)
-
-        # there may be hidden staves in a system
-        # make the encoded staff group the largest number of staves in a system
-        final_staff_grp = max(systems, key=lambda x: len(x.getDescendantsByName('staffDef')))
+        # staff zones and measures of each system
+        sg_hint, final_group, layout = self.page_layout(sg_hint)
+        final_staff_grp = final_group.to_mei(self._ids)
 
         mei.addChild(music)
         music.addChild(facsimile)
         facsimile.addChild(surface)
-        
-        # list of staff bounding boxes within a system
-        staves = []
-        for staff_bb in self.staff_bb:
-            # get bounding box of the staff
-            # parse bounding box integers
-            #staff_bb = [int(x) for x in staff_bb]
-            staves.append(staff_bb[1:])
-        
+
         music.addChild(body)
         body.addChild(mdiv)
         mdiv.addChild(score)
@@ -136,9 +350,55 @@ class BarlineDataConverter:
         score_def.addChild(final_staff_grp)
         score.addChild(section)
 
+        for s_ind, (zones, measure_numbers) in enumerate(layout):
+            # measures in a system
+            s_measures = []
+            for ulx, uly, lrx, lry, m, staff_n in zones:
+                zone = self._create_zone(ulx, uly, lrx, lry)
+                surface.addChild(zone)
+                staff = self._create_staff(staff_n, zone)
+                if m == len(s_measures):
+                    # create a new measure
+                    measure = self._create_measure(str(measure_numbers[m]))
+                    s_measures.append(measure)
+                    section.addChild(measure)
+                s_measures[m].addChild(staff)
+
+            # calculate min/max of measure/staff bounding boxes to get measure zone
+            self._calc_measure_zone(s_measures, zones, surface)
+
+            # add a system break, if necessary
+            if s_ind+1 < len(layout):
+                sb = self._create_element('sb')
+                section.addChild(sb)
+
+    def page_layout(self, sg_hint):
+        '''
+        Lay out the staff zones and measures of each system without creating any MEI,
+        in document order. Both MEI backends are written from the layout.
+
+        Returns the compiled staff group hint, the encoded staff group and
+        [(zones, measure_numbers), ...] for each system, where zones is
+        [(ulx, uly, lrx, lry, measure index in the system, staff n), ...] for
+        every staff of every measure and measure_numbers is the number of each
+        measure of the system.
+        '''
+
+        sg_hint = compile_hint(sg_hint)
+        if self.verbose:
+            for staff_grp, num_sb in sg_hint.groupings:
+                print "number of staves in system: %d x %d system(s)" % (staff_grp.num_staves, num_sb)
+
+        # there may be hidden staves in a system
+        # make the encoded staff group the largest number of staves in a system
+        final_group = sg_hint.largest_group
+
+        # list of staff bounding boxes within a system
+        staves = [staff_bb[1:] for staff_bb in self.staff_bb]
+
         # parse barline data file [staffnum][barlinenum_ulx]
         barlines = []
-        for i, bar in enumerate(self.bar_bb):
+        for bar in self.bar_bb:
             staff_num = int(bar[0])
             ulx = bar[1]
             try:
@@ -146,66 +406,135 @@ class BarlineDataConverter:
             except IndexError:
                 barlines.append([ulx])
 
+        layout = []
         staff_offset = 0
         n_measure = 1
-        for s_ind, s in enumerate(systems):
-            # measures in a system
-            s_measures = []
-            staff_defs = s.getDescendantsByName('staffDef')
+        for s in sg_hint.systems:
+            zones = []
+            measure_numbers = []
             # for each staff in the system
-            for i in range(len(staff_defs)):
+            for i in range(s.num_staves):
                 staff_num = staff_offset + i
                 s_bb = staves[staff_num]
-                # bounding box of the staff
-                s_ulx = s_bb[0]
-                s_uly = s_bb[1]
-                s_lrx = s_bb[2]
-                s_lry = s_bb[3]
-
-                # for each barline on this staff
                 try:
                     staff_bars = barlines[staff_num]
                 except IndexError:
                     # a staff was found, but no bar candidates have been found on the staff
                     continue
 
+                if len(sg_hint.groupings) == 1 or s.num_staves == final_group.num_staves:
+                    staff_n = i+1
+                else:
+                    # take into consideration hidden staves
+                    staff_n = i + self._calc_staff_num(s.num_staves, [final_group]) + 1
+
                 # for each barline on this staff
                 for n, b in enumerate(staff_bars[:-1]):
-                    # calculate bounding box of the measure
-                    m_uly = s_uly
-                    m_lry = s_lry
-                    m_ulx = b
-                    m_lrx = staff_bars[n+1]
-
-                    zone = self._create_zone(m_ulx, m_uly, m_lrx, m_lry)
-                    surface.addChild(zone)
-                    if len(sg_hint) == 1 or len(staff_defs) == len(final_staff_grp.getDescendantsByName('staffDef')):
-                        staff_n = str(i+1)    
-                    else:
-                        # take into consideration hidden staves
-                        staff_n = i + self._calc_staff_num(len(staff_defs), [final_staff_grp]) + 1
-                    
-                    staff = self._create_staff(staff_n, zone)
-                    #print '  ', staff_n, m_ulx, m_uly, m_lrx, m_lry
-                    try:
-                        s_measures[n].addChild(staff)
-                    except IndexError:
+                    if n == len(measure_numbers):
                         # create a new measure
-                        measure = self._create_measure(str(n_measure))
-                        s_measures.append(measure)
-                        section.addChild(measure)
-                        measure.addChild(staff)
+                        measure_numbers.append(n_measure)
                         n_measure += 1
+                    zones.append((b, s_bb[1], staff_bars[n+1], s_bb[3], n, staff_n))
 
-            # calculate min/max of measure/staff bounding boxes to get measure zone
-            self._calc_measure_zone(s_measures)
+            layout.append((zones, measure_numbers))
+            staff_offset += s.num_staves
+
+        return sg_hint, final_group, layout
+
+    def write_mei(self, output, sg_hint, image_path, image_width, image_height, image_dpi):
+        '''
+        Convert to mei and write it incrementally to a file, without building
+        a pymei document. Only the coordinates and ids of the zones are kept
+        while writing, so the cost is linear in the number of measures.
+
+        PARAMETERS
+        ----------
+        output: output path or file-like object
+        sg_hint: staff group hint, as a string or compiled with staffgroups.compile_hint
+        '''
 
-            staff_offset += len(staff_defs)
+        sg_hint, final_group, layout = self.page_layout(sg_hint)
+        self._ids = id_generator(self._id_strategy, self._id_scope)
+
+        if isinstance(output, basestring):
+            with open(output, 'w') as f:
+                self._write_mei(f, final_group, layout, image_path, image_width, image_height)
+        else:
+            self._write_mei(output, final_group, layout, image_path, image_width, image_height)
+
+    def _write_mei(self, f, final_group, layout, image_path, image_width, image_height):
+        writer = MeiWriter(f, ids=self._ids)
+        writer.start_document()
+        self.write_header(writer)
+
+        writer.start('music')
+
+        # physical location data
+        writer.start('facsimile')
+        zone_ids = self.write_surface(writer, layout, image_path, image_width, image_height)
+        writer.end()
+
+        writer.start('body')
+        writer.start('mdiv')
+        writer.start('score')
+        writer.start('scoreDef')
+        final_group.write_mei(writer)
+        writer.end()
+
+        writer.start('section')
+        self.write_measures(writer, layout, zone_ids)
+        writer.end()
+
+        # score, mdiv, body, music
+        for i in range(4):
+            writer.end()
+        writer.end_document()
+
+    def write_surface(self, writer, layout, image_path, image_width, image_height):
+        '''
+        Write the surface of the page: the zones of the staves of each system
+        followed by the zones of its measures.
+
+        Returns [([staff zone id, ...], [measure zone id, ...]), ...] for each system.
+        '''
+
+        writer.start('surface')
+        writer.element('graphic', [('height', image_height), ('width', image_width),
+                                   ('target', image_path), ('unit', 'px')])
+        zone_ids = []
+        for zones, measure_numbers in layout:
+            staff_zone_ids = [writer.element('zone', [('ulx', ulx), ('uly', uly), ('lrx', lrx), ('lry', lry)])
+                              for ulx, uly, lrx, lry, m, staff_n in zones]
+
+            measure_zone_ids = [writer.element('zone', [('ulx', ulx), ('uly', uly), ('lrx', lrx), ('lry', lry)])
+                                for ulx, uly, lrx, lry in self._measure_bounds(zones)]
+
+            zone_ids.append((staff_zone_ids, measure_zone_ids))
+        writer.end()
+
+        return zone_ids
+
+    def write_measures(self, writer, layout, zone_ids, measure_offset=0):
+        '''
+        Write the measures and system breaks of the page, referring to the zones
+        written by write_surface. The measures are numbered from measure_offset+1.
+        '''
+
+        for s_ind, ((zones, measure_numbers), (staff_zone_ids, measure_zone_ids)) in enumerate(zip(layout, zone_ids)):
+            # staves of each measure, in the order they were laid out
+            measure_staves = [[] for n in measure_numbers]
+            for (ulx, uly, lrx, lry, m, staff_n), zone_id in zip(zones, staff_zone_ids):
+                measure_staves[m].append((staff_n, zone_id))
+
+            for n, zone_id, staves in zip(measure_numbers, measure_zone_ids, measure_staves):
+                writer.start('measure', [('n', measure_offset + n), ('facs', '#'+zone_id)])
+                for staff_n, staff_zone_id in staves:
+                    writer.element('staff', [('n', staff_n), ('facs', '#'+staff_zone_id)])
+                writer.end()
 
             # add a system break, if necessary
-            if s_ind+1 < len(systems):
-                sb = MeiElement('sb')
-                section.addChild(sb)
+            if s_ind+1 < len(layout):
+                writer.element('sb')
 
     def _calc_staff_num(self, num_staves, staff_grps):
         '''
@@ -218,79 +547,71 @@ class BarlineDataConverter:
             # termination condition (or no match found)
             return 0
         else:
-            sg_staves = staff_grps[0].getChildrenByName('staffDef')
-            sgs = staff_grps[0].getChildrenByName('staffGrp')
+            sg_staves = staff_grps[0].staff_defs
+            sgs = staff_grps[0].groups
             if num_staves == len(sg_staves):
                 # no need to look at subsequent staff groups
-                n = int(sg_staves[0].getAttribute('n').value)
+                n = sg_staves[0]
             else:
                 n = self._calc_staff_num(num_staves, sgs)
 
             return n + self._calc_staff_num(num_staves, staff_grps[1:])
         
-    def _calc_measure_zone(self, measures):
+    def _calc_measure_zone(self, measures, zones, surface):
         '''
         Calculate the bounding box of the provided measures
         by calculating the min and max of the bounding boxes
-        of the staves which compose the measure.
-        '''
-
-        # for each measure
-        for m in measures:
-            staff_measure_zones = []
-            min_ulx = sys.maxint
-            min_uly = sys.maxint
-            max_lrx = -sys.maxint - 1
-            max_lry = -sys.maxint - 1
-            for s in m.getChildrenByName('staff'):
-                # have to skip # at the beginning of the id ref since using URIs
-                s_zone = self.meidoc.getElementById(s.getAttribute('facs').value[1:])
-                ulx = int(s_zone.getAttribute('ulx').value)
-                if ulx < min_ulx:
-                    min_ulx = ulx
-
-                uly = int(s_zone.getAttribute('uly').value)
-                if uly < min_uly:
-                    min_uly = uly
-
-                lrx = int(s_zone.getAttribute('lrx').value)
-                if lrx > max_lrx:
-                    max_lrx = lrx
-
-                lry = int(s_zone.getAttribute('lry').value)
-                if lry > max_lry:
-                    max_lry = lry
-
-            m_zone = self._create_zone(min_ulx, min_uly, max_lrx, max_lry)
+        of the staves which compose the measure, from the
+        coordinate table of the staff zones of the system.
+        '''
+
+        for m, (ulx, uly, lrx, lry) in zip(measures, self._measure_bounds(zones)):
+            m_zone = self._create_zone(ulx, uly, lrx, lry)
             m.addAttribute('facs', '#'+m_zone.getId())
-            surface = self.meidoc.getElementsByName('surface')[0]
             surface.addChild(m_zone)
 
+    def _measure_bounds(self, zones):
+        '''
+        Calculate the bounding box (ulx, uly, lrx, lry) of each measure of a system
+        in one pass over the table of its staff zones (see page_layout)
+        '''
+
+        if not zones:
+            return []
+
+        table = np.array([z[:5] for z in zones], dtype=np.int64)
+        # every measure of the system has staves: the groups are the measures in order
+        table = table[np.argsort(table[:, 4], kind='mergesort')]
+        firsts = np.flatnonzero(np.concatenate(([True], table[1:, 4] != table[:-1, 4])))
+        upper_left = np.minimum.reduceat(table[:, :2], firsts)
+        lower_right = np.maximum.reduceat(table[:, 2:4], firsts)
+
+        return np.hstack((upper_left, lower_right)).tolist()
+
     def _create_header(self, rodan_version='0.1'):
         '''
         Create a meiHead element
         '''
 
-        mei_head = MeiElement('meiHead')
-        today = datetime.date.today().isoformat()
+        mei_head = self._create_element('meiHead')
 
         app_name = 'RODAN/barlineFinder'
 
         # file description
-        file_desc = MeiElement('fileDesc')
+        file_desc = self._create_element('fileDesc')
 
-        title_stmt = MeiElement('titleStmt')
-        title = MeiElement('title')
-        resp_stmt = MeiElement('respStmt')
-        corp_name = MeiElement('corpName')
+        title_stmt = self._create_element('titleStmt')
+        title = self._create_element('title')
+        resp_stmt = self._create_element('respStmt')
+        corp_name = self._create_element('corpName')
         corp_name.setValue('Distributed Digital Music Archives and Libraries Lab (DDMAL)')
         title_stmt.addChild(title)
         title_stmt.addChild(resp_stmt)
         resp_stmt.addChild(corp_name)
         
-        pub_stmt = MeiElement('pubStmt')
-        resp_stmt = MeiElement('respStmt')
-        corp_name = MeiElement('corpName')
+        pub_stmt = self._create_element('pubStmt')
+        resp_stmt = self._create_element('respStmt')
+        corp_name = self._create_element('corpName')
         corp_name.setValue('Distributed Digital Music Archives and Libraries Lab (DDMAL)')
         pub_stmt.addChild(resp_stmt)
         resp_stmt.addChild(corp_name)
@@ -300,13 +621,13 @@ class BarlineDataConverter:
         file_desc.addChild(pub_stmt)
 
         # encoding description
-        encoding_desc = MeiElement('encodingDesc')
-        app_info = MeiElement('appInfo')
-        application = MeiElement('application')
+        encoding_desc = self._create_element('encodingDesc')
+        app_info = self._create_element('appInfo')
+        application = self._create_element('application')
         application.addAttribute('version', rodan_version)
-        name = MeiElement('name')
+        name = self._create_element('name')
         name.setValue(app_name)
-        ptr = MeiElement('ptr')
+        ptr = self._create_element('ptr')
         ptr.addAttribute('target', 'https://github.com/DDMAL/barlineFinder')
 
         mei_head.addChild(encoding_desc)
@@ -316,39 +637,103 @@ class BarlineDataConverter:
         application.addChild(ptr)
 
         # revision description
-        revision_desc = MeiElement('revisionDesc')
-        change = MeiElement('change')
+        revision_desc = self._create_element('revisionDesc')
+        change = self._create_element('change')
         change.addAttribute('n', '1')
-        resp_stmt = MeiElement('respStmt')
-        corp_name = MeiElement('corpName')
+        resp_stmt = self._create_element('respStmt')
+        corp_name = self._create_element('corpName')
         corp_name.setValue('Distributed Digital Music Archives and Libraries Lab (DDMAL)')
-        change_desc = MeiElement('changeDesc')
-        ref = MeiElement('ref')
+        change_desc = self._create_element('changeDesc')
+        ref = self._create_element('ref')
         ref.addAttribute('target', '#'+application.getId())
         ref.setValue(app_name)
         ref.setTail('.')
-        p = MeiElement('p')
+        p = self._create_element('p')
         p.addChild(ref)
         p.setValue('Encoded using ')
-        date = MeiElement('date')
-        date.setValue(today)
-        
         mei_head.addChild(revision_desc)
         revision_desc.addChild(change)
         change.addChild(resp_stmt)
         resp_stmt.addChild(corp_name)
         change.addChild(change_desc)
         change_desc.addChild(p)
-        change.addChild(date)
+        if self._date is not None:
+            date = self._create_element('date')
+            date.setValue(self._date)
+            change.addChild(date)
 
         return mei_head
 
+    def write_header(self, writer, rodan_version='0.1'):
+        '''
+        Write the meiHead element of _create_header with a MeiWriter
+        '''
+
+        app_name = 'RODAN/barlineFinder'
+        corp = 'Distributed Digital Music Archives and Libraries Lab (DDMAL)'
+
+        writer.start('meiHead')
+
+        # file description
+        writer.start('fileDesc')
+        writer.start('titleStmt')
+        writer.element('title')
+        writer.start('respStmt')
+        writer.element('corpName', text=corp)
+        writer.end()
+        writer.end()
+        writer.start('pubStmt')
+        writer.start('respStmt')
+        writer.element('corpName', text=corp)
+        writer.end()
+        writer.end()
+        writer.end()
+
+        # encoding description
+        writer.start('encodingDesc')
+        writer.start('appInfo')
+        application_id = writer.start('application', [('version', rodan_version)])
+        writer.element('name', text=app_name)
+        writer.element('ptr', [('target', 'https://github.com/DDMAL/barlineFinder')])
+        writer.end()
+        writer.end()
+        writer.end()
+
+        # revision description
+        writer.start('revisionDesc')
+        writer.start('change', [('n', '1')])
+        writer.start('respStmt')
+        writer.element('corpName', text=corp)
+        writer.end()
+        writer.start('changeDesc')
+        writer.start('p', text='Encoded using ')
+        writer.element('ref', [('target', '#'+application_id)], text=app_name, tail='.')
+        writer.end()
+        writer.end()
+        if self._date is not None:
+            writer.element('date', text=self._date)
+        writer.end()
+        writer.end()
+
+        writer.end()
+
+    def _create_element(self, name):
+        '''
+        Create an element with an id of the id strategy of the converter
+        '''
+
+        element = MeiElement(name)
+        if self._ids is not None:
+            element.setId(self._ids(name))
+
+        return element
+
     def _create_graphic(self, image_path, image_width, image_height):
         '''
         Create a graphic element.
         '''
 
-        graphic = MeiElement('graphic')
+        graphic = self._create_element('graphic')
         graphic.addAttribute('height', str(image_height))
         graphic.addAttribute('width', str(image_width))
         graphic.addAttribute('target', image_path)
@@ -356,42 +741,12 @@ class BarlineDataConverter:
 
         return graphic
 
-    def _create_staff_group(self, sg_list, staff_grp, n):
-        '''
-        Recursively create the staff group element from the parsed
-        user input of the staff groupings
-        '''
-        if not sg_list:
-            return staff_grp, n
-        else:
-            if type(sg_list[0]) is list:
-                new_staff_grp, n = self._create_staff_group(sg_list[0], MeiElement('staffGrp'), n)
-                staff_grp.addChild(new_staff_grp)
-            else:
-                # check for barthrough character
-                if sg_list[0][-1] == '|':
-                    # the barlines go through all the staves in the staff group
-                    staff_grp.addAttribute('barthru', 'true')
-                    # remove the barthrough character, should now only be an integer
-                    sg_list[0] = sg_list[0][:-1]
-
-                n_staff_defs = int(sg_list[0])
-                # get current staffDef number
-                for i in range(n_staff_defs):
-                    staff_def = MeiElement('staffDef')
-                    staff_def.addAttribute('n', str(n+i+1))
-                    staff_def.addAttribute('lines', '5')
-                    staff_grp.addChild(staff_def)
-                n += n_staff_defs
-
-            return self._create_staff_group(sg_list[1:], staff_grp, n)
-
     def _create_staff(self, n, zone):
         '''
         Create a staff element, and attach a zone reference to it
         '''
 
-        staff = MeiElement('staff')
+        staff = self._create_element('staff')
         staff.addAttribute('n', str(n))
         staff.addAttribute('facs', '#'+zone.getId())
 
@@ -405,7 +760,7 @@ class BarlineDataConverter:
         to the MEI.
         '''
 
-        measure = MeiElement('measure')
+        measure = self._create_element('measure')
         measure.addAttribute('n', str(n))
 
         if zone is not None:
@@ -418,7 +773,7 @@ class BarlineDataConverter:
         Create a zone element
         '''
 
-        zone = MeiElement('zone')
+        zone = self._create_element('zone')
         zone.addAttribute('ulx', str(ulx))
         zone.addAttribute('uly', str(uly))
         zone.addAttribute('lrx', str(lrx))
@@ -434,18 +789,146 @@ class BarlineDataConverter:
         # output mei file
         XmlExport.meiDocumentToFile(self.meidoc, output_path)
 
+class BookConverter:
+    '''
+    Converts the barline data of all the pages of a book to a single
+    MEI document, written incrementally in one pass.
+    '''
+
+    def __init__(self, pages, verbose=False, id_strategy='uuid', id_scope='', date=None):
+        '''
+        PARAMETERS
+        ----------
+        pages {list}: [(sg_hint, result), ...] in page order, where result is
+                      (staff_bb, bar_bb, image_path, image_width, image_height, image_dpi)
+                      as returned by BarlineFinder.process_file
+        id_strategy {String}: ids of the generated elements (see meiids.py).
+                              Counter ids are counted over the whole book.
+        id_scope {String}: prefix of the counter ids
+        date {String}: date of the encoding in the header, as for BarlineDataConverter
+        '''
+
+        self.pages = pages
+        self.verbose = verbose
+        self._id_strategy = id_strategy
+        self._id_scope = id_scope
+        self._date = date
+
+    def write_mei(self, output):
+        '''
+        Write the MEI of the book: a surface per page in the facsimile and
+        the measures of every page in a single section, with a page break
+        before each page after the first and continuous measure numbers.
+        The scoreDef is the one of the first page, and a new scoreDef follows
+        the page break of every page whose staff group differs from the one
+        of the previous page.
+
+        PARAMETERS
+        ----------
+        output: output path or file-like object
+        '''
+
+        if not self.pages:
+            raise ValueError('no pages to convert')
+
+        if isinstance(output, basestring):
+            with open(output, 'w') as f:
+                self._write_mei(f)
+        else:
+            self._write_mei(output)
+
+    def _write_mei(self, f):
+        # [(converter, layout, encoded staff group), ...] for each page
+        pages = []
+        for sg_hint, (staff_bb, bar_bb, image_path, image_width, image_height, image_dpi) in self.pages:
+            bar_converter = BarlineDataConverter(staff_bb, bar_bb, self.verbose, self._id_strategy, self._id_scope, self._date)
+            sg_hint, final_group, layout = bar_converter.page_layout(sg_hint)
+            pages.append((bar_converter, layout, final_group))
+
+        writer = MeiWriter(f, ids=id_generator(self._id_strategy, self._id_scope))
+        writer.start_document()
+        pages[0][0].write_header(writer)
+
+        writer.start('music')
+
+        # physical location data of every page
+        writer.start('facsimile')
+        zone_ids = []
+        for (bar_converter, layout, final_group), (sg_hint, result) in zip(pages, self.pages):
+            image_path, image_width, image_height = result[2:5]
+            zone_ids.append(bar_converter.write_surface(writer, layout, image_path, image_width, image_height))
+        writer.end()
+
+        writer.start('body')
+        writer.start('mdiv')
+        writer.start('score')
+        current_group = pages[0][2]
+        writer.start('scoreDef')
+        current_group.write_mei(writer)
+        writer.end()
+
+        writer.start('section')
+        n_measures = 0
+        for p_ind, ((bar_converter, layout, final_group), page_zone_ids) in enumerate(zip(pages, zone_ids)):
+            # add a page break before every page but the first
+            if p_ind > 0:
+                writer.element('pb')
+                # the staves of the page are defined by its own staff group hint
+                if final_group != current_group:
+                    current_group = final_group
+                    writer.start('scoreDef')
+                    current_group.write_mei(writer)
+                    writer.end()
+            bar_converter.write_measures(writer, layout, page_zone_ids, n_measures)
+            n_measures += sum(len(measure_numbers) for zones, measure_numbers in layout)
+        writer.end()
+
+        # score, mdiv, body, music
+        for i in range(4):
+            writer.end()
+        writer.end_document()
+
 if __name__ == "__main__":
     # parse command line arguments
     args = parser.parse_args()
 
-    bar_input_path = args.barfilein
-    staff_input_path = args.stafffilein
-    if not os.path.exists(bar_input_path) or not os.path.exists(staff_input_path):
-        raise ValueError('The input file does not exist')
-
-    output_path = args.fileout
-    sg_hint = args.staffgroups
-    verbose = args.verbose
-    bar_converter = BarlineDataConverter(bar_input_path, staff_input_path, verbose)
-    bar_converter.bardata_to_mei(sg_hint)
-    bar_converter.output_mei(output_path)
+    if args.inputdir is not None:
+        if args.outputdir is not None and not os.path.isdir(args.outputdir):
+            os.makedirs(args.outputdir)
+
+        jobs = find_conversion_jobs(args.inputdir, args.outputdir, args.staffgroups)
+        if args.bookout is not None:
+            # the pages are read in the order of their file names
+            jobs = page_jobs(jobs)
+            book_converter = BookConverter([read_job(job) for job in jobs], args.verbose, args.ids)
+            book_converter.write_mei(args.bookout)
+            print "\nDONE: {0} pages written to {1}".format(len(jobs), args.bookout)
+        else:
+            done = 0
+            failed = 0
+            for job, error in convert_files(jobs, args.workers, args.verbose, args.ids):
+                if error is not None:
+                    print 'FAILED: {0}\n{1}'.format(job[1][0], error.strip().splitlines()[-1])
+                    failed += 1
+                else:
+                    if args.verbose:
+                        print 'DONE: {0}'.format(job[4])
+                    done += 1
+
+            print "\nDONE: {0}\nFAILED: {1}".format(done, failed)
+    else:
+        bar_input_path = args.barfilein
+        staff_input_path = args.stafffilein
+        if bar_input_path is None or staff_input_path is None or \
+                not os.path.exists(bar_input_path) or not os.path.exists(staff_input_path):
+            raise ValueError('The input file does not exist')
+
+        output_path = args.fileout
+        sg_hint = args.staffgroups
+        verbose = args.verbose
+        bar_bb = read_boxes(bar_input_path)
+        staff_bb = read_boxes(staff_input_path)
+        bar_converter = BarlineDataConverter(staff_bb.tolist(), bar_bb.tolist(), verbose, args.ids)
+        # the image is unknown
+        bar_converter.bardata_to_mei(sg_hint, '', 0, 0, 0)
+        bar_converter.output_mei(output_path)
@@ -0,0 +1,65 @@
+"""
+Element id strategies of the generated MEI.
+
+'uuid': random ids, those of pymei ('m-' followed by a UUID).
+'counter': deterministic, compact ids made of the element name and a counter
+           per element name, e.g. 'zone-12', counted from 1 for every
+           generated document (page). An optional scope is prepended to the
+           ids so that the ids of several pages or books can be kept apart.
+           Reruns on the same input produce the same ids.
+
+So that reruns produce byte-identical documents, the date of the
+encoding is only written in the header with counter ids if it is given.
+"""
+
+import datetime
+import uuid
+
+ID_STRATEGIES = ('uuid', 'counter')
+
+def uuid_id(name):
+    '''
+    Random id of an element, in the form of the ids of pymei
+    '''
+
+    return 'm-' + str(uuid.uuid4())
+
+class CounterIds:
+    '''
+    Deterministic ids [scope]name-n, counted per element name
+    '''
+
+    def __init__(self, scope=''):
+        self._scope = scope
+        self._counts = {}
+
+    def __call__(self, name):
+        n = self._counts.get(name, 0) + 1
+        self._counts[name] = n
+
+        return '%s%s-%d' % (self._scope, name, n)
+
+def encoding_date(strategy, date=None):
+    '''
+    Date written in the header of a document generated with the given id
+    strategy: the given date, else today's date with random ids and
+    None (no date) with counter ids
+    '''
+
+    if date is not None or strategy == 'counter':
+        return date
+
+    return datetime.date.today().isoformat()
+
+def id_generator(strategy, scope=''):
+    '''
+    Return a new id generator of the given strategy: a function of the element
+    name returning the id of a new element, or None for the random ids of pymei
+    '''
+
+    if strategy == 'uuid':
+        return None
+    elif strategy == 'counter':
+        return CounterIds(scope)
+    else:
+        raise ValueError('unknown id strategy: %s' % strategy)
@@ -0,0 +1,117 @@
+"""
+Incremental MEI writer.
+
+Writes MEI elements to a file-like object as they are produced, instead of
+building a pymei document tree and serializing it at the end. Elements are
+opened with start() and closed with end(); childless elements and elements
+holding only text are written with element(). Every element gets an xml:id,
+generated by an id strategy of meiids.py (by default random, in the same
+form as pymei's) unless one is given.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+from meiids import uuid_id
+
+MEI_NAMESPACE = 'http://www.music-encoding.org/ns/mei'
+MEI_VERSION = '2013'
+
+class MeiWriter:
+    '''
+    Writes an MEI document element by element
+    '''
+
+    def __init__(self, f, indent='    ', ids=None):
+        '''
+        PARAMETERS
+        ----------
+        f {file}: file-like object to write to
+        indent {String}: indentation of each level of the document
+        ids {function}: id generator (see meiids.id_generator), random ids if None
+        '''
+
+        self._f = f
+        self._ids = ids or uuid_id
+        self._indent = indent
+        # [(name, inside mixed content), ...] of the open elements
+        self._open = []
+        # inside an element with text: children are written inline
+        self._mixed = False
+
+    def new_id(self, name):
+        return self._ids(name)
+
+    def _tag(self, name, attributes, element_id, empty):
+        tag = ['<', name, ' xml:id=', quoteattr(element_id)]
+        for attribute, value in attributes:
+            tag.extend((' ', attribute, '=', quoteattr(str(value))))
+        tag.append('/>' if empty else '>')
+
+        return ''.join(tag)
+
+    def _write(self, markup):
+        if self._mixed:
+            self._f.write(markup)
+        else:
+            self._f.write('\n' + self._indent * len(self._open) + markup)
+
+    def start_document(self, element_id=None):
+        '''
+        Write the XML declaration and open the mei element.
+        Returns the id of the mei element.
+        '''
+
+        self._f.write('<?xml version="1.0" encoding="UTF-8"?>')
+        return self.start('mei', [('xmlns', MEI_NAMESPACE), ('meiversion', MEI_VERSION)], element_id=element_id)
+
+    def end_document(self):
+        '''
+        Close the mei element
+        '''
+
+        self.end()
+        self._f.write('\n')
+
+    def start(self, name, attributes=(), text=None, element_id=None):
+        '''
+        Open an element, with optional text before its first child.
+        Returns the id of the element.
+        '''
+
+        element_id = element_id or self.new_id(name)
+        self._write(self._tag(name, attributes, element_id, False) + escape(text or ''))
+        self._open.append((name, self._mixed))
+        if text is not None:
+            self._mixed = True
+
+        return element_id
+
+    def end(self, tail=None):
+        '''
+        Close the last opened element, with optional tail
+        '''
+
+        name, mixed = self._open.pop()
+        if self._mixed and not mixed:
+            # closing the element whose text started the mixed content
+            self._f.write('</%s>' % name)
+            self._mixed = False
+        else:
+            self._write('</%s>' % name)
+        if tail is not None:
+            self._f.write(escape(tail))
+
+    def element(self, name, attributes=(), text=None, tail=None, element_id=None):
+        '''
+        Write an element without children, with optional text and tail.
+        Returns the id of the element.
+        '''
+
+        element_id = element_id or self.new_id(name)
+        if text is None:
+            markup = self._tag(name, attributes, element_id, True)
+        else:
+            markup = self._tag(name, attributes, element_id, False) + escape(text) + '</%s>' % name
+        self._write(markup + escape(tail or ''))
+
+        return element_id
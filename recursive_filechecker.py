@@ -1,66 +1,106 @@
 from optparse import OptionParser
 import os
+import time
 
-from gamera.core import *
-
-from barfinder import BarlineFinder
+from barfinder import BarlineFinder, PIPELINE_VERSION
 from meicreate import BarlineDataConverter
+from manifest import Manifest, code_version
+
+# modules whose code changes the mei output
+PIPELINE_MODULES = ('barfinder', 'meicreate', 'staffgroups', 'meiwriter', 'meiids', 'runindex', 'intervalindex', 'imageloader')
 
+MANIFEST_FILENAME = 'barfinder_manifest.jsonl'
 
 if __name__ == "__main__":
-    init_gamera()
-    usage = "usage: %prog input_folder output_folder"
+    usage = "usage: %prog [-w workers] [-f] input_folder output_folder"
     opts = OptionParser(usage = usage)
+    opts.add_option('-w', '--workers', type='int', default=None, help='number of worker processes (default: number of cores)')
+    opts.add_option('-f', '--force', action='store_true', default=False, help='process every page, even those whose output is up to date')
+    opts.add_option('-m', '--manifest', default=None, help='manifest of the outputs (default: %s in the output folder)' % MANIFEST_FILENAME)
+    opts.add_option('-b', '--book', default=None, help='write every page, in the order of their paths, to this single MEI file in the output folder instead of an MEI file per page')
     options, args = opts.parse_args()
 
     input_folder = args[0]
     output_folder = args[1]
     done = 0
     failed = 0
-
-    
-
-
-    for dirpath, dirnames, filenames in os.walk(args[0]):
-        for f in filenames[:]:
-            fullPath = os.path.join(input_folder, f)
+    skipped = 0
+
+    def log_failure(f, e):
+        print 'FAILED: {0}\n'.format(f)
+        log_file = open('filechecker_output_log.txt', 'a')
+        log_file.write('\t'.join([f, str(e), '\n']))
+        log_file.close()
+
+    noborderremove = True
+    norotation = False
+
+    bar_finder = BarlineFinder()
+
+    # the outputs of a previous run are reused if the image, the staff group hint,
+    # the parameters and the code that produced them are unchanged
+    params = bar_finder.output_params()
+    params.update({'noborderremove': noborderremove, 'norotation': norotation})
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    manifest_path = options.manifest or os.path.join(output_folder, MANIFEST_FILENAME)
+    manifest = Manifest(manifest_path, code_version(PIPELINE_VERSION, PIPELINE_MODULES), params)
+
+    start = time.time()
+    jobs = []
+    # fingerprints of the images to process, recorded once their output is written
+    fingerprints = {}
+    for dirpath, dirnames, filenames in os.walk(input_folder):
+        # walk the directories in order, which is the order of the pages of a book
+        dirnames.sort()
+        for f in sorted(filenames):
+            fullPath = os.path.join(dirpath, f)
             fileName, fileExtension = os.path.splitext(fullPath)
+            if fileExtension != ".tiff":
+                continue
             # print fileName, fileExtension
             output_mei_file = os.path.join(output_folder, os.path.splitext(f)[0] + '_ao.mei')
 
-            if fileExtension == ".tiff" and os.path.isfile(output_mei_file) is not True:
-                print "IMAGE TIFF :{0}".format(f)
-
             try:
                 txt_file = open(os.path.join(fileName + '.txt'), 'rb')
                 sg_hint = txt_file.readlines()[0]
-                
-
-                noborderremove = '-nb'
-                norotation = ''
-                verbose = ''
-
-                bar_finder = BarlineFinder()
-                staff_bb, bar_bb, image_path, image_width, image_height, image_dpi = bar_finder.process_file(fullPath, sg_hint, noborderremove, norotation)
-                # print 'STAFF_BB:{0}\nBAR_BB:{1}'.format(staff_bb, bar_bb)
-                bar_converter = BarlineDataConverter(staff_bb, bar_bb, verbose)
-                bar_converter.bardata_to_mei(sg_hint, image_path, image_width, image_height, image_dpi)
-                bar_converter.output_mei(output_mei_file)
-                print 'DONE!\n'
-                done += 1
-                
+                txt_file.close()
             except Exception, e:
-                print 'FAILED!\n'
-                log_file = open('filechecker_output_log.txt', 'a')
-                log_file.write('\t'.join([f, str(e), '\n']))
-                log_file.close()
+                log_failure(f, e)
                 failed += 1
                 continue
 
-    print "\nDONE: {0}\nFAILED: {1}".format(done, failed)
-
+            # a book is written from the results of all of its pages
+            if options.book is None:
+                up_to_date, fingerprint = manifest.check(output_mei_file, fullPath, sg_hint)
+                if up_to_date and not options.force:
+                    skipped += 1
+                    continue
+                fingerprints[output_mei_file] = fingerprint
+
+            print "IMAGE TIFF :{0}".format(f)
+            jobs.append((fullPath, sg_hint, output_mei_file, noborderremove, norotation))
+
+    print "{0} pages to process, {1} up to date ({2:.1f}s)".format(len(jobs), skipped, time.time() - start)
+
+    # the pages are processed in parallel, each worker writes the mei of its pages
+    # or returns the results of its pages for the book
+    if jobs:
+        if options.book is not None:
+            results = bar_finder.process_book(jobs, os.path.join(output_folder, options.book), options.workers)
+        else:
+            results = bar_finder.process_files(jobs, options.workers)
+        for job, result, error in results:
+            f = os.path.basename(job[0])
+            if error is not None:
+                log_failure(f, error.strip().splitlines()[-1])
+                failed += 1
+            else:
+                if options.book is None:
+                    manifest.record(job[2], job[0], job[1], fingerprints[job[2]])
+                print 'DONE: {0}\n'.format(f)
+                done += 1
 
-            # except:
-            #     print 'PROBLEM WITH FILE: {0}\n'.format(fullPath)
-            #     continue
+    manifest.compact()
 
+    print "\nDONE: {0}\nSKIPPED: {1}\nFAILED: {2}".format(done, skipped, failed)
@@ -0,0 +1,209 @@
+"""
+Column-wise run-length index of the black pixels of a page.
+
+The vertical black runs of a onebit raster are extracted once with numpy and
+kept as (column, start, length) arrays sorted by column and start. Short run
+filtering, the connected components of the runs (8-connectivity), despeckling
+and the bounding boxes of the components are then answered from the runs
+instead of from repeated passes over the raster. The most frequent run length
+is left to gamera: it is measured on the page before staffline removal, which
+is only read once.
+Once the short runs are filtered out only the tall, thin strokes that make up
+barline candidates are left, so the index is much smaller than the raster.
+"""
+
+import numpy as np
+
+def _group_reduce(groups, values, ufunc):
+    '''
+    Reduce the values of each group with a ufunc.
+    Returns the groups present, in ascending order, and their reduced values.
+    '''
+
+    order = np.argsort(groups, kind='mergesort')
+    groups = groups[order]
+    firsts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+
+    return groups[firsts], ufunc.reduceat(values[order], firsts)
+
+class VerticalRunIndex:
+    '''
+    Vertical black runs of a raster
+    '''
+
+    def __init__(self, shape, cols, starts, lengths):
+        '''
+        PARAMETERS
+        ----------
+        shape {tuple}: (nrows, ncols) of the raster
+        cols {ndarray}: column of each run
+        starts {ndarray}: first row of each run
+        lengths {ndarray}: number of pixels of each run
+        '''
+
+        self.shape = shape
+        self.cols = cols
+        self.starts = starts
+        self.lengths = lengths
+        # component of each run and number of components, computed on demand
+        self._labels = None
+        self._num_components = None
+
+    @staticmethod
+    def from_array(black):
+        '''
+        Build the index of a 2D array that is nonzero where the pixels are black
+        '''
+
+        nrows, ncols = black.shape
+        # pad each column with white so that every run has a start and an end
+        columns = np.zeros((ncols, nrows + 2), dtype=np.int8)
+        columns[:, 1:-1] = np.asarray(black).T != 0
+        edges = np.diff(columns, axis=1)
+        # nonzero scans the columns in order, and each column top to bottom
+        cols, starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+
+        return VerticalRunIndex((nrows, ncols), cols.astype(np.int32), starts.astype(np.int32),
+                                (ends - starts).astype(np.int32))
+
+    @staticmethod
+    def from_image(image):
+        '''
+        Build the index of a onebit gamera image, in the coordinates of the image
+        (the upper left pixel of the image is at (0, 0))
+        '''
+
+        return VerticalRunIndex.from_array(image.to_numpy())
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _subset(self, keep):
+        return VerticalRunIndex(self.shape, self.cols[keep], self.starts[keep], self.lengths[keep])
+
+    def filter_short_runs(self, length):
+        '''
+        Return the index without the runs shorter than length
+        '''
+
+        return self._subset(self.lengths >= length)
+
+    def components(self):
+        '''
+        Label the 8-connected components of the runs.
+        Returns the component of each run and the number of components.
+        '''
+
+        if self._labels is not None:
+            return self._labels, self._num_components
+
+        n = len(self)
+        ends = self.starts + self.lengths - 1
+
+        # runs in adjacent columns are connected if they overlap or touch diagonally.
+        # the runs are sorted by column then by row and do not overlap within a
+        # column, so the runs of column c+1 touching a run of column c are found
+        # with two binary searches on global (column, row) keys
+        stride = self.shape[0] + 2
+        key_starts = self.cols.astype(np.int64) * stride + self.starts
+        key_ends = self.cols.astype(np.int64) * stride + ends
+        next_col = (self.cols.astype(np.int64) + 1) * stride
+        lo = np.searchsorted(key_ends, next_col + self.starts - 1, side='left')
+        hi = np.searchsorted(key_starts, next_col + ends + 1, side='right')
+        counts = np.maximum(hi - lo, 0)
+        a = np.repeat(np.arange(n), counts)
+        b = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+        # propagate the smallest run index through the edges until it is stable
+        ends_a = np.concatenate((a, b))
+        ends_b = np.concatenate((b, a))
+        order = np.argsort(ends_a, kind='mergesort')
+        ends_a = ends_a[order]
+        ends_b = ends_b[order]
+        firsts = np.flatnonzero(np.concatenate(([True], ends_a[1:] != ends_a[:-1]))) if len(ends_a) else ends_a
+        runs = ends_a[firsts]
+
+        labels = np.arange(n)
+        while len(runs):
+            # smallest label among the neighbours of each run
+            neighbour_min = np.minimum.reduceat(labels[ends_b], firsts)
+            updated = np.minimum(labels[runs], neighbour_min)
+            if np.array_equal(updated, labels[runs]):
+                break
+            # hook the roots onto the smallest label, then pointer jumping
+            labels[labels[runs]] = np.minimum(labels[labels[runs]], updated)
+            labels[runs] = np.minimum(labels[runs], updated)
+            while True:
+                jumped = labels[labels]
+                if np.array_equal(jumped, labels):
+                    break
+                labels = jumped
+
+        roots, self._labels = np.unique(labels, return_inverse=True)
+        self._num_components = len(roots)
+
+        return self._labels, self._num_components
+
+    def despeckle(self, size):
+        '''
+        Return the index without the components of fewer than size pixels
+        '''
+
+        labels, num_components = self.components()
+        area = np.bincount(labels, weights=self.lengths, minlength=num_components)
+        keep = area[labels] >= size
+
+        # removing whole components leaves the others intact: keep their labels
+        despeckled = self._subset(keep)
+        kept_components, despeckled._labels = np.unique(labels[keep], return_inverse=True)
+        despeckled._num_components = len(kept_components)
+
+        return despeckled
+
+    def component_bboxes(self):
+        '''
+        Return the bounding boxes [(x, y, ncols, nrows), ...] of the components,
+        in the order of their first pixel in a row by row scan of the raster,
+        which is the order of the connected component analysis of gamera
+        '''
+
+        labels, num_components = self.components()
+        if not num_components:
+            return []
+
+        # every label from 0 to num_components - 1 has runs
+        ends = self.starts + self.lengths - 1
+        _, x1 = _group_reduce(labels, self.cols, np.minimum)
+        _, y1 = _group_reduce(labels, self.starts, np.minimum)
+        _, x2 = _group_reduce(labels, self.cols, np.maximum)
+        _, y2 = _group_reduce(labels, ends, np.maximum)
+
+        # first pixel of each component: leftmost run starting on its top row
+        top = self.starts == y1[labels]
+        _, first_x = _group_reduce(labels[top], self.cols[top], np.minimum)
+        order = np.lexsort((first_x, y1))
+
+        return list(zip(x1[order].tolist(), y1[order].tolist(),
+                        (x2 - x1 + 1)[order].tolist(), (y2 - y1 + 1)[order].tolist()))
+
+    def to_array(self, dtype=np.uint16):
+        '''
+        Render the runs as a raster, 1 where black
+        '''
+
+        nrows, ncols = self.shape
+        # +1 at the start and -1 after the end of each run, summed down each column
+        columns = np.zeros((ncols, nrows + 1), dtype=np.int32)
+        np.add.at(columns, (self.cols, self.starts), 1)
+        np.add.at(columns, (self.cols, self.starts + self.lengths), -1)
+
+        return np.ascontiguousarray(np.cumsum(columns[:, :-1], axis=1).T.astype(dtype))
+
+    def to_image(self):
+        '''
+        Render the runs as a onebit gamera image
+        '''
+
+        from gamera.plugins import numeric_io
+        return numeric_io.from_numpy(self.to_array())
@@ -0,0 +1,144 @@
+"""
+Compact result files written next to the MEI output.
+
+The staff bounding boxes and numbered bars returned by
+BarlineFinder.process_file are saved as integer arrays along with the page
+metadata (image path, width, height and resolution), so that downstream tools
+can read the results of a page without parsing its MEI. Two formats are
+supported, chosen by the extension of the file:
+
+.bfr: a fixed-layout columnar file, read with a single read and no parsing:
+      a 32 byte header (magic, format version, width, height, dpi, number of
+      staves, number of bars, length of the image path), the five int32
+      columns (staff_no, x1, y1, x2, y2) of the staves, the five columns of
+      the bars and the utf-8 image path. All integers are little-endian.
+.npz: an uncompressed NumPy archive holding the same arrays, for tools that
+      prefer a standard container.
+
+usage:
+from sidecar import read_results
+page = read_results('mei/C_07a_ED-Kl_1_A-Wn_SHWeber90_S_009.bfr')
+page.bar_bb[:, 1]    # x of the left edge of every bar
+"""
+
+import os
+import struct
+
+import numpy as np
+
+# extension of each sidecar format
+SIDECAR_FORMATS = {
+    'bfr': '.bfr',
+    'npz': '.npz'
+}
+
+# version of the layout of the arrays in the files
+FORMAT_VERSION = 1
+
+_MAGIC = 'BFR\0'
+# magic, version, reserved, width, height, dpi, staves, bars, image path bytes
+_HEADER = struct.Struct('<4sHHiiiIII')
+_COLUMNS = 5
+
+def sidecar_path(output_file, sidecar_format='bfr'):
+    '''
+    Path of the sidecar file of an MEI output file
+    '''
+
+    return os.path.splitext(output_file)[0] + SIDECAR_FORMATS[sidecar_format]
+
+class PageResults:
+    '''
+    Results of a page as read from a sidecar file
+    '''
+
+    def __init__(self, staff_bb, bar_bb, image_path, image_width, image_height, image_dpi):
+        '''
+        PARAMETERS
+        ----------
+        staff_bb {ndarray}: staff bounding boxes, one row [staff_no, x1, y1, x2, y2] per staff
+        bar_bb {ndarray}: numbered bars, one row [staff_no, x1, y1, x2, y2] per bar
+        image_path {String}: path of the preprocessed image
+        image_width {int}: width of the preprocessed image
+        image_height {int}: height of the preprocessed image
+        image_dpi {int}: resolution of the image in the x dimension
+        '''
+
+        self.staff_bb = staff_bb
+        self.bar_bb = bar_bb
+        self.image_path = image_path
+        self.image_width = image_width
+        self.image_height = image_height
+        self.image_dpi = image_dpi
+
+    def to_result(self):
+        '''
+        Return the results in the form returned by BarlineFinder.process_file
+        '''
+
+        return (self.staff_bb.tolist(), [tuple(b) for b in self.bar_bb.tolist()], self.image_path,
+                self.image_width, self.image_height, self.image_dpi)
+
+def _boxes(boxes):
+    return np.asarray(boxes, dtype=np.int32).reshape(-1, _COLUMNS)
+
+def _format(path):
+    extension = os.path.splitext(path)[1]
+    for sidecar_format, format_extension in SIDECAR_FORMATS.items():
+        if extension == format_extension:
+            return sidecar_format
+    raise ValueError('unknown sidecar format: %s' % path)
+
+def write_results(path, staff_bb, bar_bb, image_path, image_width, image_height, image_dpi):
+    '''
+    Write the results of a page to a sidecar file, in the format of its extension
+    '''
+
+    staff_bb = _boxes(staff_bb)
+    bar_bb = _boxes(bar_bb)
+    if isinstance(image_path, unicode):
+        image_path = image_path.encode('utf-8')
+
+    with open(path, 'wb') as f:
+        if _format(path) == 'npz':
+            np.savez(f, staff_bb=staff_bb, bar_bb=bar_bb,
+                     meta=np.array([FORMAT_VERSION, image_width, image_height, image_dpi], dtype=np.int64),
+                     image_path=np.array(image_path))
+        else:
+            f.write(_HEADER.pack(_MAGIC, FORMAT_VERSION, 0, image_width, image_height, image_dpi,
+                                 len(staff_bb), len(bar_bb), len(image_path)))
+            # column by column
+            f.write(staff_bb.T.astype('<i4').tostring())
+            f.write(bar_bb.T.astype('<i4').tostring())
+            f.write(image_path)
+
+def read_results(path):
+    '''
+    Read the results of a page from a sidecar file, in the format of its extension.
+    The bounding boxes of a .bfr file are read-only views of the file contents.
+    '''
+
+    if _format(path) == 'npz':
+        with np.load(path) as npz:
+            version, image_width, image_height, image_dpi = npz['meta'].tolist()
+            if version != FORMAT_VERSION:
+                raise ValueError('unsupported sidecar format version %d in %s' % (version, path))
+            return PageResults(npz['staff_bb'], npz['bar_bb'], str(npz['image_path']),
+                               image_width, image_height, image_dpi)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, _, image_width, image_height, image_dpi, num_staves, num_bars, path_length = \
+        _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != FORMAT_VERSION:
+        raise ValueError('not a version %d sidecar file: %s' % (FORMAT_VERSION, path))
+
+    offset = _HEADER.size
+    staff_bb = np.frombuffer(data, '<i4', _COLUMNS * num_staves, offset).reshape(_COLUMNS, num_staves).T
+    offset += 4 * _COLUMNS * num_staves
+    bar_bb = np.frombuffer(data, '<i4', _COLUMNS * num_bars, offset).reshape(_COLUMNS, num_bars).T
+    offset += 4 * _COLUMNS * num_bars
+    image_path = data[offset:offset + path_length]
+
+    return PageResults(staff_bb, bar_bb, image_path, image_width, image_height, image_dpi)
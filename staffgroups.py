@@ -0,0 +1,191 @@
+"""
+Compiled staff group hints.
+
+A staff group hint such as '(2|)x2 (4(2|))' describes the staff groups of each
+system of a page: nested parentheses are nested staff groups, numbers are
+staves, '|' marks barlines going through all the staves of a group and 'xN'
+repeats a grouping over N systems. The hint is parsed once into a
+StaffGroupHint, cached by hint string, and shared by the barline finder and the
+MEI converter. The MEI staffGrp of a group is instantiated from a flat template
+compiled with the group.
+"""
+
+import re
+
+class StaffGroup:
+    '''
+    A compiled staff group
+    '''
+
+    def __init__(self):
+        # staff numbers and nested StaffGroups, in order
+        self.children = []
+        # the barlines go through all the staves in the staff group
+        self.barthru = False
+
+    @property
+    def staff_defs(self):
+        '''
+        Numbers of the staves directly in this group
+        '''
+
+        return [c for c in self.children if not isinstance(c, StaffGroup)]
+
+    @property
+    def groups(self):
+        '''
+        Staff groups directly in this group
+        '''
+
+        return [c for c in self.children if isinstance(c, StaffGroup)]
+
+    def __eq__(self, other):
+        '''
+        Staff groups are equal if they encode the same staffGrp
+        '''
+
+        return isinstance(other, StaffGroup) and self._template == other._template
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _compile(self):
+        '''
+        Count the staves of the group and flatten it into a template of
+        [(parent index, element name, [(attribute, value), ...]), ...]
+        listing every element after its parent and the children of every element in order
+        '''
+
+        self._template = []
+        self._flatten(self, -1)
+        self.num_staves = sum(1 for parent, name, attributes in self._template if name == 'staffDef')
+
+    def _flatten(self, group, parent):
+        index = len(self._template)
+        attributes = [('barthru', 'true')] if group.barthru else []
+        self._template.append((parent, 'staffGrp', attributes))
+        for child in group.children:
+            if isinstance(child, StaffGroup):
+                self._flatten(child, index)
+            else:
+                self._template.append((index, 'staffDef', [('n', str(child)), ('lines', '5')]))
+
+    def to_mei(self, ids=None):
+        '''
+        Create the MEI staffGrp element of the group from its template,
+        with the ids of an id generator (see meiids.id_generator) if given
+        '''
+
+        from pymei import MeiElement
+
+        elements = []
+        for parent, name, attributes in self._template:
+            element = MeiElement(name)
+            if ids is not None:
+                element.setId(ids(name))
+            for attribute, value in attributes:
+                element.addAttribute(attribute, value)
+            if parent >= 0:
+                elements[parent].addChild(element)
+            elements.append(element)
+
+        return elements[0]
+
+    def write_mei(self, writer):
+        '''
+        Write the MEI staffGrp element of the group from its template
+        with a meiwriter.MeiWriter
+        '''
+
+        # template indices of the open staffGrps
+        open_groups = []
+        for index, (parent, name, attributes) in enumerate(self._template):
+            while open_groups and open_groups[-1] != parent:
+                writer.end()
+                open_groups.pop()
+            if name == 'staffGrp':
+                writer.start(name, attributes)
+                open_groups.append(index)
+            else:
+                writer.element(name, attributes)
+
+        for index in open_groups:
+            writer.end()
+
+def _compile_group(sg_list, n):
+    '''
+    Compile the parsed list of a staff group whose first staff is numbered n+1.
+    Returns the group and the number of the last staff in it.
+    '''
+
+    group = StaffGroup()
+    for item in sg_list:
+        if type(item) is list:
+            child, n = _compile_group(item, n)
+            group.children.append(child)
+        else:
+            # check for barthrough character
+            if item[-1] == '|':
+                group.barthru = True
+                item = item[:-1]
+            n_staff_defs = int(item)
+            group.children.extend(range(n+1, n+n_staff_defs+1))
+            n += n_staff_defs
+
+    return group, n
+
+class StaffGroupHint:
+    '''
+    A parsed staff group hint
+    '''
+
+    def __init__(self, hint):
+        '''
+        PARAMETERS
+        ----------
+        hint {String}: staff group hint, groupings of systems separated by spaces
+        '''
+
+        from pyparsing import nestedExpr
+
+        self.hint = hint
+        # [(StaffGroup, number of systems), ...] for each grouping in the hint
+        self.groupings = []
+        for s in hint.split(' '):
+            sg_list = nestedExpr().parseString(s).asList()[0]
+            group, n = _compile_group(sg_list, 0)
+            group._compile()
+
+            # parse repeating staff groups (systems)
+            num_sb = 1
+            match = re.search('(?<=x)(\d+)$', s)
+            if match is not None:
+                # there are multiple systems of this staff grouping
+                num_sb = int(match.group(0))
+
+            self.groupings.append((group, num_sb))
+
+        # staff group of each system
+        self.systems = [group for group, num_sb in self.groupings for i in range(num_sb)]
+        # system number (from 1) of each staff
+        self.staff_systems = [i+1 for i, group in enumerate(self.systems) for j in range(group.num_staves)]
+        # there may be hidden staves in a system:
+        # the group of the system with the most staves is the one encoded
+        self.largest_group = max(self.systems, key=lambda group: group.num_staves)
+
+# compiled hints by hint string
+_compiled_hints = {}
+
+def compile_hint(hint):
+    '''
+    Return the compiled staff group hint of a hint string, parsing
+    it only the first time. Compiled hints are returned as they are.
+    '''
+
+    if isinstance(hint, StaffGroupHint):
+        return hint
+
+    if hint not in _compiled_hints:
+        _compiled_hints[hint] = StaffGroupHint(hint)
+
+    return _compiled_hints[hint]
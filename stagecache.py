@@ -0,0 +1,248 @@
+"""
+Content-addressed on-disk cache for the intermediate outputs of the
+stages of BarlineFinder.process_file.
+
+Each cache entry is a directory named by a hash of the input file contents,
+the pipeline version and the parameters of the stage and of every stage that
+precedes it. An entry holds a pickled dictionary of plain values and any number
+of gamera images saved as TIFF. Least recently used entries are evicted once
+the cache grows past its size limit. The size of the cache is tracked as
+entries are stored and the cache directory is only scanned when the size
+goes over the limit, or every SCAN_INTERVAL stored entries to account for the
+entries stored by other processes sharing the cache.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+class StageCache:
+    '''
+    On-disk cache of stage outputs, keyed by input hash, stage parameters
+    and pipeline version.
+    '''
+
+    META_FILENAME = 'meta.pickle'
+    # number of stored entries after which the size of the cache is rescanned
+    SCAN_INTERVAL = 64
+    # eviction frees space down to this fraction of max_bytes
+    # so that the next stored entries do not trigger another scan
+    EVICT_TO = 0.9
+
+    def __init__(self, cache_dir, version, max_bytes=2*1024**3):
+        '''
+        PARAMETERS
+        ----------
+        cache_dir {String}: root directory of the cache, created if necessary
+        version {String}: pipeline version, entries of other versions never match
+        max_bytes {int}: size of the cache after which old entries are evicted
+        '''
+
+        self._cache_dir = cache_dir
+        self._version = version
+        self._max_bytes = max_bytes
+        # file hashes already computed in this process: (path, size, mtime) -> hash
+        self._file_hashes = {}
+        # size of the cache at the last scan plus the entries stored since, None before the first scan
+        self._total_bytes = None
+        self._puts_since_scan = 0
+
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+    def file_hash(self, path):
+        '''
+        Calculate the sha1 hash of the contents of the given file
+        '''
+
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_size, st.st_mtime)
+        if stamp not in self._file_hashes:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            self._file_hashes[stamp] = sha.hexdigest()
+
+        return self._file_hashes[stamp]
+
+    def stage_keys(self, input_hash, stages):
+        '''
+        Calculate the cache key of each stage of a pipeline. The key of a stage
+        covers the input hash, the pipeline version and the parameters of the
+        stage and of all preceding stages.
+
+        PARAMETERS
+        ----------
+        input_hash {String}: hash of the input file contents
+        stages {list}: [(stage_name, stage_params), ...] in pipeline order
+        '''
+
+        keys = []
+        key = hashlib.sha1('%s:%s' % (self._version, input_hash)).hexdigest()
+        for name, params in stages:
+            key = hashlib.sha1('%s:%s:%r' % (key, name, params)).hexdigest()
+            keys.append(key)
+
+        return keys
+
+    def deepest(self, keys):
+        '''
+        Return the index of the deepest stage in the list of stage keys
+        such that it and every preceding stage have a cache entry, or -1 if there is none.
+        '''
+
+        deepest = -1
+        for i, key in enumerate(keys):
+            if not self.has(key):
+                break
+            deepest = i
+
+        return deepest
+
+    def load(self, keys):
+        '''
+        Read the entries of the stages up to the deepest one found by deepest().
+        An entry may be evicted by another process between the lookup and the
+        read, in which case only the stages before it are resumed.
+
+        Returns the index of the deepest stage read, or -1 if there is none,
+        and the list of the values of the entries read, in stage order.
+        '''
+
+        values = []
+        for key in keys[:self.deepest(keys)+1]:
+            entry = self.get(key)
+            if entry is None:
+                break
+            values.append(entry)
+
+        return len(values) - 1, values
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._entry_path(key), self.META_FILENAME))
+
+    def get(self, key):
+        '''
+        Return the dictionary of values stored for the given key,
+        or None on a cache miss.
+        '''
+
+        entry_path = self._entry_path(key)
+        try:
+            with open(os.path.join(entry_path, self.META_FILENAME), 'rb') as f:
+                values = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        return values
+
+    def get_image(self, key, name):
+        '''
+        Load an image stored for the given key
+        '''
+
+        from gamera.core import load_image
+        return load_image(os.path.join(self._entry_path(key), name + '.tiff'))
+
+    def put(self, key, values, images=None):
+        '''
+        Store the outputs of a stage.
+
+        PARAMETERS
+        ----------
+        key {String}: stage key from stage_keys
+        values {dict}: picklable stage outputs
+        images {dict}: gamera images produced by the stage {name: image}
+        '''
+
+        entry_path = self._entry_path(key)
+        if self.has(key):
+            return
+
+        # write to a temporary directory then move it in place so that
+        # concurrent readers never see a partial entry
+        parent = os.path.dirname(entry_path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # another process created it first
+                pass
+        tmp_path = tempfile.mkdtemp(prefix='.tmp', dir=parent)
+        try:
+            if images:
+                for name, image in images.items():
+                    image.save_tiff(os.path.join(tmp_path, name + '.tiff'))
+            with open(os.path.join(tmp_path, self.META_FILENAME), 'wb') as f:
+                pickle.dump(values, f, pickle.HIGHEST_PROTOCOL)
+            size = self._entry_size(tmp_path)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        self._puts_since_scan += 1
+        if self._total_bytes is not None:
+            self._total_bytes += size
+        if self._total_bytes is None or self._total_bytes > self._max_bytes or \
+                self._puts_since_scan >= self.SCAN_INTERVAL:
+            self._evict()
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_dir, key[:2], key)
+
+    def _entry_size(self, entry_path):
+        return sum(os.path.getsize(os.path.join(entry_path, f)) for f in os.listdir(entry_path))
+
+    def _evict(self):
+        '''
+        Scan the size of the cache and, if it does not fit in max_bytes, remove
+        least recently used entries until it fits in EVICT_TO of max_bytes
+        '''
+
+        entries = []
+        total_bytes = 0
+        try:
+            prefixes = os.listdir(self._cache_dir)
+        except OSError:
+            prefixes = []
+        for prefix in prefixes:
+            prefix_path = os.path.join(self._cache_dir, prefix)
+            try:
+                keys = os.listdir(prefix_path)
+            except OSError:
+                # not a directory
+                continue
+            for key in keys:
+                if key.startswith('.'):
+                    # entry still being written
+                    continue
+                entry_path = os.path.join(prefix_path, key)
+                try:
+                    size = self._entry_size(entry_path)
+                    entries.append((os.path.getmtime(entry_path), size, entry_path))
+                except OSError:
+                    # evicted by another process during the scan
+                    continue
+                total_bytes += size
+
+        entries.sort()
+        target_bytes = self._max_bytes if total_bytes <= self._max_bytes else self.EVICT_TO * self._max_bytes
+        for mtime, size, entry_path in entries:
+            if total_bytes <= target_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= size
+
+        self._total_bytes = total_bytes
+        self._puts_since_scan = 0
@@ -0,0 +1,210 @@
+"""
+Synthetic music score pages with a known layout.
+
+Renders pages of staves, barlines and notes with numpy, with optional noise
+and skew, and writes them in the layout of the evaluation dataset (see
+evaluate.py): one directory per page holding the image, the staff group hint
+and the ground-truth MEI.
+
+usage:
+python synthscore.py -n 10 -s 4 --dpi 300 --noise 0.001 --skew 0.5 data/synthetic
+python evaluate.py data/synthetic -v
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+import imageloader
+
+# page sizes in inches
+PAGE_SIZES = {
+    'letter': (8.5, 11.0),
+    'a4': (8.27, 11.69),
+    'a3': (11.69, 16.54),
+}
+
+# set up command line argument structure
+parser = argparse.ArgumentParser(description='Render synthetic music score pages with ground-truth MEI.')
+parser.add_argument('dataroot', help='output directory, one subdirectory per page')
+parser.add_argument('-n', '--pages', help='number of pages', type=int, default=10)
+parser.add_argument('-s', '--staves', help='staves per system', type=int, default=4)
+parser.add_argument('-nb', '--nobarthru', help='draw barlines through each staff separately', action='store_true')
+parser.add_argument('-p', '--pagesize', help='page size', choices=sorted(PAGE_SIZES), default='letter')
+parser.add_argument('-m', '--measures', help='measures per system', type=int, default=4)
+parser.add_argument('-d', '--notes', help='notes per measure and staff', type=int, default=4)
+parser.add_argument('--dpi', help='resolution of the pages', type=int, default=300)
+parser.add_argument('--noise', help='fraction of flipped pixels', type=float, default=0.0)
+parser.add_argument('--skew', help='skew of the pages in degrees', type=float, default=0.0)
+parser.add_argument('--seed', help='seed of the first page', type=int, default=0)
+
+class SyntheticPage:
+    '''
+    A rendered page and its ground truth
+    '''
+
+    def __init__(self, black, dpi, sg_hint, staff_bb, bar_bb):
+        '''
+        PARAMETERS
+        ----------
+        black {ndarray}: page pixels, 1 where black
+        dpi {int}: resolution of the page
+        sg_hint {String}: staff group hint of the page
+        staff_bb {list}: staff bounding boxes [[staff_no, x1, y1, x2, y2], ...]
+        bar_bb {list}: bars of each staff [(staff_no, x1, y1, x2, y2), ...]
+                       sorted by staff and x, as output by BarlineFinder
+        '''
+
+        self.black = black
+        self.dpi = dpi
+        self.sg_hint = sg_hint
+        self.staff_bb = staff_bb
+        self.bar_bb = bar_bb
+
+    @property
+    def width(self):
+        return self.black.shape[1]
+
+    @property
+    def height(self):
+        return self.black.shape[0]
+
+def render_page(staves_per_system=4, barthru=True, page_size=PAGE_SIZES['letter'], dpi=300,
+                measures_per_system=4, notes_per_measure=4, noise=0.0, skew=0.0, seed=None):
+    '''
+    Render a page filled with systems of the given number of staves.
+
+    PARAMETERS
+    ----------
+    staves_per_system {int}: number of staves in each system
+    barthru {bool}: barlines go through all the staves of a system
+    page_size {tuple}: (width, height) of the page in inches
+    dpi {int}: resolution of the page
+    measures_per_system {int}: number of measures in each system
+    notes_per_measure {int}: number of notes in each measure of each staff
+    noise {float}: fraction of pixels flipped at random
+    skew {float}: vertical shear of the page in degrees; the ground truth
+                  is that of the page before the shear
+    seed {int}: seed of the random layout and noise
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    width = int(page_size[0] * dpi)
+    height = int(page_size[1] * dpi)
+    black = np.zeros((height, width), dtype=np.uint8)
+
+    # staff metrics
+    space = max(int(round(0.07 * dpi)), 4)
+    line = max(int(round(dpi / 200.0)), 1)
+    staff_height = 4 * space + line
+    staff_gap = 2 * staff_height
+    system_gap = 3 * staff_height
+    margin = int(0.75 * dpi)
+
+    system_height = staves_per_system * staff_height + (staves_per_system - 1) * staff_gap
+    num_systems = (height - 2 * margin + system_gap) // (system_height + system_gap)
+    if num_systems < 1:
+        raise ValueError('a system of %d staves does not fit on the page' % staves_per_system)
+
+    x1 = margin
+    x2 = width - margin - 1
+    bar_width = 2 * line
+
+    # notehead template: an ellipse one staff space high
+    head_h = space
+    head_w = int(1.3 * space)
+    yy, xx = np.mgrid[:head_h, :head_w]
+    head = (((yy - (head_h - 1) / 2.0) / (head_h / 2.0)) ** 2 +
+            ((xx - (head_w - 1) / 2.0) / (head_w / 2.0)) ** 2) <= 1.0
+    stem_length = int(3.5 * space)
+
+    staff_bb = []
+    bar_bb = []
+    for s in range(num_systems):
+        system_y1 = margin + s * (system_height + system_gap)
+        system_y2 = system_y1 + system_height - 1
+
+        # barline positions: the start and end of the system and uneven measures in between
+        measure_widths = rng.uniform(0.7, 1.3, measures_per_system)
+        bars = x1 + np.round(np.cumsum(measure_widths) / measure_widths.sum() * (x2 - x1 - bar_width + 1)).astype(int)
+        bars = [x1] + bars.tolist()
+
+        for i in range(staves_per_system):
+            staff_no = s * staves_per_system + i + 1
+            y1 = system_y1 + i * (staff_height + staff_gap)
+            y2 = y1 + staff_height - 1
+            staff_bb.append([staff_no, x1, y1, x2, y2])
+
+            for k in range(5):
+                black[y1 + k * space:y1 + k * space + line, x1:x2 + 1] = 1
+
+            for bx in bars:
+                bar_bb.append((staff_no, bx, y1, bx + bar_width - 1, y2))
+                if not barthru:
+                    black[y1:y2 + 1, bx:bx + bar_width] = 1
+
+            # notes with stems up, kept clear of the barlines
+            for m in range(measures_per_system):
+                lo = bars[m] + bar_width + space
+                hi = bars[m + 1] - head_w - space
+                if hi <= lo:
+                    continue
+                for hx in rng.randint(lo, hi, notes_per_measure):
+                    # on a line or in a space, up to a ledger line above or below the staff
+                    hy = y1 + rng.randint(-2, 9) * space // 2 - head_h // 2 + line // 2
+                    black[hy:hy + head_h, hx:hx + head_w] |= head
+                    stem_x = hx + head_w - line
+                    black[max(hy + head_h // 2 - stem_length, 0):hy + head_h // 2, stem_x:stem_x + line] = 1
+
+        if barthru:
+            for bx in bars:
+                black[system_y1:system_y2 + 1, bx:bx + bar_width] = 1
+
+    if noise > 0:
+        black ^= (rng.random_sample(black.shape) < noise).astype(np.uint8)
+
+    if skew:
+        # shear the columns vertically, which approximates a small rotation
+        shifts = np.round(np.tan(np.radians(skew)) * (np.arange(width) - width // 2)).astype(int)
+        rows = np.clip(np.arange(height)[:, None] - shifts[None, :], 0, height - 1)
+        black = black[rows, np.arange(width)[None, :]]
+
+    sg_hint = '(%d%s)x%d' % (staves_per_system, '|' if barthru else '', num_systems)
+
+    return SyntheticPage(black, dpi, sg_hint, staff_bb, bar_bb)
+
+def write_page(page, directory, name):
+    '''
+    Write a page in the layout of the evaluation dataset:
+    the image (name.tiff), the staff group hint (name.txt)
+    and the ground-truth MEI (name.mei). Returns the image path.
+    '''
+
+    from meicreate import BarlineDataConverter
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    image_path = os.path.join(directory, name + '.tiff')
+    imageloader.write_tiff(image_path, page.black, page.dpi)
+
+    with open(os.path.join(directory, name + '.txt'), 'w') as f:
+        f.write(page.sg_hint + '\n')
+
+    bar_converter = BarlineDataConverter(page.staff_bb, page.bar_bb, False)
+    bar_converter.bardata_to_mei(page.sg_hint, image_path, page.width, page.height, page.dpi)
+    bar_converter.output_mei(os.path.join(directory, name + '.mei'))
+
+    return image_path
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    for i in range(args.pages):
+        page = render_page(args.staves, not args.nobarthru, PAGE_SIZES[args.pagesize], args.dpi,
+                           args.measures, args.notes, args.noise, args.skew, args.seed + i)
+        name = 'synthetic_%04d' % (args.seed + i)
+        write_page(page, os.path.join(args.dataroot, str(i + 1)), name)
+        print '%s: %s' % (name, page.sg_hint)
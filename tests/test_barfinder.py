@@ -0,0 +1,287 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gamera.plugins import numeric_io
+from barfinder import BarlineFinder, PageFeatures, BBOX_DTYPE, bbox_array, group_broken_candidates, _range_reduce
+
+DPI = 600
+# [(y of the first staff line, x1, x2), ...], far from the top of the page
+STAVES = [(2000, 100, 1900), (2600, 100, 1900), (4200, 300, 1700)]
+# staves close enough to be refined in the same band
+CLOSE_STAVES = [(2000, 100, 1900), (2150, 100, 1900)]
+LINE_SPACING = 20
+
+def _page(staves=STAVES):
+    pixels = np.zeros((5000, 2000), dtype=np.uint16)
+    for y, x1, x2 in staves:
+        for i in range(5):
+            pixels[y + i * LINE_SPACING:y + i * LINE_SPACING + 3, x1:x2 + 1] = 1
+
+    return numeric_io.from_numpy(pixels)
+
+def _finder(image, image_dpi):
+    '''
+    Staff finder reporting each group of black rows as a staff,
+    in the coordinates of the image it runs on
+    '''
+
+    pixels = image.to_numpy()
+    rows = np.flatnonzero(pixels.any(axis=1))
+    gap = 3 * LINE_SPACING * image_dpi // DPI
+    groups = np.split(rows, np.flatnonzero(np.diff(rows) > gap) + 1) if len(rows) else []
+
+    staves = []
+    for i, g in enumerate(groups):
+        cols = np.flatnonzero(pixels[g[0]:g[-1] + 1].any(axis=0))
+        staves.append([i + 1, int(cols[0]), int(g[0]), int(cols[-1]), int(g[-1])])
+
+    return staves
+
+class TestPyramid(unittest.TestCase):
+    '''
+    The staves refined at full resolution are in page coordinates
+    '''
+
+    def test_staves_below_top(self):
+        bf = BarlineFinder(pyramid=True)
+        staves = bf._staff_line_position_pyramid(_finder, _page(), DPI)
+
+        self.assertEqual(staves, _finder(_page(), DPI))
+        self.assertEqual([st[2] for st in staves], [y for y, _, _ in STAVES])
+
+    def check_coarse(self, finder, page_staves=STAVES):
+        staves = BarlineFinder(pyramid=True)._staff_line_position_pyramid(finder, _page(page_staves), DPI)
+        refined = _finder(_page(page_staves), DPI)
+
+        # the coarse staves, scaled to the page
+        self.assertEqual(len(staves), len(refined))
+        self.assertTrue(all(v % 4 == 0 for st in staves for v in st[1:]))
+        self.assertTrue(all(abs(v - r) < 4 for st, rst in zip(staves, refined) for v, r in zip(st, rst)))
+
+    def test_finder_failure(self):
+        def finder(image, image_dpi):
+            if image_dpi == DPI:
+                raise RuntimeError('no staves')
+            return _finder(image, image_dpi)
+
+        self.check_coarse(finder)
+
+    def test_missing_staves(self):
+        def finder(image, image_dpi):
+            # a staff of the band is lost at full resolution
+            return _finder(image, image_dpi)[:1] if image_dpi == DPI else _finder(image, image_dpi)
+
+        self.check_coarse(finder, CLOSE_STAVES)
+
+def _features():
+    '''
+    Features of a page of one system of two staves, with barline candidates of different widths
+    '''
+
+    stf_position = [[1, 100, 1000, 1900, 1100, 1], [2, 100, 1300, 1900, 1400, 1]]
+    ccs = [(x, 1000, w, 401) for x, w in ((100, 6), (700, 8), (1300, 30), (1895, 6))]
+    ccs += [(500, 1000, 5, 100), (900, 1300, 5, 100), (300, 1200, 4, 50)]
+
+    return PageFeatures(stf_position, [1, 1], bbox_array(ccs), 'page_preprocessed.tiff', 2000, 3000, 300)
+
+class TestRefine(unittest.TestCase):
+    '''
+    Refining the features of a page gives the output of process_file
+    for any thresholds, without changing the features
+    '''
+
+    THRESHOLDS = [(0.1, 0.66), (0.02, 0.66), (0.3, 0.9)]
+
+    def test_process_file(self):
+        features = _features()
+        for ar_thresh, v_thresh in self.THRESHOLDS:
+            bf = BarlineFinder(ar_thresh, v_thresh)
+            bf.extract_features = lambda *args: features
+            result = bf.process_file('page.tiff', '(2|)')
+
+            self.assertEqual(result, BarlineFinder().refine(features, ar_thresh, v_thresh) + (
+                features.image_path, features.image_width, features.image_height, features.image_dpi))
+
+    def test_thresholds(self):
+        features = _features()
+        bars = [len(BarlineFinder().refine(features, ar_thresh, v_thresh)[1]) for ar_thresh, v_thresh in self.THRESHOLDS]
+        self.assertEqual(bars, [8, 6, 8])
+        self.assertEqual(features.stf_position, _features().stf_position)
+        self.assertEqual(features.ccs.tolist(), _features().ccs.tolist())
+
+class TestBboxArray(unittest.TestCase):
+
+    def test_fields(self):
+        bboxes = bbox_array([(10, 20, 3, 60), (5, 6, 7, 7)])
+        self.assertEqual(bboxes.dtype, BBOX_DTYPE)
+        self.assertEqual(bboxes[['x', 'y', 'w', 'h']].tolist(), [(10, 20, 3, 60), (5, 6, 7, 7)])
+        # the aspect ratio of gamera: width over height
+        self.assertEqual(bboxes['aspect'].tolist(), [0.05, 1.0])
+        self.assertEqual(bboxes['system'].tolist(), [0, 0])
+
+    def test_empty(self):
+        self.assertEqual(len(bbox_array([])), 0)
+        self.assertEqual(bbox_array([]).dtype, BBOX_DTYPE)
+
+def _quadratic_grouping(boxes, window):
+    '''
+    The grouping of broken candidates before the sweep: every candidate is
+    compared with every other one
+    '''
+
+    groups = []
+    grouped = []
+    for x, y, w, h in boxes:
+        group = [i for i, b in enumerate(boxes) if x > b[0] - window and x < b[0] + window]
+        if group not in grouped:
+            grouped.append(group)
+            members = [boxes[i] for i in group]
+            x1 = min(b[0] for b in members)
+            y1 = min(b[1] for b in members)
+            groups.append((x1, y1, max(b[0] + b[2] for b in members) - x1, max(b[1] + b[3] for b in members) - y1))
+
+    return groups
+
+class TestGrouping(unittest.TestCase):
+    '''
+    The sweep groups broken candidates as the quadratic grouping did
+    '''
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for n in (1, 2, 10, 100):
+            for window in (0.5, 4, 20.5, 100):
+                boxes = zip(rng.randint(0, 500, n), rng.randint(0, 500, n), rng.randint(1, 10, n), rng.randint(1, 100, n))
+                groups = group_broken_candidates(bbox_array(boxes), window)
+                self.assertEqual(groups[['x', 'y', 'w', 'h']].tolist(), _quadratic_grouping(boxes, window))
+
+    def test_broken_barline(self):
+        # the pieces of a barline broken by the staff lines and a separate barline
+        boxes = [(100, 0, 4, 10), (101, 12, 4, 10), (100, 24, 5, 10), (300, 0, 4, 34)]
+        groups = group_broken_candidates(bbox_array(boxes), 16)
+        self.assertEqual(groups[['x', 'y', 'w', 'h']].tolist(), [(100, 0, 5, 34), (300, 0, 4, 34)])
+
+    def test_empty(self):
+        self.assertEqual(len(group_broken_candidates(bbox_array([]), 4)), 0)
+
+    def test_range_reduce(self):
+        rng = np.random.RandomState(1)
+        values = rng.randint(-1000, 1000, 37)
+        lo = np.array([i for i in range(37) for j in range(i + 1, 38)])
+        hi = np.array([j for i in range(37) for j in range(i + 1, 38)])
+        self.assertEqual(_range_reduce(values, lo, hi, np.minimum).tolist(), [values[i:j].min() for i, j in zip(lo, hi)])
+        self.assertEqual(_range_reduce(values, lo, hi, np.maximum).tolist(), [values[i:j].max() for i, j in zip(lo, hi)])
+
+class _Tile:
+    def __init__(self, offset_x, offset_y):
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+
+class TestSystemRegions(unittest.TestCase):
+    '''
+    The regions of interest are the systems padded by the margin,
+    clipped to the page and merged when they overlap
+    '''
+
+    # three systems, the last two close together
+    STF_POSITION = [[1, 100, 100, 1900, 150, 1], [2, 90, 200, 1900, 250, 1],
+                    [3, 100, 1000, 1900, 1050, 2], [4, 100, 1100, 1950, 1150, 3]]
+
+    def test_regions(self):
+        stf_position = [list(st) for st in self.STF_POSITION]
+        regions = BarlineFinder(roi=True)._system_regions(stf_position, 2000, 1180)
+        # one staff height of margin by default
+        self.assertEqual(regions, [(40, 50, 1950, 300), (50, 950, 1999, 1179)])
+        self.assertEqual(stf_position, self.STF_POSITION)
+
+    def test_margin(self):
+        regions = BarlineFinder(roi=True, roi_margin=10)._system_regions(self.STF_POSITION, 2000, 3000)
+        self.assertEqual(regions, [(80, 90, 1910, 260), (90, 990, 1910, 1060), (90, 1090, 1960, 1160)])
+
+    def test_tile_bboxes(self):
+        bboxes = bbox_array([(150, 120, 3, 40)])
+        tile_bboxes = BarlineFinder()._tile_bboxes(bboxes, 100, 100, _Tile(100, 100))
+        self.assertEqual(tile_bboxes[['x', 'y']].tolist(), [(150, 120)])
+        tile_bboxes = BarlineFinder()._tile_bboxes(bboxes, 100, 100, _Tile(0, 0))
+        self.assertEqual(tile_bboxes[['x', 'y']].tolist(), [(50, 20)])
+        self.assertEqual(bboxes[['x', 'y']].tolist(), [(150, 120)])
+
+class TestPageFeatures(unittest.TestCase):
+    '''
+    Saved features are only reused for the same image, pipeline version and parameters
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        params = BarlineFinder().extract_params('(2|)')
+        features = PageFeatures([[1, 10, 0, 500, 50, 1]], [1], bbox_array([(1, 2, 3, 40)]), 'page_preprocessed.tiff',
+                                600, 800, 300, params=params, image_hash='a' * 40)
+        path = os.path.join(self.tmp_dir, 'page_features.pickle')
+        features.save(path)
+        loaded = PageFeatures.load(path)
+
+        self.assertEqual(loaded.stf_position, features.stf_position)
+        self.assertEqual(loaded.ccs.tolist(), features.ccs.tolist())
+        self.assertTrue(loaded.matches(params, 'a' * 40))
+        self.assertFalse(loaded.matches(params, 'b' * 40))
+        self.assertFalse(loaded.matches(BarlineFinder().extract_params('(1)'), 'a' * 40))
+
+    def test_unreadable(self):
+        path = os.path.join(self.tmp_dir, 'page_features.pickle')
+        with open(path, 'wb') as f:
+            f.write('not a pickle')
+        self.assertEqual(PageFeatures.load(path), None)
+
+class TestProcessBook(unittest.TestCase):
+    '''
+    The book is written from the results of its pages, in the order of the jobs
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_book(self):
+        staff_bb = [[1, 10, 0, 500, 50], [2, 10, 100, 500, 150]]
+        results = dict(('page%d.tiff' % i, (staff_bb, [(s, 50 + 10 * i, 100*(s-1), 52 + 10 * i, 100*(s-1)+50) for s in (1, 2)],
+                                            'page%d_preprocessed.tiff' % i, 600, 800, 300)) for i in range(3))
+        jobs = [('page%d.tiff' % i, '(2|)', 'page%d.mei' % i) for i in range(3)]
+
+        def process_files(jobs, workers=None):
+            # the pages complete out of order and the second one fails
+            for job in reversed(jobs):
+                self.assertEqual(job[2], None)
+                if job[0] == 'page1.tiff':
+                    yield job, None, 'Traceback'
+                else:
+                    yield job, results[job[0]], None
+
+        bf = BarlineFinder(mei_ids='counter')
+        bf.process_files = process_files
+        book_path = os.path.join(self.tmp_dir, 'book.mei')
+        done = list(bf.process_book(jobs, book_path))
+        self.assertEqual([job[0] for job, result, error in done], ['page2.tiff', 'page1.tiff', 'page0.tiff'])
+
+        from meicreate import BookConverter
+        expected_path = os.path.join(self.tmp_dir, 'expected.mei')
+        BookConverter([('(2|)', results['page0.tiff']), ('(2|)', results['page2.tiff'])], id_strategy='counter').write_mei(expected_path)
+        with open(book_path) as book:
+            with open(expected_path) as expected:
+                self.assertEqual(book.read(), expected.read())
+
+if __name__ == '__main__':
+    unittest.main()
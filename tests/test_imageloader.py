@@ -0,0 +1,109 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import imageloader
+from imageloader import read_tiff_info, read_image_info, load_image, write_tiff
+
+def _write_greyscale_strips(path, pixels, rows_per_strip, dpi):
+    '''
+    Write an uncompressed big endian 8 bit greyscale TIFF whose strips
+    are not contiguous in the file
+    '''
+
+    height, width = pixels.shape
+    strips = [pixels[i:i+rows_per_strip].tostring() for i in range(0, height, rows_per_strip)]
+    entries = [
+        (imageloader.IMAGE_WIDTH, 4, [width]),
+        (imageloader.IMAGE_LENGTH, 4, [height]),
+        (imageloader.BITS_PER_SAMPLE, 3, [8]),
+        (imageloader.PHOTOMETRIC, 3, [imageloader.BLACK_IS_ZERO]),
+        (imageloader.STRIP_OFFSETS, 4, None),
+        (imageloader.ROWS_PER_STRIP, 4, [rows_per_strip]),
+        (imageloader.STRIP_BYTE_COUNTS, 4, [len(s) for s in strips]),
+        (imageloader.X_RESOLUTION, 5, None),
+        (imageloader.RESOLUTION_UNIT, 3, [3]),
+    ]
+    ifd_size = 2 + 12 * len(entries) + 4
+    # out of line values follow the image file directory: strip offsets, strip byte counts, resolution
+    extra_offset = 8 + ifd_size
+    data_offset = extra_offset + 8 * len(strips) + 8
+    # a gap of 3 bytes between the strips
+    strip_offsets = [data_offset + sum(len(s) + 3 for s in strips[:i]) for i in range(len(strips))]
+    values = {imageloader.STRIP_OFFSETS: strip_offsets, imageloader.X_RESOLUTION: None}
+
+    ifd = struct.pack('>H', len(entries))
+    extra = ''
+    for tag, field_type, value in entries:
+        value = values.get(tag, value)
+        if tag == imageloader.X_RESOLUTION:
+            ifd += struct.pack('>HHII', tag, field_type, 1, extra_offset + len(extra))
+            extra += struct.pack('>II', dpi * 100, 254)
+        elif len(value) > 1:
+            ifd += struct.pack('>HHII', tag, field_type, len(value), extra_offset + len(extra))
+            extra += struct.pack('>' + 'I' * len(value), *value)
+        elif field_type == 3:
+            ifd += struct.pack('>HHIHH', tag, field_type, 1, value[0], 0)
+        else:
+            ifd += struct.pack('>HHII', tag, field_type, 1, value[0])
+    ifd += struct.pack('>I', 0)
+
+    with open(path, 'wb') as f:
+        f.write(b'MM\x00*' + struct.pack('>I', 8))
+        f.write(ifd)
+        f.write(extra.ljust(data_offset - extra_offset, '\x00'))
+        for s in strips:
+            f.write(s + '\x00' * 3)
+
+class TestImageLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.black = (rng.random_sample((37, 29)) < 0.3).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tiff_info(self):
+        path = os.path.join(self.tmp_dir, 'page.tiff')
+        write_tiff(path, self.black, 300)
+        info = read_tiff_info(path)
+        self.assertEqual((info.width, info.height, info.dpi), (29, 37, 300))
+        self.assertEqual((info.bits_per_sample, info.samples_per_pixel), (1, 1))
+        self.assertEqual(read_image_info(path).dpi, 300)
+
+    def test_not_tiff(self):
+        path = os.path.join(self.tmp_dir, 'page.png')
+        with open(path, 'wb') as f:
+            f.write('\x89PNG\r\n\x1a\n')
+        self.assertRaises(ValueError, read_tiff_info, path)
+
+    def test_memmap(self):
+        path = os.path.join(self.tmp_dir, 'page.tiff')
+        write_tiff(path, self.black, 300)
+        info = read_tiff_info(path)
+        # the pixels of a single strip are memory-mapped, not read
+        self.assertTrue(isinstance(imageloader._read_uncompressed_tiff(path, info), np.memmap))
+        self.assertEqual(load_image(path, info).to_numpy().tolist(), self.black.tolist())
+        self.assertEqual(load_image(path, greyscale=True).to_numpy().tolist(), ((1 - self.black) * 255).tolist())
+
+    def test_strips(self):
+        path = os.path.join(self.tmp_dir, 'page.tiff')
+        pixels = np.arange(37 * 29, dtype=np.uint32).reshape(37, 29).astype(np.uint8)
+        _write_greyscale_strips(path, pixels, 8, 300)
+        info = read_tiff_info(path)
+        # dots per centimetre are converted to dots per inch
+        self.assertEqual((info.width, info.height, info.dpi), (29, 37, 300))
+        self.assertEqual(imageloader._read_uncompressed_tiff(path, info).tolist(), pixels.tolist())
+        self.assertEqual(load_image(path, info).to_numpy().tolist(), pixels.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from intervalindex import IntervalIndex
+
+def _random_bbs(rng, n):
+    bbs = []
+    for i in range(n):
+        x1, y1 = rng.randint(0, 200, 2)
+        bbs.append([i + 1, x1, y1, x1 + rng.randint(0, 100), y1 + rng.randint(0, 100)])
+
+    return bbs
+
+class TestIntervalIndex(unittest.TestCase):
+    '''
+    The index finds the same bounding boxes as a scan over all of them
+    '''
+
+    def test_overlapping(self):
+        rng = np.random.RandomState(0)
+        for n in (0, 1, 5, 50):
+            bbs = _random_bbs(rng, n)
+            index = IntervalIndex(bbs)
+            for y1, y2 in [(y, y + d) for y in range(-10, 320, 7) for d in (0, 1, 15, 60)]:
+                expected = [i for i, bb in enumerate(bbs) if max(y1, bb[2] + 1) <= min(y2, bb[4] - 1)]
+                self.assertEqual(index.overlapping(y1, y2), expected)
+
+    def test_first_containing(self):
+        rng = np.random.RandomState(1)
+        for n in (0, 1, 5, 50):
+            bbs = _random_bbs(rng, n)
+            x = rng.randint(-10, 320, 500)
+            y = rng.randint(-10, 320, 500)
+            expected = []
+            for px, py in zip(x, y):
+                inside = [i for i, bb in enumerate(bbs) if bb[1] < px < bb[3] and bb[2] < py < bb[4]]
+                expected.append(inside[0] if inside else -1)
+            self.assertEqual(IntervalIndex(bbs).first_containing(x, y).tolist(), expected)
+
+    def test_staves(self):
+        staves = [[1, 10, 0, 500, 50], [2, 10, 100, 500, 150]]
+        index = IntervalIndex(staves)
+        self.assertEqual(index.overlapping(40, 110), [0, 1])
+        self.assertEqual(index.overlapping(50, 100), [])
+        self.assertEqual(index.first_containing([20, 20, 600], [25, 125, 25]).tolist(), [0, 1, -1])
+
+if __name__ == '__main__':
+    unittest.main()
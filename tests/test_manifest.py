@@ -0,0 +1,110 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import manifest
+from manifest import Manifest
+
+PARAMS = {'ar_thresh': 0.1, 'v_thresh': 0.66}
+
+class TestManifest(unittest.TestCase):
+    '''
+    An output is only processed again if its input, hint, parameters or code changed,
+    or if it is missing
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'manifest.jsonl')
+        self.input_path = os.path.join(self.tmp_dir, 'page.tiff')
+        self.output_path = os.path.join(self.tmp_dir, 'page.mei')
+        self.write(self.input_path, 'image')
+
+    def tearDown(self):
+        manifest.file_hash = self.file_hash
+        shutil.rmtree(self.tmp_dir)
+
+    file_hash = staticmethod(manifest.file_hash)
+
+    def write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def process(self, m, sg_hint='(2|)'):
+        '''
+        Process the page if it is not up to date, returns whether it was processed
+        '''
+
+        up_to_date, fingerprint = m.check(self.output_path, self.input_path, sg_hint)
+        if not up_to_date:
+            self.write(self.output_path, 'mei')
+            m.record(self.output_path, self.input_path, sg_hint, fingerprint)
+        return not up_to_date
+
+    def test_skip(self):
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.assertTrue(self.process(m))
+        self.assertFalse(self.process(m))
+        m.close()
+
+        # the records are read back by the next run
+        m = Manifest(self.path, '1.0', dict(PARAMS))
+        self.assertEqual(len(m), 1)
+        self.assertFalse(self.process(m))
+
+    def test_recompute(self):
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.process(m)
+        self.assertTrue(self.process(m, '(1)'))
+        self.assertTrue(self.process(Manifest(self.path, '2.0', PARAMS)))
+        self.assertTrue(self.process(Manifest(self.path, '2.0', dict(PARAMS, ar_thresh=0.2))))
+
+        m = Manifest(self.path, '2.0', dict(PARAMS, ar_thresh=0.2))
+        os.remove(self.output_path)
+        self.assertTrue(self.process(m))
+
+        self.write(self.input_path, 'another image')
+        self.assertTrue(self.process(m))
+
+    def test_touched(self):
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.process(m)
+        os.utime(self.input_path, (1, 1))
+
+        hashed = []
+        def file_hash(path):
+            hashed.append(path)
+            return self.file_hash(path)
+        manifest.file_hash = file_hash
+
+        # a touched but unchanged input is hashed once, then recognized by its stamp
+        self.assertFalse(self.process(m))
+        self.assertFalse(self.process(m))
+        self.assertEqual(hashed, [self.input_path])
+
+    def test_interrupted(self):
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.process(m)
+        m.close()
+        with open(self.path, 'a') as f:
+            f.write('{"output": "other.m')
+
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.assertEqual(len(m), 1)
+        self.assertFalse(self.process(m))
+
+    def test_compact(self):
+        m = Manifest(self.path, '1.0', PARAMS)
+        self.process(m)
+        self.process(m, '(1)')
+        m.compact()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertFalse(self.process(Manifest(self.path, '1.0', PARAMS), '(1)'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from meicreate import BarlineDataConverter
+from meicombine import MeiCombiner, StreamingMeiCombiner
+
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+MEI = '{http://www.music-encoding.org/ns/mei}'
+
+STAFF_BB = [[1, 10, 0, 500, 50], [2, 10, 100, 500, 150]]
+BAR_BB = [(s, x, 100*(s-1), x+2, 100*(s-1)+50) for s in (1, 2) for x in (50, 200, 400)]
+
+def _ids_and_references(path):
+    root = ET.parse(path).getroot()
+    ids = [e.get(XML_ID) for e in root.iter()]
+    references = [v[1:] for e in root.iter() for k, v in e.items() if k != XML_ID and v.startswith('#')]
+
+    return ids, references
+
+class TestCombineCounterIds(unittest.TestCase):
+    '''
+    Pages written with counter ids all use the same ids,
+    combining them with the default settings must keep the ids unique
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pages = []
+        for i in range(2):
+            path = os.path.join(self.tmp_dir, 'page%d.mei' % i)
+            BarlineDataConverter(STAFF_BB, BAR_BB, False, 'counter').write_mei(path, '(2|)', 'page.tiff', 600, 800, 300)
+            self.pages.append(path)
+        self.output = os.path.join(self.tmp_dir, 'book.mei')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_output(self):
+        ids, references = _ids_and_references(self.output)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertTrue(set(references) <= set(ids))
+
+    def test_combine(self):
+        mc = MeiCombiner(self.pages, self.output)
+        mc.combine()
+        mc.write_mei()
+        self.check_output()
+
+    def test_combine_stream(self):
+        StreamingMeiCombiner(self.pages, self.output).combine()
+        self.check_output()
+
+    def test_combine_counter(self):
+        StreamingMeiCombiner(self.pages, self.output, 'counter').combine()
+        self.check_output()
+        ids, references = _ids_and_references(self.output)
+        self.assertTrue('p2-measure-1' in ids)
+
+class TestCombineUuidIds(unittest.TestCase):
+    '''
+    The random ids of pages that do not collide are kept as they are
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pages = []
+        for i in range(2):
+            path = os.path.join(self.tmp_dir, 'page%d.mei' % i)
+            BarlineDataConverter(STAFF_BB, BAR_BB, False).write_mei(path, '(2|)', 'page.tiff', 600, 800, 300)
+            self.pages.append(path)
+        self.output = os.path.join(self.tmp_dir, 'book.mei')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_output(self):
+        ids, references = _ids_and_references(self.output)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertTrue(set(references) <= set(ids))
+        # the surfaces and measures of both pages, with their ids
+        for name in ('surface', 'zone', 'measure', 'staff'):
+            page_ids = set()
+            for path in self.pages:
+                page_ids.update(e.get(XML_ID) for e in ET.parse(path).getroot().iter(MEI + name))
+            output_ids = set(e.get(XML_ID) for e in ET.parse(self.output).getroot().iter(MEI + name))
+            self.assertEqual(output_ids, page_ids)
+
+    def test_combine(self):
+        mc = MeiCombiner(self.pages, self.output)
+        mc.combine()
+        mc.write_mei()
+        self.check_output()
+
+    def test_combine_stream(self):
+        StreamingMeiCombiner(self.pages, self.output).combine()
+        self.check_output()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import meiids
+from meicreate import BarlineDataConverter, BookConverter, read_boxes, read_bdat, find_conversion_jobs, page_jobs
+
+MEI = '{http://www.music-encoding.org/ns/mei}'
+
+STAFF_BB = [[1, 10, 0, 500, 50], [2, 10, 100, 500, 150]]
+BAR_BB = [(s, x, 100*(s-1), x+2, 100*(s-1)+50) for s in (1, 2) for x in (50, 200, 400)]
+
+class _Tomorrow(datetime.date):
+    @classmethod
+    def today(cls):
+        return datetime.date.today() + datetime.timedelta(days=1)
+
+class _TomorrowModule:
+    date = _Tomorrow
+
+class TestDeterministicOutput(unittest.TestCase):
+    '''
+    With counter ids, reruns on the same input are byte-identical, even on another day
+    '''
+
+    def tearDown(self):
+        meiids.datetime = datetime
+
+    def rerun(self, write):
+        first = StringIO()
+        write(first)
+        meiids.datetime = _TomorrowModule
+        second = StringIO()
+        write(second)
+
+        return first.getvalue(), second.getvalue()
+
+    def test_page(self):
+        def write(f):
+            converter = BarlineDataConverter(STAFF_BB, BAR_BB, False, 'counter')
+            converter.write_mei(f, '(2|)', 'page.tiff', 600, 800, 300)
+
+        first, second = self.rerun(write)
+        self.assertEqual(first, second)
+        self.assertFalse('<date' in first)
+
+    def test_book(self):
+        pages = [('(2|)', (STAFF_BB, BAR_BB, 'page%d.tiff' % i, 600, 800, 300)) for i in range(2)]
+        first, second = self.rerun(lambda f: BookConverter(pages, id_strategy='counter').write_mei(f))
+        self.assertEqual(first, second)
+
+    def test_given_date(self):
+        f = StringIO()
+        BarlineDataConverter(STAFF_BB, BAR_BB, False, 'counter', date='2013-05-01').write_mei(f, '(2|)', 'page.tiff', 600, 800, 300)
+        self.assertTrue('<date xml:id="date-1">2013-05-01</date>' in f.getvalue())
+
+class TestBookStaffGroups(unittest.TestCase):
+    '''
+    A page whose staff group hint differs from the one of the previous page
+    gets a scoreDef of its own after its page break
+    '''
+
+    def test_mixed_hints(self):
+        pages = [(sg_hint, (STAFF_BB, BAR_BB, 'page%d.tiff' % i, 600, 800, 300)) for i, sg_hint in enumerate(['(2|)', '(2|)', '(1)'])]
+        f = StringIO()
+        BookConverter(pages, id_strategy='counter').write_mei(f)
+
+        section = ET.fromstring(f.getvalue()).find('.//' + MEI + 'section')
+        tags = [e.tag[len(MEI):] for e in section if e.tag[len(MEI):] in ('pb', 'scoreDef')]
+        self.assertEqual(tags, ['pb', 'pb', 'scoreDef'])
+        staff_defs = section.find(MEI + 'scoreDef').findall('.//' + MEI + 'staffDef')
+        self.assertEqual([e.get('n') for e in staff_defs], ['1'])
+
+class TestReaders(unittest.TestCase):
+    '''
+    Reading the bar and staff text files and .bdat files of the bulk converter
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_read_boxes(self):
+        path = self.write('page_staff_vertices.txt', '1 10 0 500 50\n2,10,100,500,150\n')
+        self.assertEqual(read_boxes(path).tolist(), STAFF_BB)
+
+    def test_read_boxes_invalid(self):
+        self.assertRaises(ValueError, read_boxes, self.write('a.txt', '1 10 0 500\n'))
+        self.assertRaises(ValueError, read_boxes, self.write('b.txt', '1 10 0 500 5x\n'))
+
+    def test_read_bdat(self):
+        # two bar lines of the first system, a system without bar lines, one bar line of the third system
+        path = self.write('page.bdat', '300 10 302 90\n100 12 101 88\n~\n~\n50 200 51 280\n')
+        staff_bb, bar_bb = read_bdat(path)
+        self.assertEqual(staff_bb.tolist(), [[1, 100, 10, 302, 90], [2, 50, 200, 51, 280]])
+        self.assertEqual(bar_bb.tolist(), [[1, 100, 12, 101, 88], [1, 300, 10, 302, 90], [2, 50, 200, 51, 280]])
+
+    def test_read_bdat_empty(self):
+        staff_bb, bar_bb = read_bdat(self.write('page.bdat', ''))
+        self.assertEqual((staff_bb.shape, bar_bb.shape), ((0, 5), (0, 5)))
+
+    def test_read_bdat_truncated(self):
+        self.assertRaises(ValueError, read_bdat, self.write('a.bdat', '300 10 302 90\n100 12 1'))
+        self.assertRaises(ValueError, read_bdat, self.write('b.bdat', '300 10 302 90\n100 12\n'))
+
+    def test_find_conversion_jobs(self):
+        for name in ('b/page_bar_position.txt', 'b/page_bar_position_2.txt', 'a/other.bdat'):
+            if not os.path.isdir(os.path.join(self.tmp_dir, os.path.dirname(name))):
+                os.makedirs(os.path.join(self.tmp_dir, os.path.dirname(name)))
+            self.write(name, '')
+        self.write('b/page.txt', '(2|)\n')
+
+        jobs = find_conversion_jobs(self.tmp_dir)
+        self.assertEqual([(kind, sg_hint, os.path.relpath(output_path, self.tmp_dir)) for kind, inputs, sg_hint, image_path, output_path in jobs],
+                         [('bdat', None, 'a/other.mei'), ('txt', '(2|)', 'b/page.mei'), ('txt', '(2|)', 'b/page_2.mei')])
+        # a book holds a single bar file of each page
+        self.assertEqual(page_jobs(jobs), jobs[:2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from runindex import VerticalRunIndex
+
+def _cc_analysis(black):
+    '''
+    Bounding boxes [(x, y, ncols, nrows), ...] of the 8-connected components
+    in the order of their first pixel in a row by row scan, as the
+    connected component analysis of gamera, and the area of each component
+    '''
+
+    nrows, ncols = black.shape
+    seen = np.zeros(black.shape, dtype=bool)
+    bboxes = []
+    areas = []
+    for y in range(nrows):
+        for x in range(ncols):
+            if not black[y, x] or seen[y, x]:
+                continue
+            seen[y, x] = True
+            stack = [(y, x)]
+            pixels = []
+            while stack:
+                py, px = stack.pop()
+                pixels.append((py, px))
+                for ny in range(max(py - 1, 0), min(py + 2, nrows)):
+                    for nx in range(max(px - 1, 0), min(px + 2, ncols)):
+                        if black[ny, nx] and not seen[ny, nx]:
+                            seen[ny, nx] = True
+                            stack.append((ny, nx))
+            ys = [p[0] for p in pixels]
+            xs = [p[1] for p in pixels]
+            bboxes.append((min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1))
+            areas.append(len(pixels))
+
+    return bboxes, areas
+
+def _random_rasters():
+    rng = np.random.RandomState(0)
+    for density in (0.05, 0.3, 0.6):
+        for shape in ((1, 1), (1, 30), (30, 1), (25, 40)):
+            yield (rng.random_sample(shape) < density).astype(np.uint16)
+
+class TestVerticalRunIndex(unittest.TestCase):
+    '''
+    The run index answers the queries of the filtering and connected component stages
+    as a pass over the raster does
+    '''
+
+    def test_runs(self):
+        black = np.array([[1, 0, 1],
+                          [1, 0, 0],
+                          [0, 0, 1],
+                          [1, 0, 1]], dtype=np.uint16)
+        runs = VerticalRunIndex.from_array(black)
+        self.assertEqual(zip(runs.cols.tolist(), runs.starts.tolist(), runs.lengths.tolist()),
+                         [(0, 0, 2), (0, 3, 1), (2, 0, 1), (2, 2, 2)])
+        self.assertEqual(runs.to_array().tolist(), black.tolist())
+
+    def test_to_array(self):
+        for black in _random_rasters():
+            self.assertEqual(VerticalRunIndex.from_array(black).to_array().tolist(), black.tolist())
+
+    def test_filter_short_runs(self):
+        for black in _random_rasters():
+            runs = VerticalRunIndex.from_array(black)
+            filtered = runs.filter_short_runs(2)
+            self.assertTrue((filtered.lengths >= 2).all())
+            self.assertEqual(len(filtered), (runs.lengths >= 2).sum())
+
+    def test_components(self):
+        for black in _random_rasters():
+            bboxes, areas = _cc_analysis(black)
+            self.assertEqual(VerticalRunIndex.from_array(black).component_bboxes(), bboxes)
+
+    def test_despeckle(self):
+        for black in _random_rasters():
+            bboxes, areas = _cc_analysis(black)
+            despeckled = VerticalRunIndex.from_array(black).despeckle(3)
+            self.assertEqual(despeckled.component_bboxes(), [bb for bb, area in zip(bboxes, areas) if area >= 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sidecar import sidecar_path, write_results, read_results
+
+STAFF_BB = [[1, 10, 0, 500, 50], [2, 10, 100, 500, 150]]
+BAR_BB = [(s, x, 100*(s-1), x+2, 100*(s-1)+50) for s in (1, 2) for x in (50, 200, 400)]
+RESULT = (STAFF_BB, BAR_BB, 'page_preprocessed.tiff', 600, 800, 300)
+
+class TestSidecar(unittest.TestCase):
+    '''
+    The results of a page are read back from a sidecar file as they were written
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def round_trip(self, sidecar_format, result):
+        path = sidecar_path(os.path.join(self.tmp_dir, 'page.mei'), sidecar_format)
+        write_results(path, *result)
+        return read_results(path).to_result()
+
+    def test_bfr(self):
+        self.assertEqual(self.round_trip('bfr', RESULT), RESULT)
+
+    def test_npz(self):
+        self.assertEqual(self.round_trip('npz', RESULT), RESULT)
+
+    def test_no_bars(self):
+        result = ([], [], u'p\xe4ge_preprocessed.tiff', 600, 800, 300)
+        for sidecar_format in ('bfr', 'npz'):
+            self.assertEqual(self.round_trip(sidecar_format, result),
+                             ([], [], u'p\xe4ge_preprocessed.tiff'.encode('utf-8'), 600, 800, 300))
+
+    def test_path(self):
+        self.assertEqual(sidecar_path('mei/page.mei'), 'mei/page.bfr')
+        self.assertEqual(sidecar_path('mei/page.mei', 'npz'), 'mei/page.npz')
+
+    def test_not_sidecar(self):
+        path = os.path.join(self.tmp_dir, 'page.bfr')
+        with open(path, 'wb') as f:
+            f.write('\0' * 64)
+        self.assertRaises(ValueError, read_results, path)
+        self.assertRaises(ValueError, read_results, os.path.join(self.tmp_dir, 'page.txt'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from meiids import id_generator
+from meiwriter import MeiWriter
+from staffgroups import StaffGroupHint, compile_hint
+
+def _staff_grp(group):
+    '''
+    The staffGrp written from the template of a group, as nested
+    (barthru, [staff n or child staffGrp, ...]) tuples
+    '''
+
+    f = StringIO()
+    group.write_mei(MeiWriter(f, ids=id_generator('counter')))
+
+    def convert(element):
+        if element.tag == 'staffDef':
+            return int(element.get('n'))
+        return (element.get('barthru') == 'true', [convert(child) for child in element])
+
+    return convert(ET.fromstring(f.getvalue()))
+
+class TestCompileHint(unittest.TestCase):
+
+    def test_systems(self):
+        sg_hint = compile_hint('(2|)x2 (4(2|))')
+        self.assertEqual([(group.num_staves, num_sb) for group, num_sb in sg_hint.groupings], [(2, 2), (6, 1)])
+        self.assertEqual(sg_hint.staff_systems, [1, 1, 2, 2, 3, 3, 3, 3, 3, 3])
+        self.assertTrue(sg_hint.largest_group is sg_hint.groupings[1][0])
+
+    def test_memoized(self):
+        sg_hint = compile_hint('(3)')
+        self.assertTrue(compile_hint('(3)') is sg_hint)
+        self.assertTrue(compile_hint(sg_hint) is sg_hint)
+        self.assertFalse(StaffGroupHint('(3)') is sg_hint)
+
+    def test_staff_grp(self):
+        self.assertEqual(_staff_grp(compile_hint('(2|)').largest_group), (True, [1, 2]))
+        self.assertEqual(_staff_grp(compile_hint('(1)').largest_group), (False, [1]))
+        self.assertEqual(_staff_grp(compile_hint('(4(2|))').largest_group), (False, [1, 2, 3, 4, (True, [5, 6])]))
+        self.assertEqual(_staff_grp(compile_hint('((2|)1(3|))').largest_group),
+                         (False, [(True, [1, 2]), 3, (True, [4, 5, 6])]))
+
+    def test_staff_defs(self):
+        group = compile_hint('(4(2|))').largest_group
+        self.assertEqual(group.staff_defs, [1, 2, 3, 4])
+        self.assertEqual([g.staff_defs for g in group.groups], [[5, 6]])
+
+class TestStaffGroupEquality(unittest.TestCase):
+
+    def test_equal(self):
+        self.assertEqual(compile_hint('(2|)').largest_group, StaffGroupHint('(2|)x3').largest_group)
+        self.assertNotEqual(compile_hint('(2|)').largest_group, compile_hint('(2)').largest_group)
+        self.assertNotEqual(compile_hint('(2|)').largest_group, compile_hint('(1)').largest_group)
+        self.assertFalse(compile_hint('(2|)').largest_group == None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stagecache import StageCache
+
+STAGES = [('preprocess', (False, False)), ('staff_find', (2, False)), ('ccs', ())]
+
+class TestStageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = StageCache(os.path.join(self.tmp_dir, 'cache'), '1.0')
+        self.keys = self.cache.stage_keys('a' * 40, STAGES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_keys(self):
+        # a key covers the parameters of the stage and of every preceding stage
+        other = self.cache.stage_keys('a' * 40, [STAGES[0], ('staff_find', (3, False)), STAGES[2]])
+        self.assertEqual(other[0], self.keys[0])
+        self.assertNotEqual(other[1], self.keys[1])
+        self.assertNotEqual(other[2], self.keys[2])
+        self.assertNotEqual(self.cache.stage_keys('b' * 40, STAGES)[0], self.keys[0])
+        self.assertNotEqual(StageCache(self.tmp_dir, '2.0').stage_keys('a' * 40, STAGES)[0], self.keys[0])
+
+    def test_resume(self):
+        self.assertEqual(self.cache.load(self.keys), (-1, []))
+
+        self.cache.put(self.keys[0], {'stage': 0})
+        self.cache.put(self.keys[1], {'stage': 1})
+        self.assertEqual(self.cache.load(self.keys), (1, [{'stage': 0}, {'stage': 1}]))
+
+    def test_resume_prefix(self):
+        # a stage is only resumed if every preceding stage is cached
+        self.cache.put(self.keys[0], {'stage': 0})
+        self.cache.put(self.keys[2], {'stage': 2})
+        self.assertEqual(self.cache.deepest(self.keys), 0)
+        self.assertEqual(self.cache.load(self.keys), (0, [{'stage': 0}]))
+
+    def test_load_evicted(self):
+        for i, key in enumerate(self.keys):
+            self.cache.put(key, {'stage': i})
+        # the entry disappears between the lookup and the read
+        get = self.cache.get
+        self.cache.get = lambda key: None if key == self.keys[1] else get(key)
+        self.assertEqual(self.cache.load(self.keys), (0, [{'stage': 0}]))
+
+    def test_eviction(self):
+        value = {'data': 'x' * 1000}
+        self.cache.put(self.keys[0], value)
+        entry_size = self.cache._total_bytes
+        os.utime(self.cache._entry_path(self.keys[0]), (0, 0))
+
+        cache = StageCache(self.cache._cache_dir, '1.0', max_bytes=entry_size * 3)
+        keys = cache.stage_keys('c' * 40, [('stage%d' % i, ()) for i in range(10)])
+        for i, key in enumerate(keys):
+            cache.put(key, value)
+            # the entries are older than the ones stored after them
+            os.utime(cache._entry_path(key), (i + 1, i + 1))
+            self.assertTrue(cache._total_bytes <= cache._max_bytes)
+
+        # the most recently used entries are kept
+        self.assertTrue(cache.has(keys[-1]))
+        self.assertFalse(cache.has(keys[0]))
+        self.assertFalse(cache.has(self.keys[0]))
+
+    def test_put_existing(self):
+        self.cache.put(self.keys[0], {'stage': 0})
+        self.cache.put(self.keys[0], {'stage': 'other'})
+        self.assertEqual(self.cache.get(self.keys[0]), {'stage': 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Per-stage timing and tracing of the barline finder.
+
+A Tracer is handed to BarlineFinder, which wraps each of its stages in
+tracer.stage(name). Every stage records its wall time, CPU time and any
+details the stage reports (image dimensions, candidate counts, ...) and the
+record is passed to the callbacks of the tracer, such as a JSONLinesExporter.
+Without a tracer the barline finder uses NULL_STAGE, which does nothing.
+"""
+
+import json
+import resource
+import time
+
+# stages of the barline finder, in pipeline order
+STAGES = ('load', 'border_removal', 'onebit', 'rotation', 'staff_find', 'glue', 'mfr',
+          'staffline_removal', 'despeckle', 'mfr_filter', 'ccs', 'candidate_check',
+          'number_assign', 'mei_build', 'mei_write', 'sidecar_write')
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss():
+    '''
+    Return the peak resident set size of the process in bytes, since the
+    last reset_peak_rss if the kernel supports resetting it
+    '''
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident set size of the process to its current size (linux only)
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+class Tracer:
+    '''
+    Collects stage records and passes them to callbacks
+    '''
+
+    def __init__(self, callbacks=None):
+        '''
+        PARAMETERS
+        ----------
+        callbacks {list}: functions called with the record {dict} of each finished stage
+        '''
+
+        self._callbacks = list(callbacks or [])
+        # page the stages currently belong to
+        self.page = None
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def stage(self, name, **details):
+        '''
+        Return a context manager timing the stage of the given name
+        '''
+
+        return Stage(self, name, details)
+
+    def emit(self, record):
+        for callback in self._callbacks:
+            callback(record)
+
+class Stage:
+    '''
+    Context manager timing a stage. Details are added to its record with record().
+    '''
+
+    def __init__(self, tracer, name, details):
+        self._tracer = tracer
+        self._name = name
+        self._details = details
+
+    def record(self, **details):
+        self._details.update(details)
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        record = {
+            'stage': self._name,
+            'page': self._tracer.page,
+            'start': self._wall,
+            'wall': time.time() - self._wall,
+            'cpu': _cpu_time() - self._cpu
+        }
+        record.update(self._details)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self._tracer.emit(record)
+
+        return False
+
+class _NullStage:
+    '''
+    Stage of a barline finder without a tracer
+    '''
+
+    def record(self, **details):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+NULL_STAGE = _NullStage()
+
+class JSONLinesExporter:
+    '''
+    Tracer callback appending each stage record to a file as a line of JSON.
+    The file is opened on first use, so that the exporter can be sent to
+    worker processes, which then append to the same file.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __call__(self, record):
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        return {'_path': self._path, '_file': None}